@@ -0,0 +1,367 @@
+"""
+Сквозной бенчмарк конвейера на синтетических страницах.
+
+    python bench/run.py --pages 12 --output bench-result.json
+
+Этапы:
+  split       — split_polygon_by_center_gap по всем строкам страницы
+  profile     — split_wide_lines по проекции чернил на строках двух колонок, слитых в одну
+  paragraphs  — line_polygons_to_paragraph_polygons и dedupe_paragraph_polygons
+  segmentation — pipeline.segment_page (kraken + разметка + нарезка), нужен CLI kraken
+  vlm         — predict_batch на CPU крошечной моделью со случайными весами (tiny_model.py)
+                или любой локальной моделью из --vlm-model
+  upload      — POST /upload-doc сервера с MinIO, Postgres и RabbitMQ в памяти (stand_ins.py)
+
+Результат — JSON со сводкой по каждому этапу; этап, для которого нет зависимостей,
+помечается "skipped" с причиной, поэтому файлы разных коммитов можно сравнивать построчно.
+"""
+import argparse
+import importlib.util
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+import types
+from datetime import datetime, timezone
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+WORKER_DIR = os.path.join(REPO_DIR, "mlWorker")
+SERVER_MAIN = os.path.join(REPO_DIR, "server", "main.py")
+
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, WORKER_DIR)
+
+from synthetic import make_pages  # noqa: E402
+from make_paragraph import split_polygon_by_center_gap, split_wide_lines, \
+    line_polygons_to_paragraph_polygons, dedupe_paragraph_polygons  # noqa: E402
+
+STAGES = ("split", "profile", "paragraphs", "segmentation", "vlm", "upload")
+
+
+class Skipped(Exception):
+    pass
+
+
+def summarize(samples, items=None):
+    """samples — длительности в секундах; items — сколько единиц работы обработано за все samples."""
+    ordered = sorted(samples)
+    total = sum(ordered)
+    summary = {
+        "count": len(ordered),
+        "total_s": round(total, 6),
+        "mean_ms": round(1000 * statistics.mean(ordered), 3),
+        "p50_ms": round(1000 * ordered[len(ordered) // 2], 3),
+        "p95_ms": round(1000 * ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 3),
+        "max_ms": round(1000 * ordered[-1], 3),
+    }
+    if items is not None and total > 0:
+        summary["items"] = items
+        summary["items_per_s"] = round(items / total, 3)
+    return summary
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def bench_split(pages, args):
+    samples = []
+    lines = 0
+    for page in pages:
+        for _ in range(args.repeat):
+            elapsed, _ = timed(lambda: [split_polygon_by_center_gap([list(p) for p in line], 1000, 50)
+                                        for line in page.lines])
+            samples.append(elapsed)
+            lines += len(page.lines)
+    return summarize(samples, items=lines)
+
+
+def merged_rows(page):
+    """Строки левой и правой колонок на одной высоте, слитые в один прямоугольник, как их иногда отдаёт kraken."""
+    rows = []
+    for left in page.lines:
+        lx = [x for x, _ in left]
+        ly = [y for _, y in left]
+        for right in page.lines:
+            rx = [x for x, _ in right]
+            ry = [y for _, y in right]
+            overlap = min(max(ly), max(ry)) - max(min(ly), min(ry))
+            if min(rx) > max(lx) and overlap > 0.5 * (max(ly) - min(ly)):
+                x0, x1 = min(lx), max(rx)
+                y0, y1 = min(min(ly), min(ry)), max(max(ly), max(ry))
+                rows.append([(x0, y0), (x1, y0), (x1, y1), (x0, y1)])
+                break
+    return rows
+
+
+def bench_profile(pages, args):
+    try:
+        import numpy as np
+        from PIL import Image
+    except ImportError as e:
+        raise Skipped(f"numpy and Pillow are required: {e}")
+
+    samples = []
+    rows = pieces = 0
+    for page in pages:
+        merged = merged_rows(page)
+        if not merged:
+            continue
+        gray = np.asarray(Image.open(io.BytesIO(page.render())).convert("L"))
+        for _ in range(args.repeat):
+            elapsed, parts = timed(split_wide_lines, merged, 1000, 50, gray=gray)
+            samples.append(elapsed)
+        rows += len(merged)
+        pieces += len(parts)
+    if not samples:
+        raise Skipped("no multi-column pages among the synthetic ones")
+    summary = summarize(samples, items=rows * args.repeat)
+    # слитая строка длиннее 1000 px должна распасться ровно на две — по межколоночному пробелу;
+    # более короткие (справа последняя строка абзаца) не режутся вовсе
+    summary["merged_rows"] = rows
+    summary["pieces"] = pieces
+    return summary
+
+
+def layout_paragraphs(line_polys):
+    return dedupe_paragraph_polygons(line_polygons_to_paragraph_polygons(line_polys), line_polys)
+
+
+def bench_paragraphs(pages, args):
+    samples = []
+    found = expected = duplicate_pixels = 0
+    for page in pages:
+        line_polys = split_wide_lines(page.lines, 1000, 50)
+        for _ in range(args.repeat):
+            elapsed, (paragraphs, stats) = timed(layout_paragraphs, line_polys)
+            samples.append(elapsed)
+        found += len(paragraphs)
+        expected += len(page.paragraphs)
+        duplicate_pixels += stats["pixels"]
+    summary = summarize(samples, items=len(pages) * args.repeat)
+    summary["duplicate_pixels"] = duplicate_pixels
+    # не метрика качества, а страховка: бенчмарк не должен ускориться ценой потери абзацев
+    summary["paragraphs_found"] = found
+    summary["paragraphs_expected"] = expected
+    return summary
+
+
+def bench_segmentation(pages, args):
+    if shutil.which("kraken") is None:
+        raise Skipped("kraken CLI is not installed")
+    try:
+        from pipeline import segment_page
+    except ImportError as e:
+        raise Skipped(f"worker dependencies are missing: {e}")
+
+    samples = []
+    crops = 0
+    for page in pages[:args.segmentation_pages]:
+        image = page.render()
+        elapsed, layout = timed(segment_page, image)
+        samples.append(elapsed)
+        crops += len(layout.crops)
+    summary = summarize(samples, items=len(samples))
+    summary["crops"] = crops
+    return summary
+
+
+def paragraph_crops(page, image_bytes):
+    from PIL import Image
+
+    img = Image.open(io.BytesIO(image_bytes))
+    crops = []
+    for paragraph in page.paragraphs:
+        points = [p for index in paragraph for p in page.lines[index]]
+        xs = [x for x, _ in points]
+        ys = [y for _, y in points]
+        crops.append(img.crop((min(xs), min(ys), max(xs), max(ys))))
+    return crops
+
+
+def load_vlm(args):
+    try:
+        import torch
+    except ImportError as e:
+        raise Skipped(f"torch is not installed: {e}")
+    torch.set_num_threads(args.threads or torch.get_num_threads())
+
+    if args.vlm_model:
+        from vlm import load_model_and_processor
+        return load_model_and_processor(args.vlm_model, lora_path=None, device="cpu")
+
+    if not os.path.isdir(args.tiny_from):
+        raise Skipped(f"no processor for the tiny model at {args.tiny_from}, pass --tiny-from or --vlm-model")
+    from tiny_model import build_tiny_model
+    return build_tiny_model(args.tiny_from, seed=args.seed)
+
+
+def bench_vlm(pages, args):
+    try:
+        from PIL import Image  # noqa: F401
+    except ImportError as e:
+        raise Skipped(f"Pillow is not installed: {e}")
+    model, processor = load_vlm(args)
+    from vlm import predict_batch, DEFAULT_INSTRUCTION
+
+    crops = []
+    for page in pages:
+        crops.extend(paragraph_crops(page, page.render()))
+    crops = crops[:args.vlm_crops]
+
+    # прогрев: первый generate включает ленивую инициализацию ядер
+    predict_batch(model, processor, crops[:1], DEFAULT_INSTRUCTION, max_new_tokens=2)
+
+    samples = []
+    for start in range(0, len(crops), args.vlm_batch):
+        batch = crops[start:start + args.vlm_batch]
+        elapsed, _ = timed(predict_batch, model, processor, batch, DEFAULT_INSTRUCTION,
+                           max_new_tokens=args.max_new_tokens, temperature=0)
+        samples.append(elapsed)
+    summary = summarize(samples, items=len(crops))
+    summary["batch_size"] = args.vlm_batch
+    summary["max_new_tokens"] = args.max_new_tokens
+    return summary
+
+
+def load_server(s3, db, broker):
+    try:
+        spec = importlib.util.spec_from_file_location("bench_server_main", SERVER_MAIN)
+        server = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(server)
+        from fastapi.testclient import TestClient
+    except ImportError as e:
+        raise Skipped(f"server dependencies are missing: {e}")
+
+    # подменяем только внешние системы; обработчик запроса остаётся настоящим
+    server.get_s3_client = lambda: s3
+    server.get_db_connection = db.connect
+    server.pika = types.SimpleNamespace(
+        BlockingConnection=broker.connection,
+        ConnectionParameters=lambda *a, **kw: None,
+        BasicProperties=server.pika.BasicProperties,
+        exceptions=server.pika.exceptions,
+    )
+    # без with: события startup (init_s3, init_db, LISTEN) не запускаются
+    return TestClient(server.app)
+
+
+def bench_upload(pages, args):
+    from stand_ins import InMemoryS3, InMemoryPostgres, InMemoryRabbitMQ
+
+    s3, db, broker = InMemoryS3(), InMemoryPostgres(), InMemoryRabbitMQ()
+    client = load_server(s3, db, broker)
+
+    try:
+        payloads = [page.render() for page in pages]
+    except ImportError:
+        # без Pillow грузим случайные байты размера типичного скана
+        rng = random.Random(args.seed)
+        payloads = [rng.randbytes(args.upload_bytes) for _ in pages]
+
+    samples = []
+    uploaded = 0
+    for i in range(args.uploads):
+        body = payloads[i % len(payloads)]
+        priority_class = "bulk" if i % 2 else "interactive"
+        elapsed, response = timed(client.post, "/upload-doc",
+                                  params={"priority_class": priority_class, "tenant": f"t{i % 4}"},
+                                  files={"file": (f"page{i}.jpg", body, "image/jpeg")})
+        response.raise_for_status()
+        samples.append(elapsed)
+        uploaded += len(body)
+
+    summary = summarize(samples, items=args.uploads)
+    summary["mb_per_s"] = round(uploaded / 2 ** 20 / sum(samples), 3)
+    summary["published"] = broker.published()
+    return summary
+
+
+BENCHMARKS = {
+    "split": bench_split,
+    "profile": bench_profile,
+    "paragraphs": bench_paragraphs,
+    "segmentation": bench_segmentation,
+    "vlm": bench_vlm,
+    "upload": bench_upload,
+}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark of the OCR pipeline on synthetic pages")
+    parser.add_argument("--stages", default=",".join(STAGES), help=f"Comma separated subset of {STAGES}")
+    parser.add_argument("--pages", type=int, default=18, help="Synthetic pages (DPI x columns x density)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="Repetitions of the geometry stages per page")
+    parser.add_argument("--segmentation-pages", type=int, default=3)
+    parser.add_argument("--vlm-model", default=None, help="Local VLM to run on CPU instead of the tiny model")
+    parser.add_argument("--tiny-from", default=os.path.join(WORKER_DIR, "models", "gemma-3-4b-it"),
+                        help="Model dir whose config and processor the tiny random model is built from")
+    parser.add_argument("--vlm-crops", type=int, default=32)
+    parser.add_argument("--vlm-batch", type=int, default=8)
+    parser.add_argument("--max-new-tokens", type=int, default=16)
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads")
+    parser.add_argument("--uploads", type=int, default=50)
+    parser.add_argument("--upload-bytes", type=int, default=1_500_000)
+    parser.add_argument("--output", default=None, help="Write JSON here instead of stdout")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    stages = [s.strip() for s in args.stages.split(",") if s.strip()]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        raise SystemExit(f"Unknown stages: {sorted(unknown)}")
+
+    elapsed, pages = timed(make_pages, args.pages, seed=args.seed)
+    report = {
+        "commit": git_commit(),
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "args": vars(args),
+        "pages": {
+            "count": len(pages),
+            "lines": sum(len(p.lines) for p in pages),
+            "paragraphs": sum(len(p.paragraphs) for p in pages),
+            "generated_s": round(elapsed, 3),
+        },
+        "stages": {},
+    }
+
+    for stage in stages:
+        print(f"-> {stage}", file=sys.stderr)
+        try:
+            report["stages"][stage] = BENCHMARKS[stage](pages, args)
+        except Skipped as e:
+            report["stages"][stage] = {"skipped": str(e)}
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Локальные заменители MinIO, Postgres и RabbitMQ для замера пути загрузки сервера.
+
+Они принимают ровно те вызовы, которые делает /upload-doc, и держат всё в памяти, поэтому
+замер показывает накладные расходы самого сервера (multipart, копирование файла, сериализация),
+а не сети и дисков.
+"""
+import threading
+
+
+class InMemoryS3:
+    def __init__(self):
+        self.objects = {}
+        self._lock = threading.Lock()
+
+    def upload_fileobj(self, fileobj, bucket, key):
+        data = fileobj.read()
+        with self._lock:
+            self.objects[(bucket, key)] = data
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        with self._lock:
+            self.objects[(Bucket, Key)] = Body if isinstance(Body, bytes) else Body.read()
+
+
+class _Cursor:
+    def __init__(self, db):
+        self.db = db
+        self._row = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=None):
+        statement = sql.lstrip().split(None, 1)[0].upper()
+        self.db.statements[statement] = self.db.statements.get(statement, 0) + 1
+        if statement == "SELECT":
+            # единственный SELECT на пути загрузки — размер очереди арендатора
+            self._row = (0,)
+        elif "RETURNING" in sql.upper():
+            # INSERT ... RETURNING id: строка создана
+            self._row = (params[0],)
+        else:
+            self._row = None
+
+    def fetchone(self):
+        return self._row
+
+
+class InMemoryPostgres:
+    def __init__(self):
+        self.statements = {}
+
+    def connect(self):
+        return self
+
+    def cursor(self):
+        return _Cursor(self)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class _Channel:
+    def __init__(self, broker):
+        self.broker = broker
+
+    def queue_declare(self, queue, **kwargs):
+        self.broker.queues.setdefault(queue, [])
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        with self.broker.lock:
+            self.broker.queues.setdefault(routing_key, []).append(body)
+
+
+class InMemoryRabbitMQ:
+    def __init__(self):
+        self.queues = {}
+        self.lock = threading.Lock()
+
+    def connection(self, *args, **kwargs):
+        broker = self
+
+        class Connection:
+            def channel(self):
+                return _Channel(broker)
+
+            def close(self):
+                pass
+
+        return Connection()
+
+    def published(self):
+        return sum(len(messages) for messages in self.queues.values())
@@ -0,0 +1,121 @@
+"""
+Синтетические страницы архивных дел с известной разметкой.
+
+Геометрия (полигоны строк в формате boundary kraken и разбиение на абзацы) строится без
+зависимостей, картинка рисуется Pillow только по запросу (render).
+"""
+import io
+import random
+from dataclasses import dataclass, field
+from typing import List, Tuple
+
+Point = Tuple[int, int]
+
+# A4 в дюймах
+PAGE_WIDTH_IN = 8.27
+PAGE_HEIGHT_IN = 11.69
+MARGIN_IN = 0.8
+COLUMN_GAP_IN = 0.4
+# межстрочный интервал ~12 pt машинописи; полигоны kraken захватывают выносные элементы,
+# поэтому соседние строки абзаца почти касаются друг друга
+LINE_PITCH_IN = 0.22
+LINE_HEIGHT_IN = 0.21
+INDENT_IN = 0.35
+# шаг вершин вдоль верхней и нижней кромки строки, как у kraken
+VERTEX_STEP_IN = 0.15
+
+
+@dataclass
+class SyntheticPage:
+    width: int
+    height: int
+    dpi: int
+    columns: int
+    seed: int
+    lines: List[List[Point]] = field(default_factory=list)
+    # индексы строк каждого абзаца
+    paragraphs: List[List[int]] = field(default_factory=list)
+
+    def render(self, quality: int = 85) -> bytes:
+        """JPEG-скан: неровный фон бумаги и «слова» из тёмных штрихов внутри полигонов строк."""
+        from PIL import Image, ImageDraw, ImageFilter
+
+        rng = random.Random(self.seed)
+        img = Image.effect_noise((self.width, self.height), 12).point(lambda v: 200 + v // 8)
+        draw = ImageDraw.Draw(img)
+        for polygon in self.lines:
+            xs = [x for x, _ in polygon]
+            ys = [y for _, y in polygon]
+            left, right, top, bottom = min(xs), max(xs), min(ys), max(ys)
+            x = left
+            while x < right:
+                word = min(right - x, rng.randint(self.dpi // 10, self.dpi // 2))
+                draw.rectangle((x, top + (bottom - top) // 4, x + word, bottom), fill=rng.randint(20, 70))
+                x += word + rng.randint(self.dpi // 30, self.dpi // 12)
+        img = img.filter(ImageFilter.GaussianBlur(radius=max(1, self.dpi // 300)))
+
+        out = io.BytesIO()
+        img.save(out, format="JPEG", quality=quality, dpi=(self.dpi, self.dpi))
+        return out.getvalue()
+
+
+def _line_boundary(rng, left, right, top, height, step, jitter) -> List[Point]:
+    """Полигон строки: верхняя кромка слева направо, нижняя — справа налево, с дрожанием внутрь."""
+    xs = list(range(left, right, step)) + [right]
+    upper = [(x, top + rng.randint(0, jitter)) for x in xs]
+    lower = [(x, top + height - rng.randint(0, jitter)) for x in reversed(xs)]
+    return upper + lower
+
+
+def make_page(dpi: int = 300, columns: int = 1, density: float = 1.0, seed: int = 0) -> SyntheticPage:
+    """
+    density — доля заполненной высоты колонки (0..1]; абзацы по 2–5 строк с красной строкой,
+    последняя строка абзаца короче, между абзацами — пол-интервала.
+    """
+    rng = random.Random(seed)
+    width = int(PAGE_WIDTH_IN * dpi)
+    height = int(PAGE_HEIGHT_IN * dpi)
+    margin = int(MARGIN_IN * dpi)
+    gap = int(COLUMN_GAP_IN * dpi)
+    pitch = int(LINE_PITCH_IN * dpi)
+    line_height = int(LINE_HEIGHT_IN * dpi)
+    jitter = max(1, dpi // 200)
+    indent = int(INDENT_IN * dpi)
+    step = max(1, int(VERTEX_STEP_IN * dpi))
+
+    column_width = (width - 2 * margin - (columns - 1) * gap) // columns
+    bottom_limit = margin + int((height - 2 * margin) * min(max(density, 0.05), 1.0))
+
+    page = SyntheticPage(width, height, dpi, columns, seed)
+    for column in range(columns):
+        left = margin + column * (column_width + gap)
+        right = left + column_width
+        top = margin
+        while top + pitch < bottom_limit:
+            paragraph = []
+            # не длиннее max_lines в make_paragraph, иначе «ожидаемые» абзацы теряют смысл
+            size = rng.randint(2, 5)
+            for i in range(size):
+                if top + pitch >= bottom_limit:
+                    break
+                line_left = left + (indent if i == 0 else rng.randint(0, dpi // 60))
+                line_right = right - rng.randint(0, dpi // 30)
+                if i == size - 1:
+                    line_right = line_left + int((line_right - line_left) * rng.uniform(0.2, 0.8))
+                paragraph.append(len(page.lines))
+                page.lines.append(_line_boundary(rng, line_left, line_right, top, line_height, step, jitter))
+                top += pitch
+            if paragraph:
+                page.paragraphs.append(paragraph)
+            top += pitch // 2
+    return page
+
+
+def make_pages(count: int, dpis=(200, 300, 400), columns=(1, 2), densities=(0.3, 0.7, 1.0), seed: int = 0):
+    """Перебирает сочетания DPI, числа колонок и плотности, чтобы набор был одинаковым между запусками."""
+    pages = []
+    combos = [(d, c, p) for d in dpis for c in columns for p in densities]
+    for i in range(count):
+        dpi, cols, density = combos[i % len(combos)]
+        pages.append(make_page(dpi=dpi, columns=cols, density=density, seed=seed + i))
+    return pages
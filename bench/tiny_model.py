@@ -0,0 +1,40 @@
+"""
+Крошечная Gemma-3 со случайными весами для замеров на CPU.
+
+Конфиг и процессор (токенизатор, препроцессинг картинок) берутся из настоящей модели, поэтому
+входы и длина промпта те же, что в продакшене; уменьшены только ширина и глубина сети.
+Качество текста бессмысленно — меряется обвязка predict_batch и масштабирование по батчу.
+"""
+import torch
+from transformers import AutoConfig, AutoModelForImageTextToText, AutoProcessor
+
+TEXT_LAYERS = 2
+VISION_LAYERS = 1
+
+
+def build_tiny_model(model_path: str, seed: int = 0):
+    config = AutoConfig.from_pretrained(model_path, local_files_only=True)
+
+    text = config.text_config
+    text.hidden_size = 64
+    text.intermediate_size = 128
+    text.num_hidden_layers = TEXT_LAYERS
+    text.num_attention_heads = 2
+    text.num_key_value_heads = 1
+    text.head_dim = 32
+    if getattr(text, "layer_types", None):
+        text.layer_types = text.layer_types[:TEXT_LAYERS]
+
+    vision = config.vision_config
+    vision.hidden_size = 32
+    vision.intermediate_size = 64
+    vision.num_hidden_layers = VISION_LAYERS
+    vision.num_attention_heads = 2
+
+    torch.manual_seed(seed)
+    model = AutoModelForImageTextToText.from_config(config, torch_dtype=torch.float32)
+    model.eval()
+
+    processor = AutoProcessor.from_pretrained(model_path, local_files_only=True)
+    processor.tokenizer.padding_side = "left"
+    return model, processor
@@ -0,0 +1,209 @@
+"""
+Промежуточные результаты стадий распознавания, адресуемые содержимым страницы.
+
+Каждая стадия (segmentation -> layout -> recognition -> entities) сохраняет свой выход
+сжатым JSON под ключом artifacts/<sha256 страницы>/<стадия>-<отпечаток>.json.gz.
+Отпечаток стадии считается по версиям её самой и всех предыдущих стадий, поэтому смена
+версии разметки абзацев инвалидирует layout, recognition и entities, но не сегментацию kraken,
+а смена LoRA — только recognition и entities. См. reprocess.py.
+
+Версии задаются в STAGE_VERSIONS; при изменении кода или параметров стадии версию нужно поднять
+(или переопределить переменной окружения <STAGE>_VERSION).
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+
+try:
+    from botocore.exceptions import ClientError
+except ImportError:
+    # bulk.py с локальным хранилищем обходится без boto3
+    ClientError = None
+
+from crop_filter import filter_version
+from config import S3_BUCKET_NAME, DEFAULT_INSTRUCTION, MODEL_PATH, LORA_PATH, weights_fingerprint
+
+logger = logging.getLogger(__name__)
+
+# s3 — в бакет документов; off — не сохранять; иначе — путь к локальному каталогу (bulk.py, отладка)
+ARTIFACT_STORE = os.getenv("ARTIFACT_STORE", "s3")
+ARTIFACTS_PREFIX = "artifacts"
+
+STAGES = ("segmentation", "layout", "recognition", "entities")
+
+
+def recognition_version(model_path=MODEL_PATH, lora_path=LORA_PATH):
+    """
+    Базовая модель — по имени папки, LoRA — по имени и содержимому файлов: адаптер, переобученный
+    в ту же папку, меняет версию одинаково на всех узлах. Где адаптера нет (роли без модели),
+    остаётся только имя — там RECOGNITION_VERSION нужно задавать явно, как у распознавателей.
+    """
+    instruction = hashlib.sha1(DEFAULT_INSTRUCTION.encode()).hexdigest()[:8]
+    model = os.path.basename(model_path.rstrip("/"))
+    if not lora_path:
+        lora = "base"
+    else:
+        lora = os.path.basename(lora_path.rstrip("/"))
+        if os.path.exists(lora_path):
+            lora = f"{lora}-{weights_fingerprint(lora_path, content=True)}"
+        else:
+            logger.warning("LoRA %s is not available, the recognition version only has its name; "
+                           "set RECOGNITION_VERSION to the recognizers' version", lora_path)
+    return f"{model}+{lora}+{instruction}"
+
+
+STAGE_VERSIONS = {
+    # модель и параметры kraken в pipeline.run_kraken
+    "segmentation": os.getenv("SEGMENTATION_VERSION", "kraken-blla-1"),
+    # split_wide_lines (по проекции чернил) + line_polygons_to_paragraph_polygons + dedupe + crop_filter
+    "layout": os.getenv("LAYOUT_VERSION") or f"profile-1000-50+paragraphs-1+dedupe-1+{filter_version()}",
+    # базовая модель, LoRA и промпт; бэкенд (torch/int8/openvino) в версию не входит
+    "recognition": os.getenv("RECOGNITION_VERSION") or recognition_version(),
+    "entities": os.getenv("ENTITIES_VERSION", "yandexgpt-1"),
+}
+
+_SHA256 = re.compile(r"^[0-9a-f]{64}$")
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def is_content_hash(value) -> bool:
+    """documents.hash до первой сегментации содержит id документа, а не хеш содержимого."""
+    return isinstance(value, str) and bool(_SHA256.match(value))
+
+
+def stage_chain(stage):
+    return {name: STAGE_VERSIONS[name] for name in STAGES[:STAGES.index(stage) + 1]}
+
+
+def stage_fingerprint(stage) -> str:
+    chain = "|".join(f"{name}={version}" for name, version in stage_chain(stage).items())
+    return hashlib.sha1(chain.encode()).hexdigest()[:12]
+
+
+class ArtifactStore:
+    """Хранилище сжатых JSON-артефактов; наследники реализуют _get/_put/_exists по ключу."""
+
+    def key(self, digest, stage):
+        return f"{ARTIFACTS_PREFIX}/{digest}/{stage}-{stage_fingerprint(stage)}.json.gz"
+
+    def load(self, digest, stage):
+        """Данные стадии или None, если артефакта текущей версии нет (или он не читается)."""
+        try:
+            data = self._get(self.key(digest, stage))
+            if data is None:
+                return None
+            return json.loads(gzip.decompress(data))["data"]
+        except Exception as e:
+            logger.warning("Failed to load %s artifact for %s: %s", stage, digest, e)
+            return None
+
+    def save(self, digest, stage, data):
+        """Ошибки записи не роняют распознавание: артефакт лишь экономит будущие перезапуски."""
+        payload = {"stage": stage, "versions": stage_chain(stage), "data": data}
+        try:
+            self._put(self.key(digest, stage),
+                      gzip.compress(json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode(), 6))
+        except Exception as e:
+            logger.warning("Failed to save %s artifact for %s: %s", stage, digest, e)
+
+    def exists(self, digest, stage):
+        return self._exists(self.key(digest, stage))
+
+    def _get(self, key):
+        raise NotImplementedError
+
+    def _put(self, key, data):
+        raise NotImplementedError
+
+    def _exists(self, key):
+        raise NotImplementedError
+
+
+class S3ArtifactStore(ArtifactStore):
+    def __init__(self, s3_client, bucket=S3_BUCKET_NAME):
+        self.s3_client = s3_client
+        self.bucket = bucket
+
+    def _get(self, key):
+        try:
+            return self.s3_client.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                return None
+            raise
+
+    def _put(self, key, data):
+        self.s3_client.put_object(Bucket=self.bucket, Key=key, Body=data, ContentType="application/json",
+                                  ContentEncoding="gzip")
+
+    def _exists(self, key):
+        try:
+            self.s3_client.head_object(Bucket=self.bucket, Key=key)
+            return True
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404", "NotFound"):
+                return False
+            raise
+
+
+class LocalArtifactStore(ArtifactStore):
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split("/"))
+
+    def _get(self, key):
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _put(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _exists(self, key):
+        return os.path.exists(self._path(key))
+
+
+def get_artifact_store(s3_client=None, location=ARTIFACT_STORE):
+    if not location or location == "off":
+        return None
+    if location == "s3":
+        return S3ArtifactStore(s3_client) if s3_client is not None else None
+    return LocalArtifactStore(location)
+
+
+def cached_stage(store, digest, stage, compute):
+    """Выход стадии из хранилища, а если его нет — compute() с сохранением результата."""
+    if store is not None and digest is not None:
+        data = store.load(digest, stage)
+        if data is not None:
+            logger.debug("Reusing %s artifact for %s", stage, digest)
+            return data
+    data = compute()
+    if store is not None and digest is not None:
+        store.save(digest, stage, data)
+    return data
+
+
+def load_texts(store, layout):
+    """Тексты кропов страницы из артефакта recognition, если он есть и совпадает с разметкой."""
+    if store is None or layout.digest is None:
+        return None
+    data = store.load(layout.digest, "recognition")
+    if data is None or len(data["texts"]) != len(layout.bboxes):
+        return None
+    return data["texts"]
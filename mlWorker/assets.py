@@ -0,0 +1,174 @@
+"""
+Производные изображения страницы для просмотрщика: WebP-миниатюра, превью среднего разрешения
+и пирамида тайлов в формате Deep Zoom (tiles.dzi + tiles_files/<уровень>/<столбец>_<строка>.webp).
+
+Строятся один раз из уже декодированной при сегментации картинки и кладутся в MinIO рядом
+с оригиналом под assets/<doc_id>/; ключи записываются в documents.assets. Воркер строит их в фоне
+(AssetPublisher), параллельно с распознаванием страницы, и дожидается их (wait_published) до того,
+как перевести документ в 'done': клиент, получивший финальный статус, уже видит ассеты.
+"""
+import io
+import json
+import logging
+import math
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+from PIL import Image
+
+from infra import S3_BUCKET_NAME, WORKER_ID, connect_to_postgres, run_in_transaction
+from metrics import span
+
+logger = logging.getLogger(__name__)
+
+ASSETS_ENABLED = os.getenv("ASSETS_ENABLED", "1") == "1"
+ASSETS_PREFIX = "assets"
+THUMBNAIL_SIZE = 256
+PREVIEW_SIZE = int(os.getenv("PREVIEW_SIZE", "1600"))
+TILE_SIZE = 254
+TILE_OVERLAP = 1
+TILE_FORMAT = "webp"
+WEBP_QUALITY = 80
+UPLOAD_THREADS = 16
+# сколько страниц может ждать фоновой сборки ассетов; дальше submit ждёт, чтобы не копить картинки в памяти
+ASSETS_MAX_PENDING = int(os.getenv("ASSETS_MAX_PENDING", "2"))
+# сколько 'done' ждёт недостроенных ассетов страницы; дальше результат пишется без них
+ASSETS_WAIT_SECONDS = float(os.getenv("ASSETS_WAIT_SECONDS", "60"))
+
+
+def _webp(img, quality=WEBP_QUALITY):
+    out = io.BytesIO()
+    img.save(out, format="WEBP", quality=quality, method=4)
+    return out.getvalue()
+
+
+def _fit(img, size):
+    copy = img.copy()
+    copy.thumbnail((size, size), Image.LANCZOS)
+    return copy
+
+
+def dzi_descriptor(width, height):
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        f'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" TileSize="{TILE_SIZE}" '
+        f'Overlap="{TILE_OVERLAP}" Format="{TILE_FORMAT}">'
+        f'<Size Width="{width}" Height="{height}"/></Image>\n'
+    )
+
+
+def iter_tiles(img):
+    """(уровень, столбец, строка, тайл); уровень max_level — исходный размер, каждый ниже вдвое меньше."""
+    width, height = img.size
+    max_level = math.ceil(math.log2(max(width, height, 1)))
+    level_img = img
+    for level in range(max_level, -1, -1):
+        scale = 2 ** (max_level - level)
+        size = (max(1, math.ceil(width / scale)), max(1, math.ceil(height / scale)))
+        if level_img.size != size:
+            # уменьшаем предыдущий уровень, а не оригинал: каждый шаг вдвое дешевле
+            level_img = level_img.resize(size, Image.BILINEAR)
+        columns = math.ceil(size[0] / TILE_SIZE)
+        rows = math.ceil(size[1] / TILE_SIZE)
+        for column in range(columns):
+            for row in range(rows):
+                x0 = max(0, column * TILE_SIZE - TILE_OVERLAP)
+                y0 = max(0, row * TILE_SIZE - TILE_OVERLAP)
+                x1 = min(size[0], (column + 1) * TILE_SIZE + TILE_OVERLAP)
+                y1 = min(size[1], (row + 1) * TILE_SIZE + TILE_OVERLAP)
+                yield level, column, row, level_img.crop((x0, y0, x1, y1))
+
+
+def build_assets(img, doc_id):
+    """Возвращает ({имя: ключ в S3}, [(ключ, байты, content-type)])."""
+    img = img.convert("RGB") if img.mode not in ("RGB", "L") else img
+    base = f"{ASSETS_PREFIX}/{doc_id}"
+    keys = {
+        "thumbnail": f"{base}/thumb.webp",
+        "preview": f"{base}/preview.webp",
+        "dzi": f"{base}/tiles.dzi",
+    }
+    objects = [
+        (keys["thumbnail"], _webp(_fit(img, THUMBNAIL_SIZE), quality=70), "image/webp"),
+        (keys["preview"], _webp(_fit(img, PREVIEW_SIZE)), "image/webp"),
+        (keys["dzi"], dzi_descriptor(*img.size).encode(), "application/xml"),
+    ]
+    for level, column, row, tile in iter_tiles(img):
+        objects.append((f"{base}/tiles_files/{level}/{column}_{row}.{TILE_FORMAT}", _webp(tile), "image/webp"))
+    return keys, objects
+
+
+def publish_assets(conn_ref, s3_client, doc_id, img, owners=(WORKER_ID,)):
+    """
+    Строит и загружает ассеты, сохраняет их ключи в documents.assets. Ошибки не роняют распознавание.
+    Ключи пишутся, только если документ свободен или захвачен одним из owners: документ, который
+    уже перехватил другой воркер, получит ассеты от него.
+    """
+    if not ASSETS_ENABLED or img is None:
+        return None
+    try:
+        with span("assets"):
+            keys, objects = build_assets(img, doc_id)
+            with ThreadPoolExecutor(UPLOAD_THREADS) as pool:
+                list(pool.map(lambda o: s3_client.put_object(Bucket=S3_BUCKET_NAME, Key=o[0], Body=o[1],
+                                                             ContentType=o[2]), objects))
+            assets = dict(keys, width=img.size[0], height=img.size[1], tiles=len(objects) - 3)
+
+            def work(cur):
+                cur.execute(
+                    "UPDATE documents SET assets = %s WHERE id = %s AND (claimed_by IS NULL OR claimed_by = ANY(%s))",
+                    (json.dumps(assets), doc_id, list(owners)),
+                )
+                return cur.rowcount
+
+            if not run_in_transaction(conn_ref, work):
+                logger.info("Document %s is claimed by another worker, viewer assets not recorded", doc_id)
+                return None
+        logger.info("Published %d viewer assets for document %s", len(objects), doc_id)
+        return assets
+    except Exception as e:
+        logger.warning("Failed to build viewer assets for %s: %s", doc_id, e)
+        return None
+
+
+class AssetPublisher:
+    """
+    Публикует ассеты в фоновом потоке, пока страница распознаётся. Поток один и держит своё
+    соединение с Postgres; ожидающих страниц не больше max_pending.
+    """
+
+    def __init__(self, s3_client, owners=(WORKER_ID,), max_pending=ASSETS_MAX_PENDING):
+        self.s3_client = s3_client
+        self.owners = tuple(owners)
+        self.pool = ThreadPoolExecutor(1, thread_name_prefix="assets")
+        self.slots = threading.BoundedSemaphore(max(1, max_pending))
+        self.conn_ref = None
+
+    def submit(self, doc_id, img):
+        if not ASSETS_ENABLED or img is None:
+            return None
+        self.slots.acquire()
+        future = self.pool.submit(self._publish, doc_id, img)
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def _publish(self, doc_id, img):
+        if self.conn_ref is None:
+            self.conn_ref = {"conn": connect_to_postgres()}
+        return publish_assets(self.conn_ref, self.s3_client, doc_id, img, self.owners)
+
+
+def wait_published(future, doc_id, timeout=ASSETS_WAIT_SECONDS):
+    """
+    Ждёт фоновую сборку ассетов документа (future из AssetPublisher.submit, может быть None).
+    Вызывается перед записью 'done': после финального статуса stream событий закрывается,
+    и ассеты, записанные позже, клиент увидел бы только при следующем запросе.
+    """
+    if future is None:
+        return None
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeoutError:
+        logger.warning("Viewer assets for %s are not ready after %.0fs, finishing without them", doc_id, timeout)
+        return None
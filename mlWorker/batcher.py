@@ -0,0 +1,53 @@
+import os
+from typing import Callable, Dict, List, Optional
+
+from config import DEFAULT_INSTRUCTION
+
+# начальный размер батча генерации; дальше его подстраивает GenerationScheduler
+VLM_BATCH_SIZE = int(os.getenv("VLM_BATCH_SIZE", "8"))
+
+
+class CropBatcher:
+    """
+    Собирает кропы абзацев с нескольких страниц и прогоняет их через VLM общими батчами,
+    чтобы устройство было загружено, даже если на отдельной странице мало абзацев.
+    Размер батчей и восстановление после нехватки памяти — на GenerationScheduler.
+    """
+
+    def __init__(self, model, processor, batch_size: int = VLM_BATCH_SIZE, instruction: str = DEFAULT_INSTRUCTION):
+        self.model = model
+        self.processor = processor
+        self.batch_size = batch_size
+        self.instruction = instruction
+        self._items = []
+        self._callbacks: Dict[object, Optional[Callable[[int, str], None]]] = {}
+        self._counts: Dict[object, int] = {}
+
+    def add(self, key, crops, on_result: Optional[Callable[[int, str], None]] = None):
+        """on_result(index, text) вызывается по мере готовности каждого кропа страницы key."""
+        self._callbacks[key] = on_result
+        self._counts[key] = len(crops)
+        self._items.extend((key, index, crop) for index, crop in enumerate(crops))
+
+    def run(self) -> Dict[object, List[str]]:
+        texts = {key: [""] * count for key, count in self._counts.items()}
+        items = self._items
+
+        def on_result(position, text):
+            key, index, _ = items[position]
+            texts[key][index] = text
+            callback = self._callbacks.get(key)
+            if callback is not None:
+                callback(index, text)
+
+        if items:
+            # модели может не быть вовсе, если все страницы взяты из артефактов (reprocess.py);
+            # vlm (и torch) импортируется только там, где кропы действительно распознаются
+            from vlm import GenerationScheduler
+
+            scheduler = GenerationScheduler(self.model, self.processor, self.instruction, batch_size=self.batch_size)
+            scheduler.run([crop for _, _, crop in items], on_result)
+        self._items = []
+        self._callbacks = {}
+        self._counts = {}
+        return texts
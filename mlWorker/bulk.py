@@ -0,0 +1,312 @@
+"""
+Офлайн-ретроконверсия архива без веб-стека: каталог или манифест -> шардированный JSONL/Parquet.
+
+    python bulk.py --input /data/fond-12 --output /data/out
+    python bulk.py --manifest pages.jsonl --output /data/out --workers 8 --format compact
+
+Сегментация (kraken) идёт в пуле процессов, распознавание — в основном процессе общими
+VLM-батчами по --batch-docs страниц, как в воркере. Шард записывается целиком (через
+временный файл), и только потом его страницы попадают в checkpoint.tsv. Если процесс упал между
+этими шагами, повторный запуск с тем же --output сначала дописывает в checkpoint.tsv страницы
+последнего шарда (recover_checkpoint), поэтому он продолжает с места остановки, не дублируя
+и не теряя страницы.
+
+Ошибки пишутся в отдельные шарды failed-NNNNN.jsonl, так что каждая страница попадает в results-*
+не больше одного раза. После --retry-failed страница может остаться в старом failed-* и появиться
+в results-*; её итоговый статус — последняя строка с её id в checkpoint.tsv.
+
+С --artifacts промежуточные результаты стадий (artifacts.py) складываются в локальный каталог,
+и повторный прогон с другой LoRA или разметкой абзацев пересчитывает только изменившиеся стадии.
+
+Манифест — текстовый файл с путём на строку или JSONL с полями "path" и необязательным "id".
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+from multiprocessing import Pool
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from artifacts import STAGE_VERSIONS, get_artifact_store, recognition_version  # noqa: E402
+from config import BATCH_DOCS, SUPPORTED_FORMATS, MODEL_PATH, LORA_PATH  # noqa: E402
+from pipeline import segment_page, recognize_layouts, attach_entities  # noqa: E402
+from result_format import to_compact  # noqa: E402
+from vlm import load_model_and_processor  # noqa: E402
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+logger = logging.getLogger("mlworker.bulk")
+
+CHECKPOINT_FILE = "checkpoint.tsv"
+# статус в checkpoint.tsv для страниц из шардов с этим префиксом
+SHARD_STATUSES = {"results": "ok", "failed": "fail"}
+
+# хранилище артефактов процесса пула, см. init_segmenter
+_store = None
+
+
+def iter_inputs(input_dir=None, manifest=None):
+    """(id, path); id по умолчанию — путь относительно каталога или как записан в манифесте."""
+    if input_dir:
+        for root, _, files in os.walk(input_dir):
+            for name in sorted(files):
+                if os.path.splitext(name)[1].lower() in SUPPORTED_FORMATS:
+                    path = os.path.join(root, name)
+                    yield os.path.relpath(path, input_dir), path
+    if manifest:
+        base = os.path.dirname(os.path.abspath(manifest))
+        with open(manifest, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                if line.startswith("{"):
+                    entry = json.loads(line)
+                    path = entry["path"]
+                    page_id = entry.get("id", path)
+                else:
+                    path = page_id = line
+                yield page_id, path if os.path.isabs(path) else os.path.join(base, path)
+
+
+def read_checkpoint(output_dir):
+    """Последний статус каждой страницы; строка, оборванная падением посреди записи, пропускается."""
+    statuses = {}
+    path = os.path.join(output_dir, CHECKPOINT_FILE)
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                page_id, _, status = line.rstrip("\n").rpartition("\t")
+                if line.endswith("\n") and status in ("ok", "fail"):
+                    statuses[page_id] = status
+    return statuses
+
+
+def load_checkpoint(output_dir, retry_failed):
+    return {page_id for page_id, status in read_checkpoint(output_dir).items() if status == "ok" or not retry_failed}
+
+
+def append_checkpoint(output_dir, entries):
+    with open(os.path.join(output_dir, CHECKPOINT_FILE), "a+b") as f:
+        f.seek(0, os.SEEK_END)
+        lines = "".join(f"{page_id}\t{status}\n" for page_id, status in entries).encode("utf-8")
+        if f.tell():
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                # хвост прошлой записи оборван — новая строка не должна к нему приклеиться
+                lines = b"\n" + lines
+        f.write(lines)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def shard_names(output_dir, prefix):
+    names = [n for n in os.listdir(output_dir) if n.startswith(f"{prefix}-") and not n.endswith(".tmp")]
+    return sorted(names, key=lambda n: int(n[len(prefix) + 1:].split(".", 1)[0]))
+
+
+def read_shard_ids(path):
+    if path.endswith(".parquet"):
+        return pyarrow.parquet.read_table(path, columns=["id"]).column("id").to_pylist()
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line)["id"] for line in f if line.strip()]
+
+
+def recover_checkpoint(output_dir):
+    """
+    Дописывает в checkpoint.tsv страницы шарда, записанного перед падением процесса, но не попавшего
+    в чекпоинт. Так может остаться только последний шард каждого вида: следующий шард пишется
+    после чекпоинта предыдущего. Возвращает число дописанных страниц.
+    """
+    statuses = read_checkpoint(output_dir)
+    entries = []
+    for prefix, status in SHARD_STATUSES.items():
+        shards = shard_names(output_dir, prefix)
+        if not shards:
+            continue
+        for page_id in read_shard_ids(os.path.join(output_dir, shards[-1])):
+            # готовую страницу повтор не трогает, а упавшую могла уже пересчитать --retry-failed
+            if (statuses.get(page_id) != "ok") if status == "ok" else (page_id not in statuses):
+                entries.append((page_id, status))
+                statuses[page_id] = status
+    if entries:
+        append_checkpoint(output_dir, entries)
+        logger.warning("Recovered %d pages of the last shards missing from %s", len(entries), CHECKPOINT_FILE)
+    return len(entries)
+
+
+def init_segmenter(artifacts_dir):
+    global _store
+    _store = get_artifact_store(location=artifacts_dir)
+
+
+def segment_file(item):
+    """Выполняется в пуле: чтение и сегментация одной страницы."""
+    page_id, path = item
+    try:
+        with open(path, "rb") as f:
+            layout = segment_page(f.read(), _store)
+        # страница целиком не нужна основному процессу, не гоняем её через pickle
+        layout.image = None
+        return page_id, path, layout, None
+    except Exception as e:
+        return page_id, path, None, f"{type(e).__name__}: {e}"
+
+
+class ShardWriter:
+    def __init__(self, output_dir, shard_size, file_format, prefix="results"):
+        self.output_dir = output_dir
+        self.shard_size = shard_size
+        self.file_format = file_format
+        self.prefix = prefix
+        self.records = []
+        self.extension = "parquet" if file_format == "parquet" else "jsonl"
+        # номера шардов продолжаются после прошлых запусков
+        self.next_shard = len(shard_names(output_dir, prefix))
+
+    def add(self, record):
+        self.records.append(record)
+        if len(self.records) >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        if not self.records:
+            return
+        path = os.path.join(self.output_dir, f"{self.prefix}-{self.next_shard:05d}.{self.extension}")
+        tmp_path = path + ".tmp"
+        if self.file_format == "parquet":
+            table = pyarrow.table({
+                "id": [r["id"] for r in self.records],
+                "path": [r["path"] for r in self.records],
+                "result": [json.dumps(r["result"], ensure_ascii=False) for r in self.records],
+            })
+            pyarrow.parquet.write_table(table, tmp_path, compression="zstd")
+        else:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for record in self.records:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        # падение здесь, до чекпоинта, чинит recover_checkpoint при следующем запуске
+        append_checkpoint(self.output_dir, [(record["id"], SHARD_STATUSES[self.prefix]) for record in self.records])
+
+        logger.info("Wrote %s (%d pages)", path, len(self.records))
+        self.next_shard += 1
+        self.records = []
+
+
+def batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def recognize_batch(segmented, model, processor, with_entities, result_format, store=None):
+    records = []
+    ready = []
+    for page_id, path, layout, error in segmented:
+        if error is not None:
+            records.append({"id": page_id, "path": path, "error": error})
+        else:
+            ready.append((page_id, path, layout))
+    if not ready:
+        return records
+
+    try:
+        outputs = recognize_layouts([layout for *_, layout in ready], model, processor, store=store)
+    except Exception as e:
+        return records + [{"id": page_id, "path": path, "error": f"{type(e).__name__}: {e}"}
+                          for page_id, path, _ in ready]
+
+    for (page_id, path, layout), output in zip(ready, outputs):
+        try:
+            if with_entities:
+                attach_entities(output, store, layout.digest)
+            result = to_compact(output) if result_format == "compact" else output
+            records.append({"id": page_id, "path": path, "result": result})
+        except Exception as e:
+            records.append({"id": page_id, "path": path, "error": f"{type(e).__name__}: {e}"})
+    return records
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline bulk recognition of scanned pages")
+    parser.add_argument("--input", help="Directory with page images (walked recursively)")
+    parser.add_argument("--manifest", help="Text file with one path per line, or JSONL with path/id")
+    parser.add_argument("--output", required=True, help="Directory for shards and the checkpoint")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) - 1),
+                        help="Segmentation processes")
+    parser.add_argument("--batch-docs", type=int, default=BATCH_DOCS,
+                        help="Pages whose crops share VLM batches")
+    parser.add_argument("--shard-size", type=int, default=200, help="Pages per output shard")
+    parser.add_argument("--file-format", choices=("jsonl", "parquet"), default="jsonl")
+    parser.add_argument("--format", choices=("full", "compact"), default="full",
+                        help="Result shape: textAnnotation as in the API, or result_format.to_compact")
+    parser.add_argument("--no-entities", action="store_true", help="Skip entity extraction (Yandex GPT)")
+    parser.add_argument("--artifacts", help="Directory for per-stage artifacts reused by later runs")
+    parser.add_argument("--retry-failed", action="store_true", help="Process pages that failed last time again")
+    parser.add_argument("--model_path", default=MODEL_PATH)
+    parser.add_argument("--lora_path", default=LORA_PATH)
+    parser.add_argument("--device", default=os.getenv("WORKER_DEVICE") or None)
+    args = parser.parse_args(argv)
+    if not args.input and not args.manifest:
+        parser.error("one of --input or --manifest is required")
+    if args.file_format == "parquet" and pyarrow is None:
+        parser.error("--file-format parquet needs pyarrow")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(),
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    os.makedirs(args.output, exist_ok=True)
+
+    recover_checkpoint(args.output)
+    done = load_checkpoint(args.output, args.retry_failed)
+    pending = [(page_id, path) for page_id, path in iter_inputs(args.input, args.manifest) if page_id not in done]
+    logger.info("%d pages to process, %d already done", len(pending), len(done))
+    if not pending:
+        return
+
+    writer = ShardWriter(args.output, args.shard_size, args.file_format)
+    failures = ShardWriter(args.output, args.shard_size, "jsonl", prefix="failed")
+    # версия recognition должна соответствовать модели, которую грузит именно этот запуск
+    STAGE_VERSIONS["recognition"] = os.getenv("RECOGNITION_VERSION") or recognition_version(args.model_path,
+                                                                                           args.lora_path)
+    store = get_artifact_store(location=args.artifacts)
+    # пул создаётся до загрузки модели, чтобы дочерние процессы не наследовали CUDA-контекст
+    with Pool(args.workers, initializer=init_segmenter, initargs=(args.artifacts,)) as pool:
+        model, processor = load_model_and_processor(args.model_path, lora_path=args.lora_path or None,
+                                                    merge_lora=True, device=args.device)
+        processed = 0
+        segmented = pool.imap(segment_file, pending, chunksize=1)
+        for batch in batched(segmented, args.batch_docs):
+            for record in recognize_batch(batch, model, processor, not args.no_entities, args.format, store):
+                if "error" in record:
+                    logger.warning("Failed %s: %s", record["id"], record["error"])
+                    failures.add(record)
+                else:
+                    writer.add(record)
+            processed += len(batch)
+            logger.info("%d/%d pages", processed, len(pending))
+    writer.flush()
+    failures.flush()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,52 @@
+"""
+Настройки воркера без внешних зависимостей: их используют и воркер, и офлайн-утилиты (bulk.py),
+которым не нужны RabbitMQ, S3 и Postgres, и роли без модели (segmenter, aggregator), которым не нужен torch.
+"""
+import hashlib
+import os
+
+S3_BUCKET_NAME = "documents"
+
+# Сколько документов обрабатывать вместе, объединяя их кропы в общие VLM-батчи
+BATCH_DOCS = int(os.getenv("BATCH_DOCS", "4"))
+
+# Должны совпадать с UPLOAD_SIGNATURES в server/main.py
+SUPPORTED_FORMATS = {
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.png': 'image/png',
+}
+
+DEFAULT_INSTRUCTION = "Расшифруй текст на изображении."
+# базовая модель и LoRA-чекпоинт воркера; входят в версию стадии recognition (artifacts.py)
+MODEL_PATH = os.getenv("VLM_MODEL_PATH", "./models/gemma-3-4b-it")
+LORA_PATH = os.getenv("VLM_LORA_PATH", "../../ml_worker/checkpoint-200/")
+
+
+def weights_fingerprint(*paths, content=False):
+    """
+    Отпечаток весов. Меняется, если адаптер переобучили и положили в ту же папку, — по одному имени
+    папки это не видно. По умолчанию — абсолютные пути и размер/mtime файлов: дёшево, но годится
+    только для локального кеша (экспорт OpenVINO). content=True — относительные пути и содержимое
+    файлов: одинаков на всех узлах с одними весами, для версий в общем хранилище артефактов.
+    """
+    digest = hashlib.sha1()
+    for path in paths:
+        if not path:
+            continue
+        path = os.path.abspath(path)
+        if not content:
+            digest.update(path.encode())
+        files = [path] if os.path.isfile(path) else sorted(
+            os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+        for file in files:
+            name = os.path.relpath(file, path)
+            if content:
+                digest.update(f"{name}:".encode())
+                with open(file, "rb") as f:
+                    for chunk in iter(lambda: f.read(1 << 20), b""):
+                        digest.update(chunk)
+            else:
+                stat = os.stat(file)
+                digest.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return digest.hexdigest()[:12]
@@ -0,0 +1,126 @@
+"""
+Дешёвый фильтр кропов абзацев перед VLM.
+
+kraken иногда принимает за строки пятна, поля страницы и линейки бланка; каждый такой кроп стоит
+полной генерации до max_new_tokens и ничего полезного не даёт. Фильтр считает по кропу
+полутоновой страницы несколько векторизованных признаков — контраст, долю чернил и связные
+компоненты (scipy.ndimage, если установлен) — и отбрасывает кропы без текста:
+
+blank — нет чернил или контраста;
+stain — почти все чернила в одной сплошной компоненте (пятно, залитый участок);
+line  — почти все чернила в одной длинной тонкой компоненте (линейка бланка, подчёркивание);
+noise — только пыль: значимых компонент нет, все мельче буквы.
+Абзац текста — это много компонент (буквы, слова), поэтому он под stain и line не попадает,
+даже если одно слово рукописное и слитное.
+
+CROP_FILTER: skip — отбрасывать (по умолчанию); report — только считать, кропы распознаются
+(для подбора порогов); off — не считать. Пороги задаются переменными окружения CROP_*,
+пропущенные кропы считаются в метрике mlworker_crops_filtered_total{reason}.
+"""
+import hashlib
+import logging
+import os
+from collections import Counter
+from dataclasses import dataclass, astuple
+
+import numpy as np
+
+from make_paragraph import otsu_threshold
+from metrics import record_filtered_crops
+from utils import bbox_corners
+
+try:
+    from scipy import ndimage
+except ImportError:  # без scipy остаются только проверки контраста и плотности
+    ndimage = None
+
+logger = logging.getLogger(__name__)
+
+CROP_FILTER = os.getenv("CROP_FILTER", "skip")
+
+
+@dataclass(frozen=True)
+class Thresholds:
+    # стандартное отклонение яркости кропа, ниже — пустое поле
+    min_contrast: float = float(os.getenv("CROP_MIN_CONTRAST", "6"))
+    # доля пикселей-чернил: ниже — пусто; выше max_ink без scipy — пятно
+    min_ink: float = float(os.getenv("CROP_MIN_INK", "0.003"))
+    max_ink: float = float(os.getenv("CROP_MAX_INK", "0.6"))
+    # компоненты меньше этой площади — пыль скана, в подсчёте не участвуют
+    min_component: int = int(os.getenv("CROP_MIN_COMPONENT", "12"))
+    # доля чернил в крупнейшей компоненте, с которой кроп считается одним объектом, а не текстом
+    dominant_share: float = float(os.getenv("CROP_DOMINANT_SHARE", "0.9"))
+    # заполненность рамки такой компоненты, с которой она — сплошное пятно
+    stain_fill: float = float(os.getenv("CROP_STAIN_FILL", "0.5"))
+    # линия: ширина не меньше этой доли кропа при высоте не больше line_height_share
+    line_width_share: float = float(os.getenv("CROP_LINE_WIDTH_SHARE", "0.6"))
+    line_height_share: float = float(os.getenv("CROP_LINE_HEIGHT_SHARE", "0.25"))
+
+
+THRESHOLDS = Thresholds()
+
+
+def filter_version(mode=CROP_FILTER, thresholds=THRESHOLDS):
+    """Часть версии стадии layout (artifacts.py): от режима и порогов зависит набор кропов."""
+    if mode != "skip":
+        return "nofilter"
+    digest = hashlib.sha1(repr(astuple(thresholds)).encode()).hexdigest()[:8]
+    return f"filter-{digest}"
+
+
+def classify_crop(gray, threshold, thresholds=THRESHOLDS):
+    """Причина отбросить кроп ('blank', 'stain', 'line', 'noise') или None, если похоже на текст."""
+    if gray.size == 0 or float(gray.std()) < thresholds.min_contrast:
+        return "blank"
+    ink = gray <= threshold
+    density = float(ink.mean())
+    if density < thresholds.min_ink:
+        return "blank"
+    if ndimage is None:
+        return "stain" if density > thresholds.max_ink else None
+
+    labels, count = ndimage.label(ink)
+    if count == 0:
+        return "blank"
+    sizes = np.bincount(labels.ravel(), minlength=count + 1)[1:]
+    significant = sizes[sizes >= thresholds.min_component]
+    if significant.size == 0:
+        return "noise"
+    largest = int(np.argmax(sizes))
+    if sizes[largest] < thresholds.dominant_share * significant.sum():
+        return None
+
+    rows, cols = ndimage.find_objects(labels)[largest]
+    height, width = rows.stop - rows.start, cols.stop - cols.start
+    if width >= thresholds.line_width_share * gray.shape[1] and height <= thresholds.line_height_share * gray.shape[0]:
+        return "line"
+    if sizes[largest] >= thresholds.stain_fill * height * width:
+        return "stain"
+    return None
+
+
+def filter_polygons(polygons, gray, mode=CROP_FILTER, thresholds=THRESHOLDS):
+    """
+    Полигоны абзацев, которые стоит распознавать, и {причина: число отброшенных}.
+    Порог чернил общий для страницы — по Оцу всей страницы, а не каждого кропа: у пустого кропа
+    свой порог нашёл бы «чернила» в зерне бумаги.
+    """
+    if mode == "off" or not polygons:
+        return polygons, {}
+    threshold = otsu_threshold(gray)
+    kept = []
+    skipped = Counter()
+    for polygon in polygons:
+        (x0, y0), _, (x1, y1), _ = bbox_corners(polygon)
+        reason = classify_crop(gray[max(0, int(y0)):int(y1), max(0, int(x0)):int(x1)], threshold, thresholds)
+        if reason is None:
+            kept.append(polygon)
+        else:
+            skipped[reason] += 1
+            if mode != "skip":
+                kept.append(polygon)
+    if skipped:
+        record_filtered_crops(skipped, dropped=mode == "skip")
+        logger.info("Crop filter (%s): %d of %d crops look like non-text: %s",
+                    mode, sum(skipped.values()), len(polygons), dict(skipped))
+    return kept, dict(skipped)
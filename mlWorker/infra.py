@@ -0,0 +1,391 @@
+import json
+import logging
+import os
+import random
+import socket
+import threading
+import time
+
+import boto3
+import pika
+import psycopg2
+from botocore.client import Config
+from psycopg2 import OperationalError, InterfaceError, errors
+
+from config import S3_BUCKET_NAME
+from result_format import RESULT_PREFIX, store_result
+from result_index import index_document
+from metrics import span
+from progress import STATUS_CHANNEL
+from queues import is_permanent, schedule_retry
+
+logger = logging.getLogger(__name__)
+
+
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}:{os.getpid()}"
+# Сколько документ принадлежит воркеру без продления аренды
+LEASE_SECONDS = int(os.getenv("LEASE_SECONDS", "300"))
+# Владелец документа между сегментатором и сборщиком в раздельном режиме
+SPLIT_PIPELINE_OWNER = "split-pipeline"
+SPLIT_PIPELINE_LEASE_SECONDS = int(os.getenv("SPLIT_PIPELINE_LEASE_SECONDS", "3600"))
+
+
+class LeaseLost(Exception):
+    """Документ больше не принадлежит этому воркеру: аренду перехватили или он уже обработан."""
+
+
+def log_pg_env():
+    logger.info("PG env: %s",
+                {"host": os.getenv("POSTGRES_HOST"),
+                 "port": os.getenv("POSTGRES_PORT", "5432"),
+                 "db": os.getenv("POSTGRES_DB"),
+                 "user": os.getenv("POSTGRES_USER")})
+
+
+def log_pg_identity(conn):
+    with conn.cursor() as c:
+        c.execute("select current_user, current_database(), inet_server_addr(), inet_server_port();")
+        logger.info("PG identity: %s", c.fetchone())
+
+
+def get_s3_client():
+    return boto3.client(
+        's3',
+        endpoint_url=f"{os.getenv('MINIO_ROOT_HOST')}:9000",
+        aws_access_key_id=os.getenv('MINIO_ROOT_USER'),
+        aws_secret_access_key=os.getenv('MINIO_ROOT_PASSWORD'),
+        config=Config(signature_version='s3v4')
+    )
+
+
+def connect_to_rabbitmq():
+    while True:
+        try:
+            host = os.getenv("RABBITMQ_HOST", "localhost")
+            port = int(os.getenv("RABBITMQ_PORT", 5672))
+            user = os.getenv("RABBITMQ_USER", "guest")
+            password = os.getenv("RABBITMQ_PASS", "guest")
+
+            credentials = pika.PlainCredentials(user, password)
+            params = pika.ConnectionParameters(host=host, port=port, credentials=credentials)
+
+            connection = pika.BlockingConnection(params)
+            logger.info("Successfully connected to RabbitMQ")
+            return connection
+        except pika.exceptions.AMQPConnectionError:
+            logger.warning("RabbitMQ not ready yet, waiting...")
+            time.sleep(5)
+
+
+def connect_to_postgres():
+    while True:
+        try:
+            log_pg_env()
+            conn = psycopg2.connect(
+                dbname=os.getenv('POSTGRES_DB', 'db'),
+                user=os.getenv('POSTGRES_USER', 'user'),
+                password=os.getenv('POSTGRES_PASSWORD', 'password'),
+                host=os.getenv('POSTGRES_HOST', 'postgres'),
+                port=int(os.getenv('POSTGRES_PORT', '5432')),
+                connect_timeout=10,
+                keepalives=1,
+                keepalives_idle=30,
+                keepalives_interval=10,
+                keepalives_count=3
+            )
+            conn.autocommit = True
+            logger.info("Successfully connected to PostgreSQL")
+            log_pg_identity(conn)
+            return conn
+        except psycopg2.OperationalError:
+            logger.warning("PostgreSQL not ready yet, waiting...")
+            time.sleep(5)
+
+
+RETRIABLE_PG_ERRORS = (
+    OperationalError,
+    InterfaceError,
+    errors.DeadlockDetected,
+    errors.SerializationFailure,
+    errors.TransactionRollbackError,
+    errors.InFailedSqlTransaction,
+)
+
+
+def run_in_transaction(conn_ref, work, retries=5, base_delay=0.2):
+    """
+    Выполняет work(cur) в одной транзакции; при обрыве соединения переподключается
+    и повторяет с экспоненциальной задержкой. Возвращает результат work.
+    """
+    for attempt in range(retries + 1):
+        try:
+            with span("db_transaction"), conn_ref["conn"]:
+                with conn_ref["conn"].cursor() as cur:
+                    return work(cur)
+        except RETRIABLE_PG_ERRORS as e:
+            logger.warning("PG write failed (%s: %s). Reconnecting... [%d/%d]", type(e).__name__, e, attempt + 1, retries)
+
+            try:
+                conn_ref["conn"].close()
+            except Exception:
+                pass
+            conn_ref["conn"] = connect_to_postgres()
+
+            if attempt < retries:
+                delay = base_delay * (2 ** attempt) + random.uniform(0, base_delay)
+                time.sleep(delay)
+                continue
+            else:
+                break
+    raise RuntimeError("Failed to write to PostgreSQL after retries")
+
+
+def notify_status(cur, doc_id, status):
+    # доставляется подписчикам сервера только после коммита
+    cur.execute("SELECT pg_notify(%s, %s)",
+                (STATUS_CHANNEL, json.dumps({"id": doc_id, "status": status})))
+
+
+def claim_document(conn_ref, doc_id, lease_seconds=LEASE_SECONDS):
+    """
+    Захватывает документ под этот воркер перед любой дорогой работой.
+    Возвращает версию строки или None, если документ уже готов или его держит другой воркер
+    с непросроченной арендой — такую повторную доставку можно сразу подтвердить.
+    """
+    def work(cur):
+        cur.execute(
+            """
+            UPDATE documents
+            SET status = 'processing', claimed_by = %s, lease_until = now() + %s * interval '1 second'
+            WHERE id = %s
+              AND status <> 'done'
+              AND (claimed_by IS NULL OR claimed_by = %s OR lease_until IS NULL OR lease_until < now())
+            RETURNING version
+            """,
+            (WORKER_ID, lease_seconds, doc_id, WORKER_ID),
+        )
+        row = cur.fetchone()
+        if row is not None:
+            notify_status(cur, doc_id, 'processing')
+        return row[0] if row else None
+
+    version = run_in_transaction(conn_ref, work)
+    if version is not None:
+        lease_keeper.track(doc_id)
+    return version
+
+
+def hand_over_claim(conn_ref, doc_id, new_owner, lease_seconds):
+    """Передаёт захваченный документ другому владельцу (например, раздельному конвейеру)."""
+    def work(cur):
+        cur.execute(
+            """
+            UPDATE documents SET claimed_by = %s, lease_until = now() + %s * interval '1 second'
+            WHERE id = %s AND claimed_by = %s
+            """,
+            (new_owner, lease_seconds, doc_id, WORKER_ID),
+        )
+        if cur.rowcount == 0:
+            raise LeaseLost(f"Document {doc_id} is no longer claimed by {WORKER_ID}")
+
+    run_in_transaction(conn_ref, work)
+
+
+def update_doc_status(conn_ref, doc_id, status, result=None, search_index=None, owner=None,
+                      retries=5, base_delay=0.2):
+    """
+    search_index — распарсенный результат OCR; если передан, он раскладывается
+    по поисковым таблицам в той же транзакции, что и смена статуса.
+    Запись проходит, только если документ никем не захвачен или захвачен owner (по умолчанию этим воркером),
+    и никогда не откатывает 'done' назад; иначе — LeaseLost. 'in-queue', 'done' и 'fail' освобождают документ,
+    'done' и 'fail' заодно удаляют его строку document_progress.
+    Возвращает новую версию строки.
+    """
+    assignments = ["status = %s"]
+    params = [status]
+    if result is not None:
+        assignments.append("result = %s")
+        params.append(result)
+    if status in ('in-queue', 'done', 'fail'):
+        assignments.append("claimed_by = NULL, lease_until = NULL")
+
+    conditions = "id = %s AND (claimed_by IS NULL OR claimed_by = %s)"
+    if status != 'done':
+        conditions += " AND status <> 'done'"
+    params.extend([doc_id, owner or WORKER_ID])
+
+    sql = f"UPDATE documents SET {', '.join(assignments)} WHERE {conditions} RETURNING version"
+
+    def work(cur):
+        cur.execute(sql, params)
+        row = cur.fetchone()
+        if row is None:
+            # исключение откатывает транзакцию, поисковые таблицы не трогаем
+            raise LeaseLost(f"Document {doc_id} is not owned by {owner or WORKER_ID}, '{status}' not written")
+        if search_index is not None:
+            index_document(cur, doc_id, search_index)
+        if status in ('done', 'fail'):
+            # частичные блоки нужны только до результата, иначе он хранился бы в базе дважды
+            cur.execute("DELETE FROM document_progress WHERE doc_id = %s", (doc_id,))
+        notify_status(cur, doc_id, status)
+        return row[0]
+
+    version = run_in_transaction(conn_ref, work, retries, base_delay)
+    logger.info("Updated document %s -> '%s' (version %s)", doc_id, status, version)
+    return version
+
+
+def save_result(conn_ref, s3_client, doc_id, ocr_result, owner=None):
+    """
+    Сохраняет результат и переводит документ в done (update_doc_status). Если статус не записан —
+    LeaseLost или ошибка базы, — объект этой попытки удаляется; после записи удаляются прежние
+    объекты документа, на которые строка больше не ссылается. Возвращает версию строки.
+    """
+    result, key = store_result(s3_client, doc_id, ocr_result)
+    try:
+        version = update_doc_status(conn_ref, doc_id, 'done', result=result, search_index=ocr_result, owner=owner)
+    except Exception:
+        if key is not None:
+            _delete_objects(s3_client, [key])
+        raise
+    if key is not None:
+        _prune_results(conn_ref, s3_client, doc_id, key)
+    return version
+
+
+def _delete_objects(s3_client, keys):
+    try:
+        for key in keys:
+            s3_client.delete_object(Bucket=S3_BUCKET_NAME, Key=key)
+    except Exception as e:
+        logger.warning("Failed to delete result objects %s: %s", keys, e)
+
+
+def _prune_results(conn_ref, s3_client, doc_id, key):
+    """Удаляет объекты документа старше key, кроме того, на который ссылается строка сейчас."""
+    def current_key(cur):
+        cur.execute("SELECT result -> 'storage' ->> 'key' FROM documents WHERE id = %s", (doc_id,))
+        row = cur.fetchone()
+        return row[0] if row else None
+
+    try:
+        referenced = run_in_transaction(conn_ref, current_key)
+        prefix = f"{RESULT_PREFIX}/{doc_id}"
+        stale = []
+        for page in s3_client.get_paginator("list_objects_v2").paginate(Bucket=S3_BUCKET_NAME, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                name = obj["Key"]
+                # results/<id>.<ext> — объекты до появления ключей попыток, они сортируются раньше
+                if name[len(prefix):len(prefix) + 1] in ("/", ".") and name < key and name != referenced:
+                    stale.append(name)
+    except Exception as e:
+        logger.warning("Failed to list old results of %s: %s", doc_id, e)
+        return
+    if stale:
+        _delete_objects(s3_client, stale)
+        logger.info("Deleted %d old result objects of %s", len(stale), doc_id)
+
+
+class LeaseKeeper:
+    """
+    Продлевает аренду захваченных документов из фонового потока со своим соединением,
+    пока основной поток занят сегментацией или генерацией. Документы, которые больше
+    не принадлежат owner (готовы, упали, перехвачены), выпадают из списка сами.
+    """
+
+    def __init__(self, lease_seconds=LEASE_SECONDS, owner=WORKER_ID):
+        self.lease_seconds = lease_seconds
+        self.owner = owner
+        self._doc_ids = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def track(self, doc_id):
+        with self._lock:
+            self._doc_ids.add(doc_id)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="lease-keeper", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        try:
+            self._heartbeat()
+        except Exception:
+            logger.exception("Lease keeper stopped")
+        finally:
+            # следующий track запустит поток заново
+            with self._lock:
+                self._thread = None
+
+    def _heartbeat(self):
+        # соединение открывается в цикле: ошибка подключения не должна останавливать продление
+        conn_ref = None
+        while True:
+            time.sleep(self.lease_seconds / 3)
+            with self._lock:
+                doc_ids = list(self._doc_ids)
+            if not doc_ids:
+                continue
+
+            def work(cur):
+                cur.execute(
+                    """
+                    UPDATE documents SET lease_until = now() + %s * interval '1 second'
+                    WHERE id = ANY(%s) AND claimed_by = %s
+                    RETURNING id
+                    """,
+                    (self.lease_seconds, doc_ids, self.owner),
+                )
+                return {row[0] for row in cur.fetchall()}
+
+            try:
+                if conn_ref is None:
+                    conn_ref = {"conn": connect_to_postgres()}
+                alive = run_in_transaction(conn_ref, work)
+            except Exception as e:
+                logger.warning("Lease heartbeat failed: %s", e)
+                continue
+            with self._lock:
+                self._doc_ids -= set(doc_ids) - alive
+
+
+lease_keeper = LeaseKeeper()
+# документы, переданные сегментатором раздельному конвейеру: их кропы могут долго ждать в очереди
+pipeline_lease_keeper = LeaseKeeper(SPLIT_PIPELINE_LEASE_SECONDS, owner=SPLIT_PIPELINE_OWNER)
+
+
+def handle_failure(delivery, conn_ref, doc_id, error, owner=None, requeue_document=True):
+    """
+    Постоянные ошибки (битый файл, неподдерживаемый формат) подтверждаются сразу,
+    временные уходят в очередь отложенного повтора, а после исчерпания попыток — в dead-letter.
+    requeue_document=False — сообщение только часть документа (кроп, сборка раздельного конвейера):
+    при повторе строка документа не трогается, остальные кропы страницы продолжают работу.
+    """
+    ch, method = delivery.channel, delivery.method
+    if isinstance(error, LeaseLost):
+        # документ обрабатывает кто-то другой — это сообщение больше не нужно
+        logger.info("Dropping message for document %s: %s", doc_id, error)
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+        return
+
+    permanent = is_permanent(error)
+    logger.error("Error processing document %s (%s): %s", doc_id, 'permanent' if permanent else 'retriable', error)
+
+    retried = False
+    try:
+        if not permanent:
+            retried = schedule_retry(ch, delivery.queue, delivery.body, delivery.properties)
+        if doc_id:
+            if retried:
+                if requeue_document:
+                    update_doc_status(conn_ref, doc_id, 'in-queue', owner=owner)
+            else:
+                update_doc_status(conn_ref, doc_id, 'fail', result=json.dumps({"error": str(error)}), owner=owner)
+    except Exception as e:
+        logger.exception("Failed to handle error for document %s: %s", doc_id, e)
+
+    if permanent or retried:
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+    else:
+        # попытки исчерпаны — сообщение уходит в dead-letter очередь
+        ch.basic_reject(delivery_tag=method.delivery_tag, requeue=False)
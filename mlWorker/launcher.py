@@ -0,0 +1,167 @@
+"""
+Запускает по одному процессу mlWorker на устройство.
+
+WORKER_DEVICES — список через запятую ("cuda:0,cuda:1", "cpu,cpu");
+по умолчанию — по процессу на каждую видимую GPU, без GPU — один процесс на CPU.
+Каждый процесс видит только свою карту (CUDA_VISIBLE_DEVICES) и держит своего потребителя.
+
+WORKER_SHARE_MODEL=1 (только CPU-устройства): модель загружается один раз в лаунчере, а процессы
+воркеров порождаются через fork и делят её веса copy-on-write — каждый следующий процесс почти
+не добавляет RSS. С GPU так нельзя: CUDA-контекст не переживает fork.
+"""
+import gc
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+
+RESTART_DELAY_SECONDS = 5
+SHARE_MODEL = os.getenv("WORKER_SHARE_MODEL") == "1"
+
+logger = logging.getLogger("mlworker.launcher")
+
+
+def detect_devices():
+    configured = os.getenv("WORKER_DEVICES")
+    if configured:
+        return [d.strip() for d in configured.split(",") if d.strip()]
+
+    import torch
+    count = torch.cuda.device_count()
+    return [f"cuda:{i}" for i in range(count)] if count else ["cpu"]
+
+
+def worker_env(index, device, cpu_workers=1):
+    env = dict(os.environ)
+    # по индексу процесс выбирает свой порт метрик (metrics.py)
+    env["WORKER_INDEX"] = str(index)
+    if device.startswith("cuda"):
+        index = device.split(":", 1)[1] if ":" in device else "0"
+        env["CUDA_VISIBLE_DEVICES"] = index
+        env["WORKER_DEVICE"] = "cuda:0"
+    else:
+        env["CUDA_VISIBLE_DEVICES"] = ""
+        env["WORKER_DEVICE"] = "cpu"
+        # CPU-процессы делят ядра поровну, иначе потоки torch вытесняют друг друга
+        env.setdefault("CPU_THREADS", str(max(1, (os.cpu_count() or 1) // cpu_workers)))
+    return env
+
+
+def spawn(index, device, cpu_workers=1):
+    logger.info("Starting worker on %s", device)
+    return subprocess.Popen([sys.executable, "main.py"], env=worker_env(index, device, cpu_workers))
+
+
+class ForkedWorker:
+    """Процесс-воркер, порождённый fork; повторяет poll/terminate/wait из subprocess.Popen."""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+            if pid:
+                self.returncode = os.waitstatus_to_exitcode(status)
+        return self.returncode
+
+    def terminate(self):
+        if self.returncode is None:
+            try:
+                os.kill(self.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def wait(self):
+        if self.returncode is None:
+            _, status = os.waitpid(self.pid, 0)
+            self.returncode = os.waitstatus_to_exitcode(status)
+        return self.returncode
+
+
+def fork_worker(index, device, cpu_workers, model, processor):
+    logger.info("Forking worker on %s with the shared model", device)
+    pid = os.fork()
+    if pid:
+        return ForkedWorker(pid)
+
+    code = 1
+    try:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        os.environ.update(worker_env(index, device, cpu_workers))
+        if os.getenv("WORKER_ID"):
+            # заданный снаружи WORKER_ID иначе был бы общим у всех процессов и смешал их захваты
+            os.environ["WORKER_ID"] = f"{os.environ['WORKER_ID']}-{index}"
+
+        import main as worker
+        from vlm import configure_cpu_threads
+
+        # пул потоков torch не переживает fork, а ядра делятся между процессами
+        configure_cpu_threads()
+        worker.main(model, processor)
+        code = 0
+    except BaseException:
+        logger.exception("Worker on %s crashed", device)
+    finally:
+        os._exit(code)
+
+
+def load_shared_model(devices):
+    if any(device != "cpu" for device in devices):
+        raise SystemExit("WORKER_SHARE_MODEL=1 needs WORKER_DEVICES to list only cpu devices")
+    os.environ.update(CUDA_VISIBLE_DEVICES="", WORKER_DEVICE="cpu")
+
+    # main не импортирует services на уровне модуля, так что WORKER_ID у детей остаётся своим
+    import main as worker
+    if worker.WORKER_ROLE not in worker.ROLES_WITH_MODEL:
+        return None, None
+    model, processor = worker.load_model()
+
+    # объекты, пережившие загрузку, больше не трогает сборщик мусора, и их страницы не копируются
+    gc.collect()
+    gc.freeze()
+    return model, processor
+
+
+def main():
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(),
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    devices = detect_devices()
+    cpu_workers = max(1, sum(1 for device in devices if device == "cpu"))
+
+    if SHARE_MODEL:
+        model, processor = load_shared_model(devices)
+
+        def start(i):
+            return fork_worker(i, devices[i], cpu_workers, model, processor)
+    else:
+        def start(i):
+            return spawn(i, devices[i], cpu_workers)
+
+    workers = {i: start(i) for i in range(len(devices))}
+
+    def shutdown(signum, frame):
+        for proc in workers.values():
+            proc.terminate()
+        for proc in workers.values():
+            proc.wait()
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    while True:
+        time.sleep(RESTART_DELAY_SECONDS)
+        for i, proc in list(workers.items()):
+            code = proc.poll()
+            if code is not None:
+                logger.warning("Worker on %s exited with code %s, restarting", devices[i], code)
+                workers[i] = start(i)
+
+
+if __name__ == "__main__":
+    main()
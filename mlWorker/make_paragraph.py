@@ -4,6 +4,11 @@ from typing import List, Tuple, Optional
 import math
 import itertools
 
+try:
+    import numpy as np
+except ImportError:  # геометрия без битмапа (бенчмарк, отладка) numpy не требует
+    np = None
+
 Point = Tuple[float, float]
 Polygon = List[Point]  # ожидаем невырожденный многоугольник без самопересечений
 
@@ -173,6 +178,136 @@ def split_polygon_by_center_gap(poly: Polygon, L: float, gap: float) -> Optional
         return None
 
 
+def otsu_threshold(gray) -> int:
+    """Порог Оцу для полутоновой страницы (2D uint8): пиксели не светлее него — чернила."""
+    hist = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    levels = np.arange(256, dtype=np.float64)
+    weight_bg = np.cumsum(hist)
+    weight_fg = weight_bg[-1] - weight_bg
+    mean_bg = np.cumsum(hist * levels) / np.maximum(weight_bg, 1)
+    mean_fg = ((hist * levels).sum() - np.cumsum(hist * levels)) / np.maximum(weight_fg, 1)
+    between = weight_bg * weight_fg * (mean_bg - mean_fg) ** 2
+    return int(np.argmax(between))
+
+
+def ink_mask(gray, threshold: Optional[int] = None) -> "np.ndarray":
+    """Маска чернил страницы (True — тёмный пиксель); порог по умолчанию — Оцу."""
+    return gray <= (otsu_threshold(gray) if threshold is None else threshold)
+
+
+def ink_profile(poly: Polygon, ink, band: float = 0.6):
+    """
+    Проекция чернил внутри строки на её главную ось: число тёмных пикселей на каждый пиксель длины.
+    Учитывается только центральная полоса строки шириной band от её толщины, чтобы выносные
+    элементы соседних строк не закрывали пробелы.
+    Возвращает (профиль, координата начала профиля на оси, центр, ось, толщина строки).
+    """
+    _, (cx, cy), (vx, vy) = polygon_length_along_principal_axis(poly)
+    along = [(x - cx) * vx + (y - cy) * vy for x, y in poly]
+    across = [-(x - cx) * vy + (y - cy) * vx for x, y in poly]
+    start, bins = min(along), int(math.ceil(max(along) - min(along))) + 1
+    thickness = max(across) - min(across)
+    middle = 0.5 * (max(across) + min(across))
+
+    height, width = ink.shape
+    xs = [p[0] for p in poly]
+    ys = [p[1] for p in poly]
+    x0, x1 = max(0, int(min(xs))), min(width, int(math.ceil(max(xs))) + 1)
+    y0, y1 = max(0, int(min(ys))), min(height, int(math.ceil(max(ys))) + 1)
+    if x0 >= x1 or y0 >= y1:
+        return np.zeros(bins, dtype=np.int64), start, (cx, cy), (vx, vy), thickness
+
+    rows, cols = np.nonzero(ink[y0:y1, x0:x1])
+    px = cols + x0 - cx
+    py = rows + y0 - cy
+    t = px * vx + py * vy
+    s = -px * vy + py * vx
+    keep = np.abs(s - middle) <= 0.5 * band * thickness
+    index = np.clip((t[keep] - start).astype(np.int64), 0, bins - 1)
+    return np.bincount(index, minlength=bins), start, (cx, cy), (vx, vy), thickness
+
+
+def _widest_gap(profile, min_gap: float, noise: float):
+    """(начало, конец) самого широкого пустого участка внутри профиля не уже min_gap, иначе None."""
+    empty = np.concatenate(([0], (profile <= noise).astype(np.int8), [0]))
+    edges = np.diff(empty)
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    # пустые поля у концов строки — не разрыв между кусками текста
+    widths = np.where((starts > 0) & (ends < len(profile)), ends - starts, 0)
+    if not len(widths) or widths.max() < min_gap:
+        return None
+    best = int(np.argmax(widths))
+    return int(starts[best]), int(ends[best])
+
+
+def split_polygon_by_profile(poly: Polygon, ink, L: float, gap: float,
+                             gap_factor: float = 1.0, depth: int = 0, max_depth: int = 8) -> List[Polygon]:
+    """
+    Рекурсивно режет строку длиннее L по реальным пробелам: самому широкому пустому участку
+    проекции чернил не уже max(gap, gap_factor * толщина строки). Части без такого пробела
+    остаются целыми, даже если длиннее L, — разрезанное посередине слово VLM не прочтёт.
+    """
+    if len(poly) < 3 or depth >= max_depth:
+        return [poly]
+    length, _, _ = polygon_length_along_principal_axis(poly)
+    if length <= L:
+        return [poly]
+
+    profile, start, (cx, cy), (vx, vy), thickness = ink_profile(poly, ink)
+    # одиночные точки и пыль скана пробел не закрывают
+    found = _widest_gap(profile, max(gap, gap_factor * thickness), noise=max(1.0, 0.02 * thickness))
+    if found is None:
+        return [poly]
+
+    gap_start, gap_end = start + found[0], start + found[1]
+    n = (vx, vy)
+    left = suth_hodgman_clip_halfplane(poly, (cx + gap_start * vx, cy + gap_start * vy), n, keep_le=True)
+    right = suth_hodgman_clip_halfplane(poly, (cx + gap_end * vx, cy + gap_end * vy), n, keep_le=False)
+    parts = []
+    for part in (left, right):
+        if len(part) >= 3:
+            parts.extend(split_polygon_by_profile(part, ink, L, gap, gap_factor, depth + 1, max_depth))
+    return parts or [poly]
+
+
+def split_wide_lines(boundaries: List[Polygon], L: float = 1000, gap: float = 50, gray=None) -> List[Polygon]:
+    """
+    Режет слишком длинные строки kraken (обычно колонки, слипшиеся в одну строку).
+    С gray — полутоновой страницей (2D uint8) — режет по пробелам в проекции чернил
+    (split_polygon_by_profile), без неё — по центральному зазору. Координаты частей
+    округляются до целых.
+    """
+    ink = None
+    line_polys = []
+    for boundary in boundaries:
+        list_boundary = [list(x) for x in boundary]
+        if gray is not None:
+            if polygon_length_along_principal_axis(list_boundary)[0] <= L:
+                line_polys.append(list_boundary)
+                continue
+            if ink is None:
+                # маска считается, только если на странице есть длинные строки
+                ink = ink_mask(gray)
+            parts = split_polygon_by_profile(list_boundary, ink, L, gap)
+            if len(parts) == 1:
+                line_polys.append(list_boundary)
+            else:
+                line_polys.extend([[int(x[0]), int(x[1])] for x in part] for part in parts)
+            continue
+        polygon = split_polygon_by_center_gap(list_boundary, L, gap)
+        if polygon is None:
+            line_polys.append(list_boundary)
+        elif len(polygon) == 1:
+            line_polys.append(polygon)
+            line_polys[-1] = [[int(x[0]), int(x[1])] for x in line_polys[-1]]
+        else:
+            line_polys.extend(polygon)
+            line_polys[-1] = [[int(x[0]), int(x[1])] for x in line_polys[-1]]
+            line_polys[-2] = [[int(x[0]), int(x[1])] for x in line_polys[-2]]
+    return line_polys
+
+
 @dataclass
 class Line:
     polygon: Polygon
@@ -427,6 +562,162 @@ def line_polygons_to_paragraph_polygons(
     return paragraph_polygons
 
 
+# --- Перекрывающиеся кропы абзацев ---
+def _box_area(box: Tuple[float, float, float, float]) -> float:
+    return max(0.0, box[2] - box[0]) * max(0.0, box[3] - box[1])
+
+
+def _box_intersection(a: Tuple[float, float, float, float], b: Tuple[float, float, float, float]):
+    l, t = max(a[0], b[0]), max(a[1], b[1])
+    r, bt = min(a[2], b[2]), min(a[3], b[3])
+    return (l, t, r, bt) if r > l and bt > t else None
+
+
+class _BoxGrid:
+    """
+    Равномерная сетка поверх страницы: ячейка -> индексы рамок, которые её задевают.
+    Кандидаты на пересечение ищутся только в ячейках рамки, а не перебором всех пар.
+    """
+
+    def __init__(self, cell: float):
+        self.cell = cell
+        self.cells = {}
+
+    def _keys(self, box):
+        c = self.cell
+        for gx in range(int(box[0] // c), int(box[2] // c) + 1):
+            for gy in range(int(box[1] // c), int(box[3] // c) + 1):
+                yield gx, gy
+
+    def add(self, index: int, box) -> None:
+        for key in self._keys(box):
+            self.cells.setdefault(key, []).append(index)
+
+    def candidates(self, box) -> set:
+        found = set()
+        for key in self._keys(box):
+            found.update(self.cells.get(key, ()))
+        return found
+
+
+def _clean_cut(inter, line_boxes, axis: int) -> Optional[float]:
+    """
+    Позиция разреза общей полосы inter по оси axis (0 — вертикальный разрез, 1 — горизонтальный),
+    не проходящая ни через одну строку: края полосы или края строк внутри неё.
+    Из равных кандидатов берётся дальний, то есть полоса достаётся первому абзацу.
+    """
+    lo, hi = inter[axis], inter[axis + 2]
+    candidates = {lo, hi}
+    for box in line_boxes:
+        for edge in (box[axis], box[axis + 2]):
+            if lo < edge < hi:
+                candidates.add(edge)
+    for cut in sorted(candidates, reverse=True):
+        if not any(box[axis] < cut < box[axis + 2] for box in line_boxes):
+            return cut
+    return None
+
+
+def dedupe_paragraph_polygons(polygons: List[Polygon],
+                              line_polygons: List[Polygon],
+                              merge_share: float = 0.6,
+                              cell: Optional[float] = None) -> Tuple[List[Polygon], dict]:
+    """
+    Убирает повторное распознавание одних и тех же строк перекрывающимися кропами.
+    Без shapely абзац — выпуклая оболочка строк (_union_polygons), и у соседних абзацев
+    рамки (а VLM получает именно рамку, bbox_corners) могут накрывать одни и те же строки.
+
+    Пары рамок ищутся через сетку (_BoxGrid):
+      - если пересечение занимает не меньше merge_share меньшей рамки, абзацы сливаются
+        в один (выпуклая оболочка) на месте первого по порядку чтения;
+      - иначе общая полоса режется по её узкой стороне там, где разрез не проходит через
+        строки (_clean_cut): целая строка в полосе остаётся только в одном кропе,
+        край оболочки, заходящий на соседнюю строку, срезается. Если такого места нет,
+        перекрытие остаётся — дважды прочитанный кусок лучше разрезанной строки.
+    Возвращает (полигоны, {"merged": n, "trimmed": n, "pixels": площадь рамок, которую больше не распознавать}).
+    """
+    stats = {"merged": 0, "trimmed": 0, "pixels": 0}
+    if len(polygons) < 2:
+        return polygons, stats
+
+    polys = [list(map(tuple, poly)) for poly in polygons]
+    boxes = [_bbox(poly) for poly in polys]
+    before = sum(_box_area(box) for box in boxes)
+    if cell is None:
+        # ячейка порядка рамки абзаца: у рамки немного ячеек, в ячейке немного рамок
+        cell = max(32.0, _median([max(b[2] - b[0], b[3] - b[1]) for b in boxes]))
+
+    # 1) слияние почти вложенных рамок; слитая рамка может накрыть следующие, поэтому до неподвижной точки
+    alive = list(range(len(polys)))
+    changed = True
+    while changed:
+        changed = False
+        grid = _BoxGrid(cell)
+        for i in alive:
+            grid.add(i, boxes[i])
+        gone = set()
+        for i in alive:
+            if i in gone:
+                continue
+            for j in sorted(grid.candidates(boxes[i])):
+                if j <= i or j in gone:
+                    continue
+                inter = _box_intersection(boxes[i], boxes[j])
+                if inter is None:
+                    continue
+                smaller = min(_box_area(boxes[i]), _box_area(boxes[j])) or 1.0
+                if _box_area(inter) >= merge_share * smaller:
+                    polys[i] = _convex_hull(polys[i] + polys[j])
+                    boxes[i] = _bbox(polys[i])
+                    gone.add(j)
+                    stats["merged"] += 1
+                    changed = True
+        alive = [i for i in alive if i not in gone]
+
+    # 2) обрезка частичных перекрытий; рамки только сужаются, так что сетка остаётся надмножеством
+    grid = _BoxGrid(cell)
+    for i in alive:
+        grid.add(i, boxes[i])
+    line_boxes = [_bbox(poly) for poly in line_polygons]
+    line_grid = _BoxGrid(cell)
+    for k, box in enumerate(line_boxes):
+        line_grid.add(k, box)
+    for i in alive:
+        for j in sorted(grid.candidates(boxes[i])):
+            if j <= i:
+                continue
+            inter = _box_intersection(boxes[i], boxes[j])
+            if inter is None:
+                continue
+            # узкая сторона полосы — направление, в котором абзацы соседствуют
+            axis = 1 if inter[3] - inter[1] <= inter[2] - inter[0] else 0
+            first, second = (i, j) if boxes[i][axis] <= boxes[j][axis] else (j, i)
+            # разрез проходит через оба полигона целиком, а не только через общую полосу
+            band = list(inter)
+            band[1 - axis] = min(boxes[i][1 - axis], boxes[j][1 - axis])
+            band[3 - axis] = max(boxes[i][3 - axis], boxes[j][3 - axis])
+            crossing = [line_boxes[k] for k in line_grid.candidates(band)
+                        if _box_intersection(line_boxes[k], band) is not None]
+            cut = _clean_cut(inter, crossing, axis)
+            if cut is None:
+                continue
+            p0 = (cut, 0.0) if axis == 0 else (0.0, cut)
+            n = (1.0, 0.0) if axis == 0 else (0.0, 1.0)
+            head = suth_hodgman_clip_halfplane(polys[first], p0, n, keep_le=True)
+            tail = suth_hodgman_clip_halfplane(polys[second], p0, n, keep_le=False)
+            if len(head) < 3 or len(tail) < 3:
+                continue
+            polys[first], polys[second] = head, tail
+            boxes[first], boxes[second] = _bbox(head), _bbox(tail)
+            stats["trimmed"] += 1
+
+    result = [[[int(round(x)), int(round(y))] for x, y in polys[i]] for i in alive]
+    stats["pixels"] = int(max(0.0, before - sum(_box_area(_bbox(poly)) for poly in result)))
+    if not stats["merged"] and not stats["trimmed"]:
+        return polygons, stats
+    return result, stats
+
+
 # --- Пример использования ---
 if __name__ == "__main__":
     # Пример: две строки = один абзац, потом заголовок по центру, затем новый абзац
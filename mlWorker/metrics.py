@@ -0,0 +1,125 @@
+"""
+Метрики воркера для Prometheus.
+
+Каждый процесс поднимает свой /metrics на METRICS_PORT + WORKER_INDEX (индекс процесса в launcher.py).
+Без prometheus_client метрики отключаются, а span только пишет длительность этапа в debug-лог.
+"""
+import logging
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+try:
+    from prometheus_client import Counter, Gauge, Histogram, start_http_server
+except ImportError:
+    Counter = Gauge = Histogram = start_http_server = None
+
+logger = logging.getLogger(__name__)
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+
+# от десятков миллисекунд (запись в БД) до минут (генерация большой пачки на CPU)
+STAGE_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+if Histogram is not None:
+    STAGE_SECONDS = Histogram("mlworker_stage_seconds", "Длительность этапа обработки", ["stage"],
+                              buckets=STAGE_BUCKETS)
+    STAGE_ERRORS = Counter("mlworker_stage_errors_total", "Этапы, завершившиеся исключением", ["stage"])
+    GENERATED_TOKENS = Counter("mlworker_generated_tokens_total", "Сгенерированные VLM токены")
+    TOKENS_PER_SECOND = Gauge("mlworker_tokens_per_second", "Скорость генерации последнего батча")
+    VLM_BATCH_CROPS = Histogram("mlworker_vlm_batch_size", "Кропов в одном вызове generate",
+                                buckets=(1, 2, 4, 8, 16, 32, 64))
+    QUEUE_LAG_SECONDS = Gauge("mlworker_queue_lag_seconds",
+                              "Сколько последнее полученное сообщение пролежало в очереди", ["queue"])
+    VLM_TOKEN_BUDGET = Gauge("mlworker_vlm_token_budget", "Бюджет токенов одного вызова generate", ["device"])
+    VLM_OOM = Counter("mlworker_vlm_oom_total", "Нехватки памяти при генерации, после которых батч делился",
+                      ["device"])
+    CROPS_FILTERED = Counter("mlworker_crops_filtered_total",
+                             "Кропы, похожие на нетекст (crop_filter.py); dropped=false — режим report",
+                             ["reason", "dropped"])
+    CROPS_DEDUPLICATED = Counter("mlworker_crops_deduplicated_total",
+                                 "Перекрывающиеся кропы абзацев, слитые или обрезанные перед VLM", ["action"])
+    DUPLICATE_PIXELS = Counter("mlworker_duplicate_pixels_total",
+                               "Площадь кропов, которая распознавалась бы дважды")
+    GPU_MEMORY_BYTES = Gauge("mlworker_gpu_memory_bytes", "Память GPU под тензорами torch", ["kind"])
+
+
+@contextmanager
+def span(stage):
+    """Замеряет этап: with span("segmentation"): ..."""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        if Histogram is not None:
+            STAGE_ERRORS.labels(stage).inc()
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        if Histogram is not None:
+            STAGE_SECONDS.labels(stage).observe(elapsed)
+        logger.debug("%s took %.3fs", stage, elapsed)
+
+
+def record_generation(batch_size, tokens, seconds):
+    if Histogram is None:
+        return
+    VLM_BATCH_CROPS.observe(batch_size)
+    GENERATED_TOKENS.inc(tokens)
+    if seconds > 0:
+        TOKENS_PER_SECOND.set(tokens / seconds)
+
+
+def record_budget(device, budget, oom=False):
+    if Histogram is None:
+        return
+    VLM_TOKEN_BUDGET.labels(device).set(budget)
+    if oom:
+        VLM_OOM.labels(device).inc()
+
+
+def record_filtered_crops(counts, dropped=True):
+    if Histogram is None:
+        return
+    for reason, count in counts.items():
+        CROPS_FILTERED.labels(reason, str(dropped).lower()).inc(count)
+
+
+def record_deduplicated(stats):
+    if Histogram is None:
+        return
+    for action in ("merged", "trimmed"):
+        if stats[action]:
+            CROPS_DEDUPLICATED.labels(action).inc(stats[action])
+    DUPLICATE_PIXELS.inc(stats["pixels"])
+
+
+def observe_queue_lag(queue, properties):
+    """timestamp ставит публикующая сторона (server/main.py, services.publish_json, queues.schedule_retry)."""
+    timestamp = getattr(properties, "timestamp", None)
+    if Histogram is None or not timestamp:
+        return
+    QUEUE_LAG_SECONDS.labels(queue).set(max(0.0, time.time() - timestamp))
+
+
+def metrics_port():
+    # WORKER_INDEX читается в момент запуска: при WORKER_SHARE_MODEL=1 модуль импортирован ещё в лаунчере, до fork
+    return METRICS_PORT + int(os.getenv("WORKER_INDEX", "0"))
+
+
+def start_metrics_server():
+    if start_http_server is None:
+        logger.info("prometheus_client is not installed, metrics are disabled")
+        return
+
+    # память GPU читается в момент запроса /metrics; torch импортирован только там, где есть модель
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available():
+        GPU_MEMORY_BYTES.labels("allocated").set_function(torch.cuda.memory_allocated)
+        GPU_MEMORY_BYTES.labels("reserved").set_function(torch.cuda.memory_reserved)
+        GPU_MEMORY_BYTES.labels("max_allocated").set_function(torch.cuda.max_memory_allocated)
+
+    port = metrics_port()
+    start_http_server(port)
+    logger.info("Metrics are served on :%d/metrics", port)
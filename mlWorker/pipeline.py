@@ -0,0 +1,209 @@
+import io
+import json
+import logging
+import os
+import subprocess
+import tempfile
+from dataclasses import dataclass
+from typing import List, Optional
+
+import numpy as np
+from PIL import Image
+
+from yandex_gpt import build_entities
+from artifacts import content_hash, cached_stage, load_texts
+from batcher import CropBatcher
+from crop_filter import filter_polygons
+from metrics import span, record_deduplicated
+from utils import bbox_corners
+from make_paragraph import split_wide_lines, line_polygons_to_paragraph_polygons, dedupe_paragraph_polygons
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PageLayout:
+    width: int
+    height: int
+    bboxes: List[list]
+    crops: List[Image.Image]
+    # декодированная страница, нужна только для ассетов просмотрщика (assets.py)
+    image: Optional[Image.Image] = None
+    # sha256 исходных байтов страницы — ключ промежуточных артефактов (artifacts.py)
+    digest: Optional[str] = None
+
+
+def run_kraken(file_content):
+    with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as tmp_img:
+        tmp_img.write(file_content)
+        tmp_img_path = tmp_img.name
+
+    with tempfile.NamedTemporaryFile(suffix=".txt", delete=False) as tmp_out:
+        tmp_out_path = tmp_out.name
+
+    try:
+        subprocess.run(
+            ["kraken", "-i", tmp_img_path, tmp_out_path, "segment", "-bl"],
+            check=True
+        )
+
+        with open(tmp_out_path, "r", encoding="utf-8") as f:
+            result = json.load(f)
+
+        logger.debug("kraken result: %s", result)
+
+    finally:
+        os.remove(tmp_img_path)
+        os.remove(tmp_out_path)
+
+    return result
+
+
+def segment_page(file_content, store=None):
+    """
+    CPU-часть распознавания: сегментация kraken, разметка абзацев и нарезка кропов.
+    Со store сегментация и разметка текущих версий берутся из артефактов, а не считаются заново.
+    """
+    digest = content_hash(file_content)
+
+    def segment():
+        with span("segmentation"):
+            result = run_kraken(file_content)
+        # из JSON kraken дальше нужны только контуры строк
+        return {"lines": [box_meta['boundary'] for box_meta in result['lines']]}
+
+    img = Image.open(io.BytesIO(file_content))
+    width, height = img.size
+
+    def paragraphs():
+        segmentation = cached_stage(store, digest, "segmentation", segment)
+        with span("layout"):
+            gray = np.asarray(img.convert("L"))
+            # длинные строки режутся по пробелам в проекции чернил страницы, а не посередине
+            line_polys = split_wide_lines(segmentation["lines"], 1000, 50, gray=gray)
+            # рамки соседних абзацев не должны накрывать одни и те же строки
+            polygons, deduplicated = dedupe_paragraph_polygons(line_polygons_to_paragraph_polygons(line_polys),
+                                                               line_polys)
+            if deduplicated["merged"] or deduplicated["trimmed"]:
+                record_deduplicated(deduplicated)
+                logger.info("Paragraph crops: %d merged, %d trimmed, %d duplicate pixels removed",
+                            deduplicated["merged"], deduplicated["trimmed"], deduplicated["pixels"])
+            # пятна, поля и линейки бланка не доходят до VLM
+            polygons, skipped = filter_polygons(polygons, gray)
+            return {"width": width, "height": height, "polygons": polygons, "skipped": skipped,
+                    "deduplicated": deduplicated}
+
+    paragraph_polygons = cached_stage(store, digest, "layout", paragraphs)["polygons"]
+
+    bboxes = [bbox_corners(polygon) for polygon in paragraph_polygons]
+    crops = []
+    for bbox in bboxes:
+        logger.debug("crop %s", (*bbox[0], *bbox[2]))
+        crops.append(img.crop((*bbox[0], *bbox[2])))
+
+    return PageLayout(width, height, bboxes, crops, img, digest)
+
+
+def build_block(bbox, text):
+    return {
+        "boundingBox": {
+            "vertices": [{"x": str(val[0]), "y": str(val[1])} for val in bbox]
+        },
+        "lines": [{
+            "boundingBox": {
+                "vertices": [{"x": str(val[0]), "y": str(val[1])} for val in bbox],
+            },
+            "text": text,
+            "words": [],
+            "entityIndex": "-1",
+            "textSegments": [
+                {
+                    "startIndex": "0",
+                    "length": "1"
+                }
+            ],
+            "orientation": "ANGLE_0"
+        }],
+        "textSegments": [
+            {
+                "startIndex": "0",
+                "length": "1"
+            }
+        ],
+    }
+
+
+def build_output(layout, texts):
+    output = {
+        "result": {
+            "textAnnotation": {
+                "width": str(layout.width),
+                "height": str(layout.height),
+                "blocks": [build_block(bbox, text) for bbox, text in zip(layout.bboxes, texts)],
+                "fullText": "".join(texts),
+                "entities": [],
+                "tables": [],
+                "rotate": "ANGLE_0",
+                "markdown": "",
+                "pictures": []
+            },
+            "pageNumber": 1,
+            "type": "дело"
+        }
+    }
+    return output
+
+
+def attach_entities(output, store=None, digest=None):
+    full_text = output['result']['textAnnotation']['fullText']
+
+    def extract():
+        with span("entities"):
+            return {"entities": build_entities(full_text)['entities']}
+
+    output['result']['entities'] = cached_stage(store, digest, "entities", extract)['entities']
+    logger.debug("output: %s", output)
+    return output
+
+
+def recognize_layouts(layouts, model, processor, progresses=None, store=None):
+    """
+    GPU-часть: кропы всех страниц распознаются общими батчами, затем результат собирается постранично.
+    Страницы, для которых в store есть тексты текущей версии, в VLM не идут.
+    Сущности не извлекаются — см. attach_entities.
+    """
+    progresses = progresses or [None] * len(layouts)
+    known = [load_texts(store, layout) for layout in layouts]
+    batcher = CropBatcher(model, processor)
+    for key, (layout, progress) in enumerate(zip(layouts, progresses)):
+        on_result = None
+        if progress is not None:
+            progress.start(len(layout.bboxes))
+            on_result = (lambda index, text, layout=layout, progress=progress:
+                         progress.add_block(index, build_block(layout.bboxes[index], text)))
+        if known[key] is not None:
+            if on_result is not None:
+                for index, text in enumerate(known[key]):
+                    on_result(index, text)
+            continue
+        batcher.add(key, layout.crops, on_result)
+
+    texts = batcher.run()
+
+    outputs = []
+    for key, (layout, progress) in enumerate(zip(layouts, progresses)):
+        if progress is not None:
+            progress.finish()
+        page_texts = known[key]
+        if page_texts is None:
+            page_texts = texts[key]
+            if store is not None and layout.digest is not None:
+                store.save(layout.digest, "recognition", {"texts": page_texts})
+        outputs.append(build_output(layout, page_texts))
+    return outputs
+
+
+def recognize_text(file_content, mime_type, model, processor, progress=None, store=None):
+    layout = segment_page(file_content, store)
+    output = recognize_layouts([layout], model, processor, [progress], store)[0]
+    return attach_entities(output, store, layout.digest)
@@ -0,0 +1,151 @@
+"""
+Профилирование отдельных документов по запросу.
+
+Документ профилируется, если в сообщении doc_processing есть "profile": true (сервер ставит его
+по ?profile=true при загрузке) или заголовок x-profile, либо случайно с вероятностью
+PROFILE_SAMPLE_RATE. Общий VLM-батч и извлечение сущностей снимаются cProfile
+(PROFILER=cprofile) или torch.profiler (PROFILER=torch, если torch загружен — иначе cProfile);
+у сегментации пишется только длительность: она ждёт подпроцесс kraken, и cProfile показал бы лишь
+ожидание. Профиль кладётся в MinIO рядом с документом под profiles/<doc_id>/, а ключи и длительности
+участков — в result.profile документа.
+
+    python -m pstats profile.prof          # cProfile
+    chrome://tracing или ui.perfetto.dev   # трассы torch (*.trace.json.gz)
+"""
+import cProfile
+import gzip
+import logging
+import marshal
+import os
+import pstats
+import random
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+from infra import S3_BUCKET_NAME
+
+logger = logging.getLogger(__name__)
+
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILER = os.getenv("PROFILER", "cprofile")
+PROFILE_PREFIX = "profiles"
+
+
+def profile_requested(message, properties=None):
+    """Явный запрос профиля в сообщении или заголовке, без случайной выборки."""
+    headers = getattr(properties, "headers", None) or {}
+    return bool(message.get("profile") or headers.get("x-profile"))
+
+
+def wants_profile(message, properties=None):
+    if profile_requested(message, properties):
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+def _torch_profiler():
+    # torch импортирован только в процессах с моделью; сегментатору он не нужен
+    torch = sys.modules.get("torch")
+    return getattr(torch, "profiler", None) if torch is not None else None
+
+
+class Profile:
+    """Профиль одного документа: участки cProfile сливаются в один .prof, трассы torch — по файлу на участок."""
+
+    def __init__(self, doc_id, kind=PROFILER):
+        self.doc_id = doc_id
+        self.kind = kind
+        self.stats = None
+        self.traces = {}
+        self.sections = {}
+
+    def add(self, name, seconds, profiler=None, trace=None):
+        self.sections[name] = round(self.sections.get(name, 0.0) + seconds, 4)
+        if profiler is not None:
+            if self.stats is None:
+                self.stats = pstats.Stats(profiler)
+            else:
+                self.stats.add(profiler)
+        if trace is not None:
+            self.traces[name] = trace
+
+    def upload(self, s3_client):
+        """Загружает профиль и возвращает описание для result.profile; ошибки не роняют документ."""
+        base = f"{PROFILE_PREFIX}/{self.doc_id}/{time.strftime('%Y%m%dT%H%M%S', time.gmtime())}"
+        objects = []
+        if self.stats is not None:
+            # pstats.Stats.dump_stats пишет только в файл, формат — marshal словаря stats
+            objects.append((f"{base}.prof", marshal.dumps(self.stats.stats)))
+        for name, trace in self.traces.items():
+            objects.append((f"{base}-{name}.trace.json.gz", gzip.compress(trace, 6)))
+        try:
+            for key, body in objects:
+                s3_client.put_object(Bucket=S3_BUCKET_NAME, Key=key, Body=body,
+                                     ContentType="application/octet-stream")
+        except Exception as e:
+            logger.warning("Failed to upload profile of %s: %s", self.doc_id, e)
+            return None
+        logger.info("Uploaded profile of %s: %s", self.doc_id, [key for key, _ in objects])
+        return {"keys": [key for key, _ in objects], "sections": self.sections}
+
+
+def start_profile(doc_id, message, properties=None):
+    return Profile(doc_id) if wants_profile(message, properties) else None
+
+
+@contextmanager
+def timed(profiles, name):
+    """Только длительность участка, без профилировщика: для участков, которые ждут другой процесс."""
+    profiles = [profile for profile in profiles if profile is not None]
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        for profile in profiles:
+            profile.add(name, elapsed)
+
+
+@contextmanager
+def profiled(profiles, name):
+    """
+    Снимает участок name для всех переданных профилей (None пропускаются). Профилировщик один
+    на участок: VLM-батч общий для нескольких документов, а два cProfile одновременно не работают.
+    """
+    profiles = [profile for profile in profiles if profile is not None]
+    if not profiles:
+        yield
+        return
+
+    torch_profiler = _torch_profiler() if profiles[0].kind == "torch" else None
+    start = time.perf_counter()
+    if torch_profiler is not None:
+        activities = [torch_profiler.ProfilerActivity.CPU]
+        if sys.modules["torch"].cuda.is_available():
+            activities.append(torch_profiler.ProfilerActivity.CUDA)
+        with torch_profiler.profile(activities=activities, record_shapes=True) as prof:
+            yield
+        elapsed = time.perf_counter() - start
+        with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as tmp:
+            path = tmp.name
+        try:
+            prof.export_chrome_trace(path)
+            with open(path, "rb") as f:
+                trace = f.read()
+        finally:
+            os.remove(path)
+        for profile in profiles:
+            profile.add(name, elapsed, trace=trace)
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        elapsed = time.perf_counter() - start
+        for profile in profiles:
+            profile.add(name, elapsed, profiler=profiler)
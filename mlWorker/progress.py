@@ -0,0 +1,80 @@
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+STATUS_CHANNEL = "document_status"
+PROGRESS_INTERVAL_SECONDS = float(os.getenv("PROGRESS_INTERVAL_SECONDS", "2.0"))
+
+
+def indexed_block(index, block):
+    """Блоки приходят в порядке распознавания, по cropIndex клиент восстанавливает порядок чтения."""
+    return {**block, "cropIndex": index}
+
+
+class ProgressReporter:
+    """
+    Пишет прогресс распознавания страницы в document_progress не чаще раза в min_interval.
+    В таблицу дописываются только новые блоки, полный result не перезаписывается.
+    Строку удаляет переход в 'done' или 'fail' (infra.update_doc_status).
+    Ошибки записи не роняют обработку документа — прогресс best-effort.
+    """
+
+    def __init__(self, conn_ref, doc_id, min_interval=PROGRESS_INTERVAL_SECONDS):
+        self.conn_ref = conn_ref
+        self.doc_id = doc_id
+        self.min_interval = min_interval
+        self.total = 0
+        self.done = 0
+        self._pending = []
+        self._last_flush = 0.0
+
+    def start(self, total):
+        self.total = total
+        self.done = 0
+        self._pending = []
+        self._write(reset=True)
+
+    def add_block(self, index, block):
+        self.done += 1
+        self._pending.append(indexed_block(index, block))
+        if time.monotonic() - self._last_flush >= self.min_interval:
+            self._write()
+
+    def finish(self):
+        if self._pending:
+            self._write()
+
+    def _write(self, reset=False):
+        blocks = json.dumps(self._pending)
+        try:
+            with self.conn_ref["conn"]:
+                with self.conn_ref["conn"].cursor() as cur:
+                    cur.execute(
+                        """
+                        INSERT INTO document_progress (doc_id, done, total, blocks, updated_at)
+                        VALUES (%s, %s, %s, %s::jsonb, now())
+                        ON CONFLICT (doc_id) DO UPDATE SET
+                            done = EXCLUDED.done,
+                            total = EXCLUDED.total,
+                            blocks = CASE WHEN %s THEN EXCLUDED.blocks
+                                          ELSE document_progress.blocks || EXCLUDED.blocks END,
+                            updated_at = now()
+                        """,
+                        (self.doc_id, self.done, self.total, blocks, reset),
+                    )
+                    cur.execute(
+                        "SELECT pg_notify(%s, %s)",
+                        (STATUS_CHANNEL, json.dumps({
+                            "id": self.doc_id,
+                            "status": "processing",
+                            "progress": {"done": self.done, "total": self.total},
+                        })),
+                    )
+        except Exception as e:
+            logger.warning("Progress write failed for %s: %s", self.doc_id, e)
+            return
+        self._pending = []
+        self._last_flush = time.monotonic()
@@ -0,0 +1,156 @@
+import base64
+import json
+import logging
+import os
+import re
+import time
+import urllib.parse
+import urllib.request
+
+import pika
+from botocore.exceptions import ClientError
+from PIL import Image, UnidentifiedImageError
+
+logger = logging.getLogger(__name__)
+
+PROCESSING_QUEUE = "doc_processing"
+BULK_QUEUE = f"{PROCESSING_QUEUE}.bulk"
+DEAD_LETTER_QUEUE = f"{PROCESSING_QUEUE}.dead"
+RETRY_HEADER = "x-retry-count"
+
+# Классы приоритета: интерактивные загрузки и массовый импорт идут в разные очереди
+WORK_QUEUES = {
+    "interactive": PROCESSING_QUEUE,
+    "bulk": BULK_QUEUE,
+}
+# Внутри bulk приоритет сообщения выставляет сервер по размеру очереди арендатора
+BULK_MAX_PRIORITY = 9
+
+# Очереди раздельного режима: сегментатор -> распознаватели кропов -> сборщик результата.
+# Кропы интерактивных документов получают приоритет выше любого bulk.
+CROP_QUEUE = "crop_recognition"
+AGGREGATION_QUEUE = "doc_aggregation"
+CROP_MAX_PRIORITY = BULK_MAX_PRIORITY + 1
+
+# Задержки между повторными попытками; на каждую задержку своя очередь с TTL,
+# истёкшие сообщения возвращаются в исходную рабочую очередь через dead-letter.
+RETRY_DELAYS_SECONDS = [int(x) for x in os.getenv("RETRY_DELAYS_SECONDS", "10,60,300").split(",") if x]
+
+# Отклонённые сообщения рабочих очередей уходят в DEAD_LETTER_QUEUE по политике RabbitMQ, а не по
+# x-dead-letter-* в аргументах: doc_processing уже объявлена без них, и повторное объявление с другими
+# аргументами падает с PRECONDITION_FAILED, а политика применяется и к существующим очередям.
+# Пустое имя — политикой управляют вручную.
+DEAD_LETTER_POLICY = os.getenv("RABBITMQ_DEAD_LETTER_POLICY", "doc-processing-dead-letter")
+RABBITMQ_MANAGEMENT_URL = os.getenv("RABBITMQ_MANAGEMENT_URL",
+                                    f"http://{os.getenv('RABBITMQ_HOST', 'localhost')}:15672")
+RABBITMQ_VHOST = os.getenv("RABBITMQ_VHOST", "/")
+
+
+def work_queue_arguments(queue):
+    """Аргументы doc_processing* должны совпадать с объявлением в server/main.py"""
+    arguments = {}
+    if queue == BULK_QUEUE:
+        arguments["x-max-priority"] = BULK_MAX_PRIORITY
+    elif queue == CROP_QUEUE:
+        arguments["x-max-priority"] = CROP_MAX_PRIORITY
+    return arguments
+
+
+class PermanentError(Exception):
+    """Ошибка, которая повторится при любой попытке: неподдерживаемый формат, битый файл и т.п."""
+
+
+def retry_queue_name(queue, delay_seconds):
+    return f"{queue}.retry.{delay_seconds}s"
+
+
+def dead_letter_policy():
+    """Тело политики для PUT /api/policies/<vhost>/<name>: DLX на все рабочие очереди, но не на повторы."""
+    queues = (*WORK_QUEUES.values(), CROP_QUEUE, AGGREGATION_QUEUE)
+    return {
+        "pattern": "^(" + "|".join(map(re.escape, queues)) + ")$",
+        "apply-to": "queues",
+        "definition": {"dead-letter-exchange": "", "dead-letter-routing-key": DEAD_LETTER_QUEUE},
+        "priority": 0,
+    }
+
+
+def ensure_dead_letter_policy():
+    """Ставит политику через HTTP API плагина management; без него — подсказка для rabbitmqctl в лог."""
+    if not DEAD_LETTER_POLICY:
+        return False
+    policy = dead_letter_policy()
+    url = (f"{RABBITMQ_MANAGEMENT_URL.rstrip('/')}/api/policies/"
+           f"{urllib.parse.quote(RABBITMQ_VHOST, safe='')}/{urllib.parse.quote(DEAD_LETTER_POLICY, safe='')}")
+    credentials = f"{os.getenv('RABBITMQ_USER', 'guest')}:{os.getenv('RABBITMQ_PASS', 'guest')}"
+    request = urllib.request.Request(url, data=json.dumps(policy).encode(), method="PUT", headers={
+        "Content-Type": "application/json",
+        "Authorization": "Basic " + base64.b64encode(credentials.encode()).decode(),
+    })
+    try:
+        with urllib.request.urlopen(request, timeout=10):
+            pass
+    except Exception as e:
+        logger.error("Failed to set RabbitMQ policy %s (%s): %s. Rejected messages will be dropped until it is "
+                     "set, e.g. rabbitmqctl set_policy -p %s --apply-to queues %s '%s' '%s'",
+                     DEAD_LETTER_POLICY, url, e, RABBITMQ_VHOST, DEAD_LETTER_POLICY, policy["pattern"],
+                     json.dumps(policy["definition"]))
+        return False
+    logger.info("RabbitMQ policy %s routes rejected messages to %s", DEAD_LETTER_POLICY, DEAD_LETTER_QUEUE)
+    return True
+
+
+def declare_topology(channel):
+    channel.queue_declare(queue=DEAD_LETTER_QUEUE, durable=True)
+    ensure_dead_letter_policy()
+    for queue in (*WORK_QUEUES.values(), CROP_QUEUE, AGGREGATION_QUEUE):
+        channel.queue_declare(queue=queue, durable=True, arguments=work_queue_arguments(queue))
+        for delay in RETRY_DELAYS_SECONDS:
+            channel.queue_declare(
+                queue=retry_queue_name(queue, delay),
+                durable=True,
+                arguments={
+                    "x-message-ttl": delay * 1000,
+                    "x-dead-letter-exchange": "",
+                    "x-dead-letter-routing-key": queue,
+                },
+            )
+
+
+def is_permanent(exc):
+    if isinstance(exc, (PermanentError, UnidentifiedImageError, Image.DecompressionBombError,
+                        json.JSONDecodeError, UnicodeDecodeError)):
+        return True
+    if isinstance(exc, ClientError):
+        return exc.response.get("Error", {}).get("Code") in ("NoSuchKey", "404")
+    return False
+
+
+def get_retry_count(properties):
+    headers = (properties.headers or {}) if properties is not None else {}
+    return int(headers.get(RETRY_HEADER, 0))
+
+
+def schedule_retry(channel, queue, body, properties):
+    """
+    Публикует копию сообщения в очередь отложенного повтора для рабочей очереди queue.
+    Возвращает False, если попытки исчерпаны.
+    """
+    attempt = get_retry_count(properties)
+    if attempt >= len(RETRY_DELAYS_SECONDS):
+        return False
+
+    headers = dict((properties.headers or {}) if properties is not None else {})
+    headers[RETRY_HEADER] = attempt + 1
+    channel.basic_publish(
+        exchange="",
+        routing_key=retry_queue_name(queue, RETRY_DELAYS_SECONDS[attempt]),
+        body=body,
+        properties=pika.BasicProperties(
+            delivery_mode=2,
+            headers=headers,
+            priority=properties.priority if properties is not None else None,
+            timestamp=int(time.time()),
+        ),
+    )
+    return True
@@ -0,0 +1,195 @@
+"""
+Перезапуск уже распознанных документов только с тех стадий, версия которых изменилась.
+
+    python reprocess.py --all --dry-run
+    python reprocess.py --all --batch-docs 8
+    python reprocess.py --ids 3f2a... 9c41...
+
+Для каждого документа в статусе done по documents.hash (sha256 страницы) проверяются артефакты
+текущих версий (artifacts.py):
+  - есть entities            — документ актуален, пропускается;
+  - есть recognition         — заново извлекаются только сущности, страница не скачивается;
+  - иначе                    — страница скачивается, сегментация и разметка берутся из артефактов,
+                               если их версии не менялись, кропы распознаются VLM общими батчами.
+Документы, распознанные до появления артефактов, проходят весь конвейер один раз.
+Ассеты просмотрщика не пересобираются: страница не меняется.
+"""
+import argparse
+import logging
+import os
+import sys
+from collections import Counter
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from artifacts import STAGE_VERSIONS, get_artifact_store, is_content_hash, load_texts  # noqa: E402
+from config import BATCH_DOCS, MODEL_PATH, LORA_PATH  # noqa: E402
+from infra import S3_BUCKET_NAME, get_s3_client, connect_to_postgres, run_in_transaction, save_result  # noqa: E402
+from pipeline import PageLayout, segment_page, build_output, attach_entities, recognize_layouts  # noqa: E402
+from utils import bbox_corners  # noqa: E402
+from vlm import load_model_and_processor  # noqa: E402
+
+logger = logging.getLogger("mlworker.reprocess")
+
+# сколько строк documents читать из серверного курсора за раз
+FETCH_SIZE = 1000
+
+
+def connect_reader():
+    """
+    Отдельное соединение для именованного курсора. connect_to_postgres включает autocommit, а
+    серверный курсор живёт только внутри транзакции — без неё psycopg2 падает с ProgrammingError.
+    """
+    conn = connect_to_postgres()
+    conn.autocommit = False
+    return conn
+
+
+def iter_documents(conn, ids=None, limit=None):
+    """(id, filepath, hash) распознанных документов; conn — из connect_reader, курсор именованный."""
+    sql = "SELECT id, filepath, hash FROM documents WHERE status = 'done'"
+    params = []
+    if ids:
+        sql += " AND id = ANY(%s)"
+        params.append(list(ids))
+    sql += " ORDER BY id"
+    if limit:
+        sql += " LIMIT %s"
+        params.append(limit)
+    with conn.cursor(name="reprocess_documents") as cur:
+        cur.itersize = FETCH_SIZE
+        cur.execute(sql, params)
+        yield from cur
+
+
+def plan(store, digest):
+    """Первая стадия, которую нужно выполнить заново, или None, если документ актуален."""
+    if not is_content_hash(digest):
+        return "segmentation"
+    if store.exists(digest, "entities"):
+        return None
+    if store.exists(digest, "recognition"):
+        return "entities"
+    return "recognition"
+
+
+class Reprocessor:
+    def __init__(self, conn_ref, s3_client, store, batch_docs, device=None):
+        self.conn_ref = conn_ref
+        self.s3_client = s3_client
+        self.store = store
+        self.batch_docs = batch_docs
+        self.device = device
+        self.model = self.processor = None
+        self.pending = []
+        self.counts = Counter()
+
+    def page_from_artifacts(self, digest):
+        """Страница без картинки: геометрия из артефакта layout, тексты — из recognition."""
+        layout = self.store.load(digest, "layout")
+        if layout is None:
+            return None
+        page = PageLayout(layout["width"], layout["height"],
+                          [bbox_corners(polygon) for polygon in layout["polygons"]], [], digest=digest)
+        texts = load_texts(self.store, page)
+        return None if texts is None else build_output(page, texts)
+
+    def finish(self, doc_id, digest, output):
+        attach_entities(output, self.store, digest)
+        save_result(self.conn_ref, self.s3_client, doc_id, output)
+
+    def add(self, doc_id, filepath, digest, stage):
+        try:
+            if stage == "entities":
+                output = self.page_from_artifacts(digest)
+                if output is not None:
+                    self.finish(doc_id, digest, output)
+                    self.counts["entities"] += 1
+                    return
+            response = self.s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=filepath.split('/')[-1])
+            layout = segment_page(response['Body'].read(), self.store)
+            layout.image = None
+            if layout.digest != digest:
+                run_in_transaction(self.conn_ref, lambda cur: cur.execute(
+                    "UPDATE documents SET hash = %s WHERE id = %s", (layout.digest, doc_id)))
+            self.pending.append((doc_id, layout))
+            if len(self.pending) >= self.batch_docs:
+                self.flush()
+        except Exception as e:
+            self.counts["failed"] += 1
+            logger.warning("Failed to reprocess %s: %s", doc_id, e)
+
+    def flush(self):
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        # модель грузится при первой странице, которой действительно нужен VLM: у документов без
+        # documents.hash тексты текущей версии могут уже лежать в артефактах
+        if self.model is None and any(load_texts(self.store, layout) is None for _, layout in batch):
+            self.model, self.processor = load_model_and_processor(MODEL_PATH, lora_path=LORA_PATH,
+                                                                  merge_lora=True, device=self.device)
+        try:
+            outputs = recognize_layouts([layout for _, layout in batch], self.model, self.processor,
+                                        store=self.store)
+        except Exception as e:
+            self.counts["failed"] += len(batch)
+            logger.warning("Failed to recognize %d documents: %s", len(batch), e)
+            return
+        for (doc_id, layout), output in zip(batch, outputs):
+            try:
+                self.finish(doc_id, layout.digest, output)
+                self.counts["recognition"] += 1
+            except Exception as e:
+                self.counts["failed"] += 1
+                logger.warning("Failed to reprocess %s: %s", doc_id, e)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Re-run only the recognition stages whose version changed")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--all", action="store_true", help="All documents in status 'done'")
+    target.add_argument("--ids", nargs="+", help="Document ids")
+    parser.add_argument("--limit", type=int, help="Stop after this many documents")
+    parser.add_argument("--batch-docs", type=int, default=BATCH_DOCS, help="Pages whose crops share VLM batches")
+    parser.add_argument("--device", default=os.getenv("WORKER_DEVICE") or None)
+    parser.add_argument("--dry-run", action="store_true", help="Only count documents per stage to re-run")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(),
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    s3_client = get_s3_client()
+    store = get_artifact_store(s3_client)
+    if store is None:
+        logger.error("ARTIFACT_STORE is off, nothing to compare stage versions against")
+        return 1
+    logger.info("Stage versions: %s", STAGE_VERSIONS)
+
+    reader = connect_reader()
+    conn_ref = {"conn": connect_to_postgres()}
+    reprocessor = Reprocessor(conn_ref, s3_client, store, args.batch_docs, args.device)
+    planned = Counter()
+    try:
+        for doc_id, filepath, digest in iter_documents(reader, args.ids, args.limit):
+            stage = plan(store, digest)
+            planned[stage or "up-to-date"] += 1
+            if stage is not None and not args.dry_run:
+                reprocessor.add(doc_id, filepath, digest, stage)
+            if sum(planned.values()) % FETCH_SIZE == 0:
+                logger.info("Checked %d documents: %s", sum(planned.values()), dict(planned))
+        reprocessor.flush()
+    finally:
+        reader.close()
+
+    logger.info("Planned: %s", dict(planned))
+    if not args.dry_run:
+        logger.info("Reprocessed: %s", dict(reprocessor.counts))
+    return 1 if reprocessor.counts["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,123 @@
+"""
+Компактное хранение результата OCR.
+
+Полный формат (textAnnotation со строковыми координатами и дублированием рамки блока в его строке)
+раскладывается в компактный: числовые координаты x0, y0, x1, y1, строка без своей рамки, если
+она совпадает с рамкой блока, fullText не хранится, если он склеивается из строк.
+
+RESULT_STORAGE=postgres — компактный JSON пишется в documents.result;
+RESULT_STORAGE=s3 — результат сжимается (msgpack + zstd, без них — json + gzip) и кладётся в MinIO,
+а в documents.result остаётся только сводка со ссылкой на объект. Объект пишется под ключом
+попытки results/<id>/<время>-<суффикс>, см. infra.save_result.
+Обратно в полный формат результат разворачивает сервер (server/main.py, expand_result).
+"""
+import gzip
+import json
+import logging
+import os
+import time
+import uuid
+
+try:
+    import msgpack
+    import zstandard
+except ImportError:
+    msgpack = zstandard = None
+
+from config import S3_BUCKET_NAME
+
+logger = logging.getLogger(__name__)
+
+COMPACT_VERSION = 1
+RESULT_STORAGE = os.getenv("RESULT_STORAGE", "postgres")
+RESULT_PREFIX = "results"
+ZSTD_LEVEL = int(os.getenv("RESULT_ZSTD_LEVEL", "10"))
+
+_DEFAULT_ANNOTATION = {"entities": [], "tables": [], "rotate": "ANGLE_0", "markdown": "", "pictures": []}
+
+
+def _box(vertices):
+    xs = [int(float(v["x"])) for v in vertices]
+    ys = [int(float(v["y"])) for v in vertices]
+    return [min(xs), min(ys), max(xs), max(ys)]
+
+
+def to_compact(ocr_result):
+    page = ocr_result["result"]
+    annotation = page["textAnnotation"]
+
+    blocks = []
+    texts = []
+    for block in annotation.get("blocks", []):
+        box = _box(block["boundingBox"]["vertices"])
+        lines = []
+        for line in block.get("lines", []):
+            text = line.get("text", "")
+            texts.append(text)
+            line_box = _box(line["boundingBox"]["vertices"])
+            # строка с рамкой блока (наш единственный случай) хранится просто текстом
+            lines.append(text if line_box == box else [*line_box, text])
+        blocks.append([*box, lines[0] if len(lines) == 1 and isinstance(lines[0], str) else lines])
+
+    compact = {
+        "v": COMPACT_VERSION,
+        "w": int(annotation["width"]),
+        "h": int(annotation["height"]),
+        "page": page.get("pageNumber", 1),
+        "type": page.get("type"),
+        "blocks": blocks,
+        "entities": page.get("entities", []),
+    }
+    if annotation.get("fullText", "") != "".join(texts):
+        compact["fullText"] = annotation["fullText"]
+    # непустые служебные поля аннотации сохраняются как есть
+    extra = {key: annotation[key] for key, default in _DEFAULT_ANNOTATION.items()
+             if key in annotation and annotation[key] != default}
+    if extra:
+        compact["extra"] = extra
+    if page.get("profile"):
+        compact["profile"] = page["profile"]
+    return compact
+
+
+def encode(compact):
+    """Возвращает (codec, bytes)."""
+    if msgpack is not None:
+        raw = msgpack.packb(compact, use_bin_type=True)
+        return "msgpack+zstd", zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(raw)
+    raw = json.dumps(compact, ensure_ascii=False, separators=(",", ":")).encode()
+    return "json+gzip", gzip.compress(raw)
+
+
+def summarize(compact):
+    summary = {
+        "v": compact["v"],
+        "w": compact["w"],
+        "h": compact["h"],
+        "page": compact["page"],
+        "type": compact["type"],
+        "blockCount": len(compact["blocks"]),
+        "entityCount": len(compact["entities"]),
+    }
+    if "profile" in compact:
+        summary["profile"] = compact["profile"]
+    return summary
+
+
+def store_result(s3_client, doc_id, ocr_result):
+    """
+    Готовит значение для documents.result: компактный JSON или сводку со ссылкой на объект в S3.
+    Возвращает (значение, ключ загруженного объекта или None).
+    """
+    compact = to_compact(ocr_result)
+    if RESULT_STORAGE != "s3":
+        return json.dumps(compact, ensure_ascii=False, separators=(",", ":")), None
+
+    codec, payload = encode(compact)
+    # у каждой попытки свой ключ: проигравший воркер не перезаписывает объект, на который уже ссылается строка
+    key = f"{RESULT_PREFIX}/{doc_id}/{time.time_ns():020d}-{uuid.uuid4().hex[:8]}.{codec.replace('+', '.')}"
+    s3_client.put_object(Bucket=S3_BUCKET_NAME, Key=key, Body=payload, ContentType="application/octet-stream")
+    summary = summarize(compact)
+    summary["storage"] = {"key": key, "codec": codec, "size": len(payload)}
+    logger.info("Stored result of %s in S3: %s (%d bytes)", doc_id, key, len(payload))
+    return json.dumps(summary), key
@@ -0,0 +1,72 @@
+from psycopg2.extras import execute_values
+
+
+def _bbox_from_vertices(vertices):
+    xs = [int(float(v["x"])) for v in vertices]
+    ys = [int(float(v["y"])) for v in vertices]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def index_document(cur, doc_id, ocr_result):
+    """
+    Раскладывает результат OCR по таблицам document_pages / blocks / lines / entities.
+    Повторный вызов для того же документа перезаписывает его строки.
+    """
+    page = ocr_result["result"]
+    annotation = page["textAnnotation"]
+    page_number = int(page.get("pageNumber", 1))
+
+    cur.execute("DELETE FROM document_pages WHERE doc_id = %s", (doc_id,))
+
+    cur.execute(
+        """
+        INSERT INTO document_pages (doc_id, page_number, width, height, doc_type, full_text)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        RETURNING id
+        """,
+        (doc_id, page_number, int(annotation["width"]), int(annotation["height"]),
+         page.get("type"), annotation.get("fullText", "")),
+    )
+    page_id = cur.fetchone()[0]
+
+    blocks = annotation.get("blocks", [])
+    if blocks:
+        block_rows = []
+        for block_index, block in enumerate(blocks):
+            text = "\n".join(line.get("text", "") for line in block.get("lines", []))
+            block_rows.append((page_id, block_index,
+                               *_bbox_from_vertices(block["boundingBox"]["vertices"]), text))
+        block_ids = dict(execute_values(
+            cur,
+            "INSERT INTO document_blocks (page_id, block_index, x0, y0, x1, y1, text) VALUES %s "
+            "RETURNING block_index, id",
+            block_rows,
+            fetch=True,
+        ))
+
+        line_rows = []
+        for block_index, block in enumerate(blocks):
+            for line_index, line in enumerate(block.get("lines", [])):
+                line_rows.append((block_ids[block_index], line_index,
+                                  *_bbox_from_vertices(line["boundingBox"]["vertices"]),
+                                  line.get("text", "")))
+        if line_rows:
+            execute_values(
+                cur,
+                "INSERT INTO document_lines (block_id, line_index, x0, y0, x1, y1, text) VALUES %s",
+                line_rows,
+            )
+
+    entity_rows = [
+        (doc_id, page_id, e.get("type", "ФИО"), e["text"],
+         e.get("blockIndex"), e.get("startIndex"), e.get("endIndex"))
+        for e in page.get("entities", [])
+        if e.get("text")
+    ]
+    if entity_rows:
+        execute_values(
+            cur,
+            "INSERT INTO document_entities "
+            "(doc_id, page_id, entity_type, text, block_index, start_index, end_index) VALUES %s",
+            entity_rows,
+        )
@@ -0,0 +1,68 @@
+import os
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Any, Optional
+
+# Сколько интерактивных документов подряд можно взять, прежде чем уступить один bulk
+INTERACTIVE_WEIGHT = int(os.getenv("INTERACTIVE_WEIGHT", "4"))
+
+
+@dataclass
+class Delivery:
+    queue_class: str
+    queue: str
+    channel: Any
+    method: Any
+    properties: Any
+    body: bytes
+    tenant: str
+
+
+class FairScheduler:
+    """
+    Буфер предвыбранных (prefetch) сообщений.
+    Между классами — взвешенный приоритет interactive над bulk,
+    внутри класса — round-robin по арендаторам (tenant / batch).
+    """
+
+    def __init__(self, classes=("interactive", "bulk"), interactive_weight=INTERACTIVE_WEIGHT):
+        self.classes = classes
+        self.interactive_weight = interactive_weight
+        self._queues = {cls: OrderedDict() for cls in classes}
+        self._streak = 0
+
+    def __len__(self):
+        return sum(self.depth(cls) for cls in self.classes)
+
+    def depth(self, queue_class):
+        return sum(len(q) for q in self._queues[queue_class].values())
+
+    def push(self, delivery: Delivery):
+        tenants = self._queues[delivery.queue_class]
+        tenants.setdefault(delivery.tenant, deque()).append(delivery)
+
+    def _pop_round_robin(self, queue_class) -> Optional[Delivery]:
+        tenants = self._queues[queue_class]
+        if not tenants:
+            return None
+        tenant, pending = next(iter(tenants.items()))
+        delivery = pending.popleft()
+        # арендатор уходит в конец очереди обхода
+        del tenants[tenant]
+        if pending:
+            tenants[tenant] = pending
+        return delivery
+
+    def pop(self) -> Optional[Delivery]:
+        first, rest = self.classes[0], self.classes[1:]
+        if self._queues[first] and (self._streak < self.interactive_weight
+                                    or not any(self._queues[cls] for cls in rest)):
+            self._streak += 1
+            return self._pop_round_robin(first)
+
+        self._streak = 0
+        for cls in rest:
+            delivery = self._pop_round_robin(cls)
+            if delivery is not None:
+                return delivery
+        return self._pop_round_robin(first)
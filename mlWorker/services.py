@@ -0,0 +1,488 @@
+"""
+Роли воркера.
+
+all        — весь конвейер в одном процессе (сегментация + VLM + сборка результата);
+segmenter  — CPU: скачивает страницу, сегментирует и публикует координаты кропов в CROP_QUEUE;
+recognizer — GPU: распознаёт кропы разных страниц общими батчами;
+aggregator — собирает textAnnotation, когда распознаны все кропы страницы, и извлекает сущности.
+"""
+import io
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Optional
+
+import pika
+from PIL import Image
+from psycopg2.extras import execute_values
+
+from config import BATCH_DOCS, SUPPORTED_FORMATS
+from infra import S3_BUCKET_NAME, WORKER_ID, SPLIT_PIPELINE_OWNER, SPLIT_PIPELINE_LEASE_SECONDS, get_s3_client, \
+    connect_to_rabbitmq, connect_to_postgres, run_in_transaction, claim_document, hand_over_claim, \
+    handle_failure, save_result, pipeline_lease_keeper
+from pipeline import PageLayout, segment_page, build_block, build_output, attach_entities, recognize_layouts
+from progress import ProgressReporter, STATUS_CHANNEL, indexed_block
+from queues import WORK_QUEUES, CROP_QUEUE, AGGREGATION_QUEUE, CROP_MAX_PRIORITY, PermanentError, \
+    declare_topology, get_retry_count
+from scheduler import Delivery, FairScheduler
+from assets import AssetPublisher, wait_published
+from artifacts import get_artifact_store, is_content_hash, load_texts
+from batcher import VLM_BATCH_SIZE
+from metrics import span, observe_queue_lag
+from profiling import Profile, profile_requested, start_profile, profiled, timed
+from utils import bbox_corners
+
+logger = logging.getLogger(__name__)
+
+# Сколько сообщений каждого класса держать в буфере планировщика
+WORKER_PREFETCH = int(os.getenv("WORKER_PREFETCH", "16"))
+# Сколько распознаватель ждёт добора неполного батча кропов
+CROP_BATCH_WAIT_SECONDS = float(os.getenv("CROP_BATCH_WAIT_SECONDS", "0.2"))
+# Сколько декодированных страниц держит распознаватель (кропы одной страницы обычно идут подряд)
+IMAGE_CACHE_SIZE = int(os.getenv("IMAGE_CACHE_SIZE", "8"))
+
+@dataclass
+class Job:
+    delivery: Delivery
+    doc_id: str
+    filepath: str
+    layout: PageLayout
+    progress: ProgressReporter
+    # профиль документа по запросу (profiling.py), None — не профилируется
+    profile: Optional[Profile] = None
+    # фоновая сборка ассетов просмотрщика (AssetPublisher.submit), ждём её до 'done'
+    assets: Optional[Future] = None
+
+
+def prepare_document(delivery, conn_ref, s3_client, store=None, profiling=False, assets=None) -> Optional[Job]:
+    """
+    Всё до VLM: проверка, скачивание, сегментация. При ошибке документ обрабатывается здесь же.
+    store — хранилище промежуточных артефактов (artifacts.py), сегментация берётся из него, если есть.
+    profiling — учитывать запрос профиля из сообщения: профиль собирает только роль all,
+    где распознавание документа идёт в этом же процессе; в остальных ролях запрос только логируется.
+    assets — AssetPublisher: ассеты просмотрщика строятся в фоне, пока страница распознаётся;
+    до перевода документа в 'done' их нужно дождаться (wait_published(job.assets, ...)).
+    """
+    properties, body = delivery.properties, delivery.body
+    doc_id = None
+
+    try:
+        message = json.loads(body.decode())
+        doc_id = message.get('id')
+        filepath = message.get('filepath').split('/')[-1]
+        logger.info("Received message for document %s (retry %d)", doc_id, get_retry_count(properties))
+
+        # 0. Check file type
+        file_ext = os.path.splitext(filepath)[1].lower()
+
+        if file_ext not in SUPPORTED_FORMATS:
+            raise PermanentError(
+                f"Unsupported file type: {file_ext}. Supported formats are {list(SUPPORTED_FORMATS.keys())}"
+            )
+
+        # 1. Claim the document; duplicates are dropped before any download or GPU work
+        version = claim_document(conn_ref, doc_id)
+        if version is None:
+            logger.info("Document %s is already done or claimed by another worker, skipping", doc_id)
+            delivery.channel.basic_ack(delivery_tag=delivery.method.delivery_tag)
+            return None
+
+        profile = None
+        if profiling:
+            profile = start_profile(doc_id, message, properties)
+        elif profile_requested(message, properties):
+            logger.info("Ignoring profile request for document %s: only WORKER_ROLE=all profiles documents", doc_id)
+
+        # 2. Download file from S3
+        logger.debug("Downloading %s from S3", filepath)
+        with span("s3_download"):
+            response = s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=filepath)
+            file_content = response['Body'].read()
+
+        # 3. Segment the page
+        logger.info("Starting OCR processing for document %s (version %s)", doc_id, version)
+        with timed([profile], "segmentation"):
+            layout = segment_page(file_content, store)
+        # хеш содержимого — ключ артефактов страницы, по нему reprocess.py находит их без скачивания
+        run_in_transaction(conn_ref, lambda cur: cur.execute(
+            "UPDATE documents SET hash = %s WHERE id = %s", (layout.digest, doc_id)))
+        published = assets.submit(doc_id, layout.image) if assets is not None else None
+        layout.image = None
+        return Job(delivery, doc_id, filepath, layout, ProgressReporter(conn_ref, doc_id), profile, published)
+    except Exception as e:
+        handle_failure(delivery, conn_ref, doc_id, e)
+        return None
+
+
+def consume_work_queues(rabbitmq_connection, channel, process_batch, batch_size):
+    """Читает doc_processing* через FairScheduler и отдаёт в process_batch до batch_size документов."""
+    scheduler = FairScheduler(classes=tuple(WORK_QUEUES))
+
+    def enqueue(queue_class, queue):
+        def on_message(ch, method, properties, body):
+            try:
+                message = json.loads(body.decode())
+                tenant = message.get('tenant') or message.get('batch') or 'default'
+            except (ValueError, AttributeError):
+                tenant = 'default'
+            observe_queue_lag(queue, properties)
+            scheduler.push(Delivery(queue_class, queue, ch, method, properties, body, tenant))
+        return on_message
+
+    # prefetch считается на каждого потребителя, поэтому bulk не может занять слоты interactive
+    channel.basic_qos(prefetch_count=max(WORKER_PREFETCH, batch_size))
+    for queue_class, queue in WORK_QUEUES.items():
+        channel.basic_consume(queue=queue, on_message_callback=enqueue(queue_class, queue), auto_ack=False)
+
+    logger.info("Waiting for messages on %s", list(WORK_QUEUES.values()))
+    while True:
+        rabbitmq_connection.process_data_events(time_limit=0 if len(scheduler) else 1)
+        deliveries = []
+        while len(deliveries) < batch_size and len(scheduler):
+            deliveries.append(scheduler.pop())
+        if deliveries:
+            logger.debug("Queue depth: %s", ", ".join(f"{cls}={scheduler.depth(cls)}" for cls in WORK_QUEUES))
+            process_batch(deliveries)
+
+
+def run_all(model, processor):
+    s3_client = get_s3_client()
+    store = get_artifact_store(s3_client)
+    rabbitmq_connection = connect_to_rabbitmq()
+    conn_ref = {"conn": connect_to_postgres()}
+    assets = AssetPublisher(s3_client)
+
+    channel = rabbitmq_connection.channel()
+    declare_topology(channel)
+
+    def process_batch(deliveries):
+        jobs = [job for job in (prepare_document(d, conn_ref, s3_client, store, profiling=True, assets=assets)
+                                for d in deliveries)
+                if job is not None]
+        if not jobs:
+            return
+
+        # 4. Recognize the crops of all pages in shared batches
+        try:
+            # профиль батча общий: в нём и кропы соседних документов
+            with profiled([job.profile for job in jobs], "recognition"):
+                outputs = recognize_layouts([job.layout for job in jobs], model, processor,
+                                            [job.progress for job in jobs], store)
+        except Exception as e:
+            for job in jobs:
+                handle_failure(job.delivery, conn_ref, job.doc_id, e)
+            return
+
+        # 5. Finalize and update to done
+        for job, ocr_result in zip(jobs, outputs):
+            try:
+                with profiled([job.profile], "entities"):
+                    attach_entities(ocr_result, store, job.layout.digest)
+                if job.profile is not None:
+                    ocr_result['result']['profile'] = job.profile.upload(s3_client)
+                # ключи ассетов должны попасть в строку раньше финального статуса
+                wait_published(job.assets, job.doc_id)
+                save_result(conn_ref, s3_client, job.doc_id, ocr_result)
+                logger.info("Finished processing for document %s", job.doc_id)
+                job.delivery.channel.basic_ack(delivery_tag=job.delivery.method.delivery_tag)
+            except Exception as e:
+                handle_failure(job.delivery, conn_ref, job.doc_id, e)
+
+    consume_work_queues(rabbitmq_connection, channel, process_batch, BATCH_DOCS)
+
+
+def publish_json(channel, queue, message, priority=None):
+    channel.basic_publish(exchange='',
+                          routing_key=queue,
+                          body=json.dumps(message).encode(),
+                          properties=pika.BasicProperties(delivery_mode=2, priority=priority,
+                                                          timestamp=int(time.time())))
+
+
+def run_segmenter():
+    s3_client = get_s3_client()
+    store = get_artifact_store(s3_client)
+    rabbitmq_connection = connect_to_rabbitmq()
+    conn_ref = {"conn": connect_to_postgres()}
+    # к записи ассетов документ может быть уже передан конвейеру (hand_over_claim)
+    assets = AssetPublisher(s3_client, owners=(WORKER_ID, SPLIT_PIPELINE_OWNER))
+
+    channel = rabbitmq_connection.channel()
+    declare_topology(channel)
+
+    def save_layout(job, texts=None):
+        """texts — уже известные тексты кропов (артефакт recognition): тогда кропы сразу готовы."""
+        boxes = [(bbox[0][0], bbox[0][1], bbox[2][0], bbox[2][1]) for bbox in job.layout.bboxes]
+
+        def work(cur):
+            cur.execute(
+                """
+                INSERT INTO document_layouts (doc_id, width, height, crop_count) VALUES (%s, %s, %s, %s)
+                ON CONFLICT (doc_id) DO UPDATE SET
+                    width = EXCLUDED.width, height = EXCLUDED.height, crop_count = EXCLUDED.crop_count
+                """,
+                (job.doc_id, job.layout.width, job.layout.height, len(boxes)),
+            )
+            cur.execute("DELETE FROM document_crops WHERE doc_id = %s", (job.doc_id,))
+            if boxes:
+                execute_values(
+                    cur,
+                    "INSERT INTO document_crops (doc_id, crop_index, x0, y0, x1, y1, text) VALUES %s",
+                    [(job.doc_id, index, *box, texts[index] if texts else None) for index, box in enumerate(boxes)],
+                )
+
+        run_in_transaction(conn_ref, work)
+        job.progress.start(len(boxes))
+        if texts:
+            for index, (bbox, text) in enumerate(zip(job.layout.bboxes, texts)):
+                job.progress.add_block(index, build_block(bbox, text))
+            job.progress.finish()
+        # дальше документом владеет конвейер: распознаватели и сборщик пишут от его имени
+        hand_over_claim(conn_ref, job.doc_id, SPLIT_PIPELINE_OWNER, SPLIT_PIPELINE_LEASE_SECONDS)
+        # пока документ в конвейере, аренду продлевает сегментатор: кропы bulk могут часами ждать в очереди
+        pipeline_lease_keeper.track(job.doc_id)
+        return boxes
+
+    def publish_crops(job, boxes, recognized=False):
+        delivery = job.delivery
+        if delivery.queue_class == 'interactive':
+            priority = CROP_MAX_PRIORITY
+        else:
+            priority = (delivery.properties.priority if delivery.properties else None) or 0
+
+        for index, box in enumerate([] if recognized else boxes):
+            publish_json(delivery.channel, CROP_QUEUE, {
+                "id": job.doc_id,
+                "filepath": job.filepath,
+                "index": index,
+                "bbox": list(box),
+                "tenant": delivery.tenant,
+            }, priority)
+        if recognized or not boxes:
+            publish_json(delivery.channel, AGGREGATION_QUEUE, {"id": job.doc_id})
+
+        delivery.channel.basic_ack(delivery_tag=delivery.method.delivery_tag)
+        if recognized:
+            logger.info("Reused recognized text of %d crops for document %s", len(boxes), job.doc_id)
+        else:
+            logger.info("Published %d crops for document %s", len(boxes), job.doc_id)
+
+    def process_batch(deliveries):
+        for delivery in deliveries:
+            job = prepare_document(delivery, conn_ref, s3_client, store, assets=assets)
+            if job is None:
+                continue
+            texts = load_texts(store, job.layout)
+            try:
+                boxes = save_layout(job, texts)
+            except Exception as e:
+                handle_failure(delivery, conn_ref, job.doc_id, e)
+                continue
+            # 'done' пишет сборщик после последнего кропа: до публикации кропов ассеты уже должны быть в строке
+            wait_published(job.assets, job.doc_id)
+            try:
+                publish_crops(job, boxes, recognized=texts is not None)
+            except Exception as e:
+                handle_failure(delivery, conn_ref, job.doc_id, e, owner=SPLIT_PIPELINE_OWNER)
+
+    consume_work_queues(rabbitmq_connection, channel, process_batch, 1)
+
+
+def record_crop_texts(conn_ref, doc_id, items):
+    """
+    Сохраняет тексты кропов страницы и двигает счётчик прогресса.
+    Возвращает True ровно для той транзакции, которая распознала последний кроп страницы.
+    Повторно доставленные кропы (text уже записан) не учитываются. Готовность считается по самим
+    document_crops: document_progress только для показа прогресса, его строки может и не быть.
+    Каждый записанный кроп продлевает аренду конвейера, даже если сегментатор, державший её, перезапущен.
+    """
+    def work(cur):
+        # блокировка строки разметки упорядочивает транзакции страницы: следующая видит кропы предыдущих
+        cur.execute("SELECT crop_count FROM document_layouts WHERE doc_id = %s FOR UPDATE", (doc_id,))
+        layout = cur.fetchone()
+        if layout is None:
+            return False
+        updated = execute_values(
+            cur,
+            "UPDATE document_crops AS c SET text = v.text "
+            "FROM (VALUES %s) AS v(doc_id, crop_index, text) "
+            "WHERE c.doc_id = v.doc_id AND c.crop_index = v.crop_index AND c.text IS NULL "
+            "RETURNING c.crop_index",
+            [(doc_id, index, text) for index, _, text in items],
+            fetch=True,
+        )
+        updated = {row[0] for row in updated}
+        if not updated:
+            return False
+        cur.execute(
+            "UPDATE documents SET lease_until = now() + %s * interval '1 second' WHERE id = %s AND claimed_by = %s",
+            (SPLIT_PIPELINE_LEASE_SECONDS, doc_id, SPLIT_PIPELINE_OWNER),
+        )
+        cur.execute("SELECT count(*) FROM document_crops WHERE doc_id = %s AND text IS NOT NULL", (doc_id,))
+        done, total = cur.fetchone()[0], layout[0]
+
+        blocks = [indexed_block(index, build_block(bbox, text)) for index, bbox, text in items if index in updated]
+        cur.execute(
+            """
+            UPDATE document_progress
+            SET done = %s, total = %s, blocks = blocks || %s::jsonb, updated_at = now()
+            WHERE doc_id = %s
+            """,
+            (done, total, json.dumps(blocks), doc_id),
+        )
+        cur.execute("SELECT pg_notify(%s, %s)", (STATUS_CHANNEL, json.dumps({
+            "id": doc_id, "status": "processing", "progress": {"done": done, "total": total},
+        })))
+        return done >= total
+
+    return run_in_transaction(conn_ref, work)
+
+
+def run_recognizer(model, processor):
+    from vlm import GenerationScheduler
+
+    s3_client = get_s3_client()
+    rabbitmq_connection = connect_to_rabbitmq()
+    conn_ref = {"conn": connect_to_postgres()}
+
+    channel = rabbitmq_connection.channel()
+    declare_topology(channel)
+
+    scheduler = GenerationScheduler(model, processor, batch_size=VLM_BATCH_SIZE)
+    images = OrderedDict()
+
+    def load_image(filepath):
+        if filepath in images:
+            images.move_to_end(filepath)
+            return images[filepath]
+        with span("s3_download"):
+            response = s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=filepath)
+            img = Image.open(io.BytesIO(response['Body'].read()))
+            img.load()
+        images[filepath] = img
+        if len(images) > IMAGE_CACHE_SIZE:
+            images.popitem(last=False)
+        return img
+
+    def recognize_crops(deliveries):
+        prepared = []
+        for delivery in deliveries:
+            doc_id = None
+            try:
+                message = json.loads(delivery.body.decode())
+                doc_id = message['id']
+                x0, y0, x1, y1 = message['bbox']
+                crop = load_image(message['filepath']).crop((x0, y0, x1, y1))
+                prepared.append((delivery, doc_id, message['index'], bbox_corners([(x0, y0), (x1, y1)]), crop))
+            except Exception as e:
+                handle_failure(delivery, conn_ref, doc_id, e, owner=SPLIT_PIPELINE_OWNER, requeue_document=False)
+
+        if not prepared:
+            return
+
+        try:
+            texts = scheduler.run([item[4] for item in prepared])
+        except Exception as e:
+            for delivery, doc_id, *_ in prepared:
+                handle_failure(delivery, conn_ref, doc_id, e, owner=SPLIT_PIPELINE_OWNER, requeue_document=False)
+            return
+
+        by_doc = OrderedDict()
+        for (delivery, doc_id, index, bbox, _), text in zip(prepared, texts):
+            by_doc.setdefault(doc_id, []).append((delivery, index, bbox, text))
+
+        for doc_id, entries in by_doc.items():
+            try:
+                if record_crop_texts(conn_ref, doc_id, [(index, bbox, text) for _, index, bbox, text in entries]):
+                    publish_json(channel, AGGREGATION_QUEUE, {"id": doc_id})
+                for delivery, *_ in entries:
+                    delivery.channel.basic_ack(delivery_tag=delivery.method.delivery_tag)
+            except Exception as e:
+                for delivery, *_ in entries:
+                    handle_failure(delivery, conn_ref, doc_id, e, owner=SPLIT_PIPELINE_OWNER, requeue_document=False)
+
+    pending = []
+    first_at = 0.0
+
+    def on_message(ch, method, properties, body):
+        nonlocal first_at
+        if not pending:
+            first_at = time.monotonic()
+        observe_queue_lag(CROP_QUEUE, properties)
+        pending.append(Delivery("crop", CROP_QUEUE, ch, method, properties, body, "default"))
+
+    # батч растёт вместе с бюджетом планировщика, prefetch — с запасом до его потолка
+    channel.basic_qos(prefetch_count=2 * scheduler.max_batch)
+    channel.basic_consume(queue=CROP_QUEUE, on_message_callback=on_message, auto_ack=False)
+
+    logger.info("Waiting for crops on %s", CROP_QUEUE)
+    while True:
+        rabbitmq_connection.process_data_events(time_limit=0.05 if pending else 1)
+        limit = scheduler.batch_limit
+        if pending and (len(pending) >= limit or time.monotonic() - first_at >= CROP_BATCH_WAIT_SECONDS):
+            batch, pending[:] = pending[:limit], pending[limit:]
+            first_at = time.monotonic()
+            recognize_crops(batch)
+
+
+def run_aggregator():
+    s3_client = get_s3_client()
+    store = get_artifact_store(s3_client)
+    rabbitmq_connection = connect_to_rabbitmq()
+    conn_ref = {"conn": connect_to_postgres()}
+
+    channel = rabbitmq_connection.channel()
+    declare_topology(channel)
+
+    def load_crops(cur, doc_id):
+        cur.execute(
+            "SELECT l.width, l.height, d.hash FROM document_layouts l JOIN documents d ON d.id = l.doc_id "
+            "WHERE l.doc_id = %s",
+            (doc_id,),
+        )
+        layout = cur.fetchone()
+        cur.execute(
+            "SELECT x0, y0, x1, y1, text FROM document_crops WHERE doc_id = %s ORDER BY crop_index",
+            (doc_id,),
+        )
+        return layout, cur.fetchall()
+
+    def callback(ch, method, properties, body):
+        delivery = Delivery("aggregation", AGGREGATION_QUEUE, ch, method, properties, body, "default")
+        observe_queue_lag(AGGREGATION_QUEUE, properties)
+        doc_id = None
+        try:
+            doc_id = json.loads(body.decode())['id']
+            layout, crops = run_in_transaction(conn_ref, lambda cur: load_crops(cur, doc_id))
+            if layout is None or any(text is None for *_, text in crops):
+                # устаревшее сообщение: страница пересегментирована или уже собрана
+                logger.info("Skipping aggregation for document %s: crops are not complete", doc_id)
+                ch.basic_ack(delivery_tag=method.delivery_tag)
+                return
+
+            width, height, digest = layout
+            texts = [text for *_, text in crops]
+            page = PageLayout(width, height, [bbox_corners([(x0, y0), (x1, y1)]) for x0, y0, x1, y1, _ in crops], [],
+                              digest=digest if is_content_hash(digest) else None)
+            if store is not None and page.digest is not None:
+                store.save(page.digest, "recognition", {"texts": texts})
+            ocr_result = attach_entities(build_output(page, texts), store, page.digest)
+            save_result(conn_ref, s3_client, doc_id, ocr_result, owner=SPLIT_PIPELINE_OWNER)
+            run_in_transaction(conn_ref, lambda cur: cur.execute(
+                "DELETE FROM document_layouts WHERE doc_id = %s; DELETE FROM document_crops WHERE doc_id = %s",
+                (doc_id, doc_id),
+            ))
+            logger.info("Finished processing for document %s", doc_id)
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+        except Exception as e:
+            handle_failure(delivery, conn_ref, doc_id, e, owner=SPLIT_PIPELINE_OWNER, requeue_document=False)
+
+    channel.basic_qos(prefetch_count=1)
+    channel.basic_consume(queue=AGGREGATION_QUEUE, on_message_callback=callback, auto_ack=False)
+
+    logger.info("Waiting for pages on %s", AGGREGATION_QUEUE)
+    channel.start_consuming()
@@ -0,0 +1,39 @@
+import os
+import sys
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def pg_schema(monkeypatch):
+    """
+    Временная схема в PostgreSQL из POSTGRES_*: соединения connect_to_postgres видят её через
+    search_path. Без доступной базы тест пропускается.
+    """
+    psycopg2 = pytest.importorskip("psycopg2")
+    env = {"POSTGRES_DB": "db", "POSTGRES_USER": "user", "POSTGRES_PASSWORD": "password",
+           "POSTGRES_HOST": "localhost", "POSTGRES_PORT": "5432"}
+    env = {name: os.getenv(name, default) for name, default in env.items()}
+    try:
+        admin = psycopg2.connect(dbname=env["POSTGRES_DB"], user=env["POSTGRES_USER"],
+                                 password=env["POSTGRES_PASSWORD"], host=env["POSTGRES_HOST"],
+                                 port=int(env["POSTGRES_PORT"]), connect_timeout=2)
+    except psycopg2.OperationalError as e:
+        pytest.skip(f"PostgreSQL is unavailable: {e}")
+    admin.autocommit = True
+    schema = f"test_{uuid.uuid4().hex[:12]}"
+    with admin.cursor() as cur:
+        cur.execute(f"CREATE SCHEMA {schema}")
+        cur.execute(f"SET search_path TO {schema}")
+    for name, value in env.items():
+        monkeypatch.setenv(name, value)
+    monkeypatch.setenv("PGOPTIONS", f"-c search_path={schema}")
+    try:
+        yield admin
+    finally:
+        with admin.cursor() as cur:
+            cur.execute(f"DROP SCHEMA {schema} CASCADE")
+        admin.close()
@@ -0,0 +1,52 @@
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+artifacts = pytest.importorskip("artifacts")
+
+MLWORKER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def weights(tmp_path):
+    model, lora = tmp_path / "gemma-3-4b-it", tmp_path / "checkpoint-200"
+    model.mkdir()
+    lora.mkdir()
+    (lora / "adapter_model.safetensors").write_bytes(b"v1")
+    (lora / "adapter_config.json").write_text("{}")
+    return str(model), lora
+
+
+def test_recognition_version_follows_the_adapter_contents(weights, tmp_path):
+    model, lora = weights
+    first = artifacts.recognition_version(model, str(lora))
+    assert first.startswith("gemma-3-4b-it+checkpoint-200-")
+
+    # та же LoRA на другом узле: другой путь и mtime, та же версия
+    copy = tmp_path / "node2" / "checkpoint-200"
+    shutil.copytree(lora, copy)
+    os.utime(copy / "adapter_model.safetensors", ns=(1, 1))
+    assert artifacts.recognition_version(model, str(copy)) == first
+
+    # переобученный адаптер в той же папке
+    (lora / "adapter_model.safetensors").write_bytes(b"v2")
+    assert artifacts.recognition_version(model, str(lora)) != first
+
+
+def test_recognition_version_without_adapter_files(weights, tmp_path):
+    model, _ = weights
+    assert artifacts.recognition_version(model, None).startswith("gemma-3-4b-it+base+")
+    missing = str(tmp_path / "checkpoint-300")
+    assert artifacts.recognition_version(model, missing).startswith("gemma-3-4b-it+checkpoint-300+")
+
+
+def test_roles_without_model_do_not_import_torch():
+    # None в sys.modules — модуль как будто не установлен: import падает, find_spec возвращает None
+    code = ("import sys\n"
+            "for name in ('torch', 'transformers', 'peft', 'vlm'):\n"
+            "    sys.modules[name] = None\n"
+            "import main, services, artifacts, pipeline\n")
+    subprocess.run([sys.executable, "-c", code], cwd=MLWORKER_DIR, check=True)
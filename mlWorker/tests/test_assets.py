@@ -0,0 +1,59 @@
+import pytest
+
+assets = pytest.importorskip("assets")
+
+from PIL import Image  # noqa: E402
+
+
+class PutOnlyS3:
+    def __init__(self):
+        self.keys = []
+
+    def put_object(self, Bucket, Key, Body, ContentType):
+        self.keys.append(Key)
+
+
+@pytest.fixture
+def documents(pg_schema):
+    with pg_schema.cursor() as cur:
+        cur.execute("CREATE TABLE documents (id text PRIMARY KEY, claimed_by text, assets jsonb)")
+        cur.execute("INSERT INTO documents VALUES ('mine', %s, NULL), ('free', NULL, NULL), ('taken', 'other', NULL)",
+                    (assets.WORKER_ID,))
+    return pg_schema
+
+
+def stored_assets(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT id, assets IS NOT NULL FROM documents ORDER BY id")
+        return dict(cur.fetchall())
+
+
+def test_background_publisher_respects_the_owner(documents):
+    s3 = PutOnlyS3()
+    publisher = assets.AssetPublisher(s3, max_pending=1)
+    page = Image.new("RGB", (600, 300), "white")
+    futures = [publisher.submit(doc_id, page) for doc_id in ("mine", "free", "taken")]
+
+    results = [future.result(timeout=30) for future in futures]
+    assert results[0]["tiles"] > 0 and results[1] is not None and results[2] is None
+    assert stored_assets(documents) == {"free": True, "mine": True, "taken": False}
+    assert "assets/mine/tiles.dzi" in s3.keys
+
+
+def test_wait_published_returns_once_the_keys_are_stored(documents):
+    publisher = assets.AssetPublisher(PutOnlyS3(), max_pending=1)
+    future = publisher.submit("mine", Image.new("RGB", (600, 300), "white"))
+
+    # так вызывается перед 'done': строка уже содержит ключи, когда статус станет финальным
+    published = assets.wait_published(future, "mine")
+    assert published["dzi"] == "assets/mine/tiles.dzi"
+    assert stored_assets(documents)["mine"] is True
+
+
+def test_wait_published_gives_up_after_the_timeout(caplog):
+    from concurrent.futures import Future
+
+    assert assets.wait_published(None, "doc") is None
+    with caplog.at_level("WARNING", logger="assets"):
+        assert assets.wait_published(Future(), "doc", timeout=0.01) is None
+    assert "not ready" in caplog.text
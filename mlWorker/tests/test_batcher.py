@@ -0,0 +1,55 @@
+import pytest
+
+vlm = pytest.importorskip("vlm")
+
+from PIL import Image  # noqa: E402
+
+from batcher import CropBatcher  # noqa: E402
+
+
+@pytest.fixture
+def generate(monkeypatch):
+    """predict_batch, который отвечает именем кропа и запоминает размеры вызовов."""
+    monkeypatch.setattr(vlm, "_device_budgets", {})
+    monkeypatch.setattr(vlm.GenerationScheduler, "_prompt_tokens", lambda self: 10)
+    calls = []
+
+    def predict_batch(model, processor, images, *args):
+        calls.append([image.info["name"] for image in images])
+        return [image.info["name"] for image in images]
+
+    monkeypatch.setattr(vlm, "predict_batch", predict_batch)
+    return calls
+
+
+def page_crops(page, sizes):
+    crops = []
+    for index, width in enumerate(sizes):
+        crop = Image.new("L", (width, 20))
+        crop.info["name"] = f"{page}/{index}"
+        crops.append(crop)
+    return crops
+
+
+def test_crops_of_several_pages_share_batches(generate):
+    batcher = CropBatcher(object(), None, batch_size=4)
+    seen = []
+    batcher.add("a", page_crops("a", [50, 300]), lambda index, text: seen.append(("a", index, text)))
+    batcher.add("empty", [])
+    batcher.add("b", page_crops("b", [200, 10, 100]), lambda index, text: seen.append(("b", index, text)))
+
+    texts = batcher.run()
+
+    # общие батчи по 4 кропа из обеих страниц, крупные кропы — вместе
+    assert generate == [["a/1", "b/0", "b/2", "a/0"], ["b/1"]]
+    assert texts == {"a": ["a/0", "a/1"], "empty": [], "b": ["b/0", "b/1", "b/2"]}
+    assert sorted(seen) == [("a", 0, "a/0"), ("a", 1, "a/1"), ("b", 0, "b/0"), ("b", 1, "b/1"), ("b", 2, "b/2")]
+    # батчер готов к следующей группе страниц
+    assert batcher.run() == {}
+
+
+def test_pages_without_crops_do_not_touch_the_model(generate):
+    batcher = CropBatcher(None, None)
+    batcher.add("a", [])
+    assert batcher.run() == {"a": []}
+    assert generate == []
@@ -0,0 +1,91 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+bulk = pytest.importorskip("bulk")
+
+MLWORKER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def write_checkpoint(output_dir, lines):
+    with open(os.path.join(output_dir, bulk.CHECKPOINT_FILE), "w", encoding="utf-8") as f:
+        f.writelines(f"{page_id}\t{status}\n" for page_id, status in lines)
+
+
+def test_load_checkpoint(tmp_path):
+    assert bulk.load_checkpoint(str(tmp_path), retry_failed=False) == set()
+    write_checkpoint(tmp_path, [("a.png", "ok"), ("dir\tb.png", "fail"), ("c.png", "fail"), ("c.png", "ok")])
+    assert bulk.load_checkpoint(str(tmp_path), retry_failed=False) == {"a.png", "dir\tb.png", "c.png"}
+    # страница, упавшая в первый раз и готовая после --retry-failed, больше не берётся
+    assert bulk.load_checkpoint(str(tmp_path), retry_failed=True) == {"a.png", "c.png"}
+
+
+def test_failures_go_to_their_own_shards(tmp_path):
+    output = str(tmp_path)
+    results = bulk.ShardWriter(output, 2, "jsonl")
+    failures = bulk.ShardWriter(output, 2, "jsonl", prefix="failed")
+    results.add({"id": "a", "path": "a.png", "result": {}})
+    failures.add({"id": "b", "path": "b.png", "error": "OSError: truncated"})
+    results.flush()
+    failures.flush()
+
+    assert sorted(os.listdir(output)) == [bulk.CHECKPOINT_FILE, "failed-00000.jsonl", "results-00000.jsonl"]
+    with open(tmp_path / "failed-00000.jsonl", encoding="utf-8") as f:
+        assert [json.loads(line)["id"] for line in f] == ["b"]
+    assert bulk.ShardWriter(output, 2, "jsonl").next_shard == 1
+    assert bulk.load_checkpoint(output, retry_failed=True) == {"a"}
+
+
+def test_shard_written_before_a_crash_is_recovered(tmp_path, monkeypatch):
+    output = str(tmp_path)
+    results = bulk.ShardWriter(output, 2, "jsonl")
+    results.add({"id": "a", "path": "a.png", "result": {}})
+    results.flush()
+    write_checkpoint(output, [("a", "ok"), ("b", "fail")])
+
+    def crash(output_dir, entries):
+        raise KeyboardInterrupt
+
+    # шард переименован, а до чекпоинта процесс не дошёл
+    monkeypatch.setattr(bulk, "append_checkpoint", crash)
+    with pytest.raises(KeyboardInterrupt):
+        results.add({"id": "b", "path": "b.png", "result": {}})
+        results.add({"id": "c", "path": "c.png", "result": {}})
+    monkeypatch.undo()
+
+    assert bulk.load_checkpoint(output, retry_failed=True) == {"a"}
+    assert bulk.recover_checkpoint(output) == 2
+    # b упала в прошлый раз, но успела записаться после --retry-failed
+    assert bulk.load_checkpoint(output, retry_failed=True) == {"a", "b", "c"}
+    assert bulk.recover_checkpoint(output) == 0
+
+
+def test_failed_pages_already_in_the_checkpoint_are_not_recovered(tmp_path):
+    output = str(tmp_path)
+    failures = bulk.ShardWriter(output, 10, "jsonl", prefix="failed")
+    failures.add({"id": "a", "path": "a.png", "error": "OSError"})
+    failures.flush()
+    # страница упала, потом пересчитана после --retry-failed
+    bulk.append_checkpoint(output, [("a", "ok")])
+    assert bulk.recover_checkpoint(output) == 0
+    assert bulk.read_checkpoint(output) == {"a": "ok"}
+
+
+def test_torn_checkpoint_line_is_ignored(tmp_path):
+    with open(tmp_path / bulk.CHECKPOINT_FILE, "w", encoding="utf-8") as f:
+        f.write("a\tok\nb\to")
+    assert bulk.read_checkpoint(str(tmp_path)) == {"a": "ok"}
+    bulk.append_checkpoint(str(tmp_path), [("b", "ok")])
+    assert bulk.read_checkpoint(str(tmp_path)) == {"a": "ok", "b": "ok"}
+
+
+def test_import_does_not_need_service_dependencies():
+    # None в sys.modules — модуль как будто не установлен: import падает, find_spec возвращает None
+    code = ("import sys\n"
+            "for name in ('pika', 'boto3', 'botocore', 'psycopg2'):\n"
+            "    sys.modules[name] = None\n"
+            "import bulk\n")
+    subprocess.run([sys.executable, "-c", code], cwd=MLWORKER_DIR, check=True)
@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+import crop_filter
+from crop_filter import classify_crop, filter_polygons
+
+INK = 128
+
+
+def page(height=100, width=300):
+    return np.full((height, width), 240, dtype=np.uint8)
+
+
+def text(gray, rows=((20, 30), (50, 60), (80, 90))):
+    """Строки «букв»: много отдельных компонент, как у настоящего текста."""
+    for y0, y1 in rows:
+        for x in range(10, gray.shape[1] - 10, 9):
+            gray[y0:y1, x:x + 5] = 20
+    return gray
+
+
+def test_text_is_kept():
+    assert classify_crop(text(page()), INK) is None
+
+
+def test_blank_crop():
+    assert classify_crop(page(), INK) == "blank"
+    assert classify_crop(page()[:0], INK) == "blank"
+
+
+def test_stain():
+    gray = page()
+    gray[20:80, 100:200] = 10
+    gray[5:7, 10:14] = 10
+    assert classify_crop(gray, INK) == "stain"
+
+
+def test_form_rule():
+    gray = page()
+    gray[60:63, 5:295] = 30
+    assert classify_crop(gray, INK) == "line"
+
+
+def test_scan_dust():
+    gray = page()
+    for x in range(20, 280, 10):
+        gray[50:53, x:x + 3] = 0
+    assert classify_crop(gray, INK) == "noise"
+
+
+def test_handwritten_word_in_a_paragraph_is_text():
+    gray = text(page(), rows=((20, 30), (50, 60)))
+    gray[75:90, 40:260] = 20
+    gray[80:85, 60:240] = 240
+    assert classify_crop(gray, INK) is None
+
+
+def test_without_scipy_only_density_is_checked(monkeypatch):
+    monkeypatch.setattr(crop_filter, "ndimage", None)
+    gray = page()
+    gray[60:63, 5:295] = 30
+    assert classify_crop(gray, INK) is None
+    gray[:, :250] = 10
+    assert classify_crop(gray, INK) == "stain"
+
+
+@pytest.mark.parametrize("mode, kept", [("skip", 1), ("report", 2), ("off", 2)])
+def test_filter_polygons_modes(mode, kept):
+    gray = np.concatenate([text(page()), page()], axis=0)
+    polygons = [[[0, 0], [300, 0], [300, 100], [0, 100]], [[0, 100], [300, 100], [300, 200], [0, 200]]]
+    result, skipped = filter_polygons(polygons, gray, mode=mode)
+    assert len(result) == kept
+    assert skipped == ({} if mode == "off" else {"blank": 1})
@@ -0,0 +1,81 @@
+import threading
+
+import pytest
+
+services = pytest.importorskip("services")
+
+from infra import connect_to_postgres  # noqa: E402
+from utils import bbox_corners  # noqa: E402
+
+BBOX = bbox_corners([(0, 0), (10, 5)])
+
+
+@pytest.fixture
+def page(pg_schema):
+    """Страница из трёх кропов раздельного конвейера."""
+    with pg_schema.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE documents (id text PRIMARY KEY, claimed_by text, lease_until timestamptz);
+            INSERT INTO documents VALUES ('doc', %s, now());
+            CREATE TABLE document_layouts (doc_id text PRIMARY KEY, width int, height int, crop_count int);
+            CREATE TABLE document_crops (doc_id text, crop_index int, x0 int, y0 int, x1 int, y1 int, text text,
+                                         PRIMARY KEY (doc_id, crop_index));
+            CREATE TABLE document_progress (doc_id text PRIMARY KEY, done int, total int, blocks jsonb,
+                                            updated_at timestamptz);
+            INSERT INTO document_layouts VALUES ('doc', 10, 15, 3);
+            INSERT INTO document_crops SELECT 'doc', i, 0, 5 * i, 10, 5 * i + 5, NULL FROM generate_series(0, 2) i;
+        """, (services.SPLIT_PIPELINE_OWNER,))
+    return pg_schema
+
+
+def record(conn_ref, *indexes):
+    return services.record_crop_texts(conn_ref, "doc", [(index, BBOX, f"text {index}") for index in indexes])
+
+
+def test_streamed_blocks_carry_their_crop_index(page):
+    with page.cursor() as cur:
+        cur.execute("INSERT INTO document_progress VALUES ('doc', 0, 3, '[]', now())")
+    conn_ref = {"conn": connect_to_postgres()}
+    record(conn_ref, 2)
+    record(conn_ref, 0, 1)
+    with page.cursor() as cur:
+        cur.execute("SELECT done, blocks FROM document_progress WHERE doc_id = 'doc'")
+        done, blocks = cur.fetchone()
+    assert done == 3
+    assert [block["cropIndex"] for block in blocks] == [2, 0, 1]
+
+
+def test_last_crop_completes_the_page_without_progress_row(page):
+    conn_ref = {"conn": connect_to_postgres()}
+    assert not record(conn_ref, 0, 1)
+    assert not record(conn_ref, 1)
+    assert record(conn_ref, 2)
+    # повторная доставка последнего кропа не собирает страницу второй раз
+    assert not record(conn_ref, 2)
+
+
+def test_recorded_crop_renews_the_pipeline_lease(page):
+    conn_ref = {"conn": connect_to_postgres()}
+    record(conn_ref, 0)
+    with page.cursor() as cur:
+        cur.execute("SELECT lease_until - now() FROM documents WHERE id = 'doc'")
+        assert cur.fetchone()[0].total_seconds() > services.SPLIT_PIPELINE_LEASE_SECONDS - 60
+
+
+def test_concurrent_last_crops_complete_the_page_once(page):
+    with page.cursor() as cur:
+        cur.execute("UPDATE document_crops SET text = 'done' WHERE crop_index = 0")
+    results = []
+    barrier = threading.Barrier(2)
+
+    def recognizer(index):
+        conn_ref = {"conn": connect_to_postgres()}
+        barrier.wait()
+        results.append(record(conn_ref, index))
+
+    threads = [threading.Thread(target=recognizer, args=(index,)) for index in (1, 2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(results) == [False, True]
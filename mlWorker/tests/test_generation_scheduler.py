@@ -0,0 +1,90 @@
+import pytest
+
+vlm = pytest.importorskip("vlm")
+
+from PIL import Image  # noqa: E402
+
+ITEM_TOKENS = 10 + 128
+
+
+class FakeDevice:
+    """predict_batch с памятью на capacity кропов; сверх неё — OOM, как у CUDA."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.calls = []
+
+    def __call__(self, model, processor, images, instruction, max_new_tokens, temperature, top_p):
+        self.calls.append(len(images))
+        if len(images) > self.capacity:
+            raise RuntimeError("CUDA out of memory. Tried to allocate 2.00 GiB")
+        return [image.info["name"] for image in images]
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    monkeypatch.setattr(vlm, "_device_budgets", {})
+    monkeypatch.setattr(vlm.GenerationScheduler, "_prompt_tokens", lambda self: 10)
+
+    def make(capacity, batch_size=8, max_batch=64):
+        device = FakeDevice(capacity)
+        monkeypatch.setattr(vlm, "predict_batch", device)
+        return vlm.GenerationScheduler(object(), None, batch_size=batch_size, max_batch=max_batch), device
+
+    return make
+
+
+def crops(count):
+    images = []
+    for index in range(count):
+        image = Image.new("RGB", (100 + index, 50))
+        image.info["name"] = f"crop {index}"
+        images.append(image)
+    return images
+
+
+def test_oom_halves_the_batch_and_keeps_the_order(scheduler):
+    generation, device = scheduler(capacity=3)
+    seen = []
+    texts = generation.run(crops(8), on_result=lambda index, text: seen.append(index))
+
+    assert texts == [f"crop {index}" for index in range(8)]
+    assert sorted(seen) == list(range(8))
+    # 8 не влезло, первая половина 4 тоже; вторая сразу идёт по новому бюджету, без лишнего OOM
+    assert device.calls == [8, 4, 2, 2, 2, 2]
+    assert generation.budget.ceiling == 4 * ITEM_TOKENS
+    assert generation.batch_limit == 2
+
+
+def test_budget_is_shared_by_schedulers_of_a_device(scheduler):
+    first, _ = scheduler(capacity=3)
+    first.run(crops(8))
+    second, device = scheduler(capacity=3)
+    second.run(crops(4))
+    assert device.calls == [2, 2]
+
+
+def test_budget_grows_back_below_the_failed_size(scheduler, monkeypatch):
+    monkeypatch.setattr(vlm, "BUDGET_GROW_AFTER", 2)
+    generation, device = scheduler(capacity=3)
+    generation.run(crops(8))
+    generation.run(crops(12))
+    assert generation.batch_limit == 3
+    generation.run(crops(30))
+    # 4 кропа уже падали: выше 3 бюджет не растёт
+    assert generation.batch_limit == 3 and max(device.calls[-5:]) == 3
+
+
+def test_single_crop_oom_and_other_errors_propagate(scheduler, monkeypatch):
+    generation, _ = scheduler(capacity=0)
+    with pytest.raises(RuntimeError, match="out of memory"):
+        generation.run(crops(2))
+
+    generation, device = scheduler(capacity=8)
+
+    def broken(*args):
+        raise ValueError("bad image")
+
+    monkeypatch.setattr(vlm, "predict_batch", broken)
+    with pytest.raises(ValueError):
+        generation.run(crops(2))
@@ -0,0 +1,81 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+infra = pytest.importorskip("infra")
+pika = pytest.importorskip("pika")
+
+from queues import CROP_QUEUE, RETRY_DELAYS_SECONDS, RETRY_HEADER  # noqa: E402
+from scheduler import Delivery  # noqa: E402
+
+
+class FakeChannel:
+    def __init__(self):
+        self.published = []
+        self.acked = []
+        self.rejected = []
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        self.published.append(routing_key)
+
+    def basic_ack(self, delivery_tag):
+        self.acked.append(delivery_tag)
+
+    def basic_reject(self, delivery_tag, requeue):
+        self.rejected.append(delivery_tag)
+
+
+@pytest.fixture
+def pipeline_doc(pg_schema):
+    """Документ, переданный раздельному конвейеру."""
+    with pg_schema.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE documents (id text PRIMARY KEY, status text, result jsonb, claimed_by text,
+                                    lease_until timestamptz, version bigint NOT NULL DEFAULT 0);
+            INSERT INTO documents VALUES ('doc', 'processing', NULL, %s, now() + interval '1 hour', 3);
+            CREATE TABLE document_progress (doc_id text PRIMARY KEY);
+        """, (infra.SPLIT_PIPELINE_OWNER,))
+    return pg_schema
+
+
+def crop_delivery(channel, retries=0):
+    properties = pika.BasicProperties(headers={RETRY_HEADER: retries})
+    body = json.dumps({"id": "doc", "index": 0}).encode()
+    return Delivery("crop", CROP_QUEUE, channel, SimpleNamespace(delivery_tag=7), properties, body, "default")
+
+
+def document(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT status, claimed_by, result FROM documents WHERE id = 'doc'")
+        return cur.fetchone()
+
+
+def test_crop_retry_leaves_the_document_alone(pipeline_doc):
+    channel = FakeChannel()
+    conn_ref = {"conn": infra.connect_to_postgres()}
+    infra.handle_failure(crop_delivery(channel), conn_ref, "doc", RuntimeError("S3 timeout"),
+                         owner=infra.SPLIT_PIPELINE_OWNER, requeue_document=False)
+
+    assert len(channel.published) == 1 and channel.acked == [7]
+    assert document(pipeline_doc) == ("processing", infra.SPLIT_PIPELINE_OWNER, None)
+
+
+def test_exhausted_crop_fails_the_document(pipeline_doc):
+    channel = FakeChannel()
+    conn_ref = {"conn": infra.connect_to_postgres()}
+    infra.handle_failure(crop_delivery(channel, retries=len(RETRY_DELAYS_SECONDS)), conn_ref, "doc",
+                         RuntimeError("S3 timeout"), owner=infra.SPLIT_PIPELINE_OWNER, requeue_document=False)
+
+    assert channel.published == [] and channel.rejected == [7]
+    status, claimed_by, result = document(pipeline_doc)
+    assert (status, claimed_by, result) == ("fail", None, {"error": "S3 timeout"})
+
+
+def test_document_retry_returns_it_to_the_queue(pipeline_doc):
+    channel = FakeChannel()
+    conn_ref = {"conn": infra.connect_to_postgres()}
+    infra.handle_failure(crop_delivery(channel), conn_ref, "doc", RuntimeError("S3 timeout"),
+                         owner=infra.SPLIT_PIPELINE_OWNER)
+
+    assert document(pipeline_doc) == ("in-queue", None, None)
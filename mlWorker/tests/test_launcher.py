@@ -0,0 +1,28 @@
+import os
+import sys
+import types
+
+import launcher
+import metrics
+import vlm
+
+
+def test_forked_workers_serve_metrics_on_their_own_ports(monkeypatch):
+    # как при WORKER_SHARE_MODEL=1: metrics уже импортирован в лаунчере до fork
+    monkeypatch.delenv("WORKER_INDEX", raising=False)
+    monkeypatch.setattr(vlm, "configure_cpu_threads", lambda: None)
+    read_fd, write_fd = os.pipe()
+
+    def fake_main(model, processor):
+        os.write(write_fd, f"{metrics.metrics_port()}\n".encode())
+
+    monkeypatch.setitem(sys.modules, "main", types.SimpleNamespace(main=fake_main))
+
+    workers = [launcher.fork_worker(index, "cpu", 2, None, None) for index in range(2)]
+    assert [worker.wait() for worker in workers] == [0, 0]
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        ports = sorted(int(line) for line in f)
+
+    assert ports == [metrics.METRICS_PORT, metrics.METRICS_PORT + 1]
+    assert metrics.metrics_port() == metrics.METRICS_PORT
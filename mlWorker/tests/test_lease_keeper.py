@@ -0,0 +1,78 @@
+import time
+
+import pytest
+
+infra = pytest.importorskip("infra")
+
+
+@pytest.fixture
+def claimed(pg_schema):
+    with pg_schema.cursor() as cur:
+        cur.execute("CREATE TABLE documents (id text PRIMARY KEY, claimed_by text, lease_until timestamptz)")
+        cur.execute("INSERT INTO documents VALUES ('doc', %s, NULL)", (infra.WORKER_ID,))
+    return pg_schema
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def lease_extended(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT lease_until IS NOT NULL FROM documents WHERE id = 'doc'")
+        return cur.fetchone()[0]
+
+
+def test_failed_connect_is_retried(claimed, monkeypatch):
+    connect = infra.connect_to_postgres
+    attempts = []
+
+    def flaky_connect():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise RuntimeError("connection refused")
+        return connect()
+
+    monkeypatch.setattr(infra, "connect_to_postgres", flaky_connect)
+    keeper = infra.LeaseKeeper(lease_seconds=0.3)
+    keeper.track("doc")
+    assert wait_for(lambda: lease_extended(claimed))
+    assert len(attempts) == 2
+    assert keeper._thread is not None
+    # поток живёт дольше временной схемы; без документов он больше не ходит в базу
+    with keeper._lock:
+        keeper._doc_ids.clear()
+
+
+def test_dead_thread_is_restarted(monkeypatch):
+    keeper = infra.LeaseKeeper(lease_seconds=0.3)
+    runs = []
+
+    def crash():
+        runs.append(1)
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(keeper, "_heartbeat", crash)
+    keeper.track("a")
+    assert wait_for(lambda: keeper._thread is None)
+    keeper.track("b")
+    assert wait_for(lambda: len(runs) == 2 and keeper._thread is None)
+
+
+def test_pipeline_keeper_renews_only_pipeline_documents(claimed):
+    with claimed.cursor() as cur:
+        cur.execute("INSERT INTO documents VALUES ('pipeline', %s, NULL)", (infra.SPLIT_PIPELINE_OWNER,))
+    keeper = infra.LeaseKeeper(lease_seconds=0.3, owner=infra.SPLIT_PIPELINE_OWNER)
+    keeper.track("doc")
+    keeper.track("pipeline")
+    assert wait_for(lambda: keeper._doc_ids == {"pipeline"})
+    with claimed.cursor() as cur:
+        cur.execute("SELECT id FROM documents WHERE lease_until IS NOT NULL")
+        assert cur.fetchall() == [("pipeline",)]
+    with keeper._lock:
+        keeper._doc_ids.clear()
@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+
+from make_paragraph import dedupe_paragraph_polygons, split_polygon_by_profile, split_wide_lines
+
+
+def line_with_words(width, words, height=40):
+    """Маска чернил с одной строкой y 10..30; words — [(x0, x1)] залитых участков."""
+    ink = np.zeros((height, width), dtype=bool)
+    for x0, x1 in words:
+        ink[12:28, x0:x1] = True
+    return ink, [[0, 10], [width - 1, 10], [width - 1, 30], [0, 30]]
+
+
+def x_range(poly):
+    xs = [x for x, _ in poly]
+    return min(xs), max(xs)
+
+
+def test_long_line_is_cut_inside_the_ink_gap():
+    ink, poly = line_with_words(2000, [(5, 900), (1000, 1995)])
+    parts = split_polygon_by_profile(poly, ink, L=1000, gap=50)
+    assert len(parts) == 2
+    (_, left_end), (right_start, _) = sorted(x_range(part) for part in parts)
+    assert 900 <= left_end <= right_start <= 1000
+
+
+def test_parts_are_split_again_until_short():
+    ink, poly = line_with_words(2100, [(5, 600), (700, 1300), (1400, 2095)])
+    parts = split_polygon_by_profile(poly, ink, L=800, gap=50)
+    assert len(parts) == 3
+
+
+@pytest.mark.parametrize("words", [
+    [(5, 1995)],                 # сплошной текст: резать негде
+    [(5, 960), (990, 1995)],     # пробел уже gap
+    [(300, 1700)],               # пустые только поля у концов строки
+])
+def test_line_without_a_real_gap_stays_whole(words):
+    ink, poly = line_with_words(2000, words)
+    assert split_polygon_by_profile(poly, ink, L=1000, gap=50) == [poly]
+
+
+def test_split_wide_lines_uses_the_profile_with_a_page():
+    ink, poly = line_with_words(2000, [(5, 900), (1000, 1995)], height=80)
+    gray = np.where(ink, 0, 255).astype(np.uint8)
+    short = [[0, 50], [400, 50], [400, 70], [0, 70]]
+    lines = split_wide_lines([poly, short], L=1000, gap=50, gray=gray)
+    assert len(lines) == 3 and short in lines
+    assert all(isinstance(x, int) for line in lines for point in line for x in point)
+
+
+def rect(x0, y0, x1, y1):
+    return [[x0, y0], [x1, y0], [x1, y1], [x0, y1]]
+
+
+def bbox(poly):
+    xs, ys = zip(*poly)
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def crops_containing(line, polygons):
+    lx0, ly0, lx1, ly1 = bbox(line)
+    return sum(1 for poly in polygons
+               for x0, y0, x1, y1 in [bbox(poly)] if x0 <= lx0 and y0 <= ly0 and lx1 <= x1 and ly1 <= y1)
+
+
+def test_dedupe_merges_nearly_nested_paragraphs():
+    lines = [rect(10, 10, 90, 20), rect(10, 30, 90, 40)]
+    polygons, stats = dedupe_paragraph_polygons([rect(0, 0, 100, 100), rect(10, 10, 90, 45)], lines)
+    assert stats["merged"] == 1 and len(polygons) == 1
+    assert bbox(polygons[0]) == (0, 0, 100, 100)
+
+
+def test_dedupe_trims_overlap_at_a_line_edge():
+    # выпуклая оболочка первого абзаца заходит на первую строку второго
+    first_lines = [rect(0, 0, 200, 10), rect(0, 12, 200, 22)]
+    second_lines = [rect(0, 25, 200, 35), rect(0, 37, 200, 47)]
+    first = [[0, 0], [200, 0], [200, 30], [0, 30]]
+    second = [[0, 24], [200, 24], [200, 50], [0, 50]]
+    lines = first_lines + second_lines
+
+    assert crops_containing(second_lines[0], [first, second]) == 1
+    polygons, stats = dedupe_paragraph_polygons([first, second], lines)
+    assert stats == {"merged": 0, "trimmed": 1, "pixels": 200 * 6}
+    assert bbox(polygons[0])[3] == bbox(polygons[1])[1] == 25
+    assert all(crops_containing(line, polygons) == 1 for line in lines)
+
+
+def test_dedupe_keeps_overlap_that_would_cut_a_line():
+    lines = [rect(0, 0, 200, 40)]
+    polygons = [rect(0, 0, 120, 40), rect(80, 0, 200, 40)]
+    assert dedupe_paragraph_polygons(polygons, lines) == (polygons, {"merged": 0, "trimmed": 0, "pixels": 0})
+
+
+def test_dedupe_leaves_disjoint_paragraphs_alone():
+    polygons = [rect(0, 0, 100, 20), rect(0, 40, 100, 60), rect(200, 0, 300, 60)]
+    result, stats = dedupe_paragraph_polygons(polygons, [])
+    assert result is polygons and not any(stats.values())
@@ -0,0 +1,78 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import metrics
+
+prometheus_client = pytest.importorskip("prometheus_client")
+REGISTRY = prometheus_client.REGISTRY
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+def test_span_observes_durations_and_errors():
+    count = sample("mlworker_stage_seconds_count", stage="test_stage")
+    errors = sample("mlworker_stage_errors_total", stage="test_stage")
+    with metrics.span("test_stage"):
+        pass
+    with pytest.raises(ValueError):
+        with metrics.span("test_stage"):
+            raise ValueError("boom")
+
+    assert sample("mlworker_stage_seconds_count", stage="test_stage") == count + 2
+    assert sample("mlworker_stage_errors_total", stage="test_stage") == errors + 1
+
+
+def test_generation_budget_and_crop_counters():
+    tokens = sample("mlworker_generated_tokens_total")
+    metrics.record_generation(4, 200, 2.0)
+    metrics.record_generation(1, 10, 0)
+    assert sample("mlworker_generated_tokens_total") == tokens + 210
+    assert sample("mlworker_tokens_per_second") == 100.0
+
+    ooms = sample("mlworker_vlm_oom_total", device="test:0")
+    metrics.record_budget("test:0", 552)
+    metrics.record_budget("test:0", 276, oom=True)
+    assert sample("mlworker_vlm_token_budget", device="test:0") == 276
+    assert sample("mlworker_vlm_oom_total", device="test:0") == ooms + 1
+
+    blank = sample("mlworker_crops_filtered_total", reason="blank", dropped="false")
+    metrics.record_filtered_crops({"blank": 3}, dropped=False)
+    assert sample("mlworker_crops_filtered_total", reason="blank", dropped="false") == blank + 3
+
+    merged = sample("mlworker_crops_deduplicated_total", action="merged")
+    trimmed = sample("mlworker_crops_deduplicated_total", action="trimmed")
+    pixels = sample("mlworker_duplicate_pixels_total")
+    metrics.record_deduplicated({"merged": 2, "trimmed": 0, "pixels": 1500})
+    assert sample("mlworker_crops_deduplicated_total", action="merged") == merged + 2
+    assert sample("mlworker_crops_deduplicated_total", action="trimmed") == trimmed
+    assert sample("mlworker_duplicate_pixels_total") == pixels + 1500
+
+
+def test_queue_lag_uses_the_publish_timestamp():
+    metrics.observe_queue_lag("test_queue", SimpleNamespace(timestamp=int(time.time()) - 30))
+    assert 29 <= sample("mlworker_queue_lag_seconds", queue="test_queue") <= 32
+    # сообщения без timestamp (старые публикации) метрику не трогают
+    metrics.observe_queue_lag("test_queue", SimpleNamespace(timestamp=None))
+    metrics.observe_queue_lag("test_queue", None)
+    assert 29 <= sample("mlworker_queue_lag_seconds", queue="test_queue") <= 32
+
+
+def test_metrics_port_follows_the_worker_index(monkeypatch):
+    monkeypatch.setenv("WORKER_INDEX", "3")
+    assert metrics.metrics_port() == metrics.METRICS_PORT + 3
+
+
+def test_without_prometheus_client_only_logs(monkeypatch, caplog):
+    monkeypatch.setattr(metrics, "Histogram", None)
+    monkeypatch.setattr(metrics, "start_http_server", None)
+    with caplog.at_level("DEBUG", logger="metrics"):
+        with metrics.span("quiet_stage"):
+            pass
+        metrics.record_generation(1, 1, 1)
+        metrics.start_metrics_server()
+    assert "quiet_stage took" in caplog.text and "metrics are disabled" in caplog.text
+    assert sample("mlworker_stage_seconds_count", stage="quiet_stage") == 0
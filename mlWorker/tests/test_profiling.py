@@ -0,0 +1,31 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+profiling = pytest.importorskip("profiling")
+
+
+def test_explicit_request_ignores_sampling(monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILE_SAMPLE_RATE", 0)
+    assert profiling.profile_requested({"profile": True})
+    assert profiling.profile_requested({}, SimpleNamespace(headers={"x-profile": "1"}))
+    assert not profiling.profile_requested({}, SimpleNamespace(headers=None))
+    assert not profiling.wants_profile({"id": "doc"})
+
+
+def test_timed_records_wall_time_without_a_profiler():
+    profile = profiling.Profile("doc", kind="cprofile")
+    with profiling.timed([profile, None], "segmentation"):
+        time.sleep(0.01)
+    assert profile.sections["segmentation"] >= 0.01
+    assert profile.stats is None and not profile.traces
+
+
+def test_profiled_sections_accumulate():
+    profile = profiling.Profile("doc", kind="cprofile")
+    for _ in range(2):
+        with profiling.profiled([profile], "recognition"):
+            sum(range(1000))
+    assert set(profile.sections) == {"recognition"}
+    assert profile.stats is not None
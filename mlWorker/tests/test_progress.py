@@ -0,0 +1,67 @@
+import json
+
+import pytest
+
+infra = pytest.importorskip("infra")
+
+from pipeline import build_block  # noqa: E402
+from progress import ProgressReporter  # noqa: E402
+from utils import bbox_corners  # noqa: E402
+
+
+@pytest.fixture
+def progress_table(pg_schema):
+    with pg_schema.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE documents (id text PRIMARY KEY, status text, result jsonb, claimed_by text,
+                                    lease_until timestamptz, version bigint NOT NULL DEFAULT 0);
+            INSERT INTO documents VALUES ('doc', 'processing', NULL, %s, NULL, 0);
+            CREATE TABLE document_progress (doc_id text PRIMARY KEY, done int, total int, blocks jsonb,
+                                            updated_at timestamptz);
+        """, (infra.WORKER_ID,))
+    return pg_schema
+
+
+def progress_row(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT done, total, blocks FROM document_progress WHERE doc_id = 'doc'")
+        return cur.fetchone()
+
+
+def block(index):
+    return build_block(bbox_corners([(0, 10 * index), (100, 10 * index + 10)]), f"line {index}")
+
+
+def test_blocks_carry_their_crop_index(progress_table):
+    progress = ProgressReporter({"conn": infra.connect_to_postgres()}, "doc", min_interval=0)
+    progress.start(3)
+    # кропы распознаются в порядке площади, а не чтения
+    for index in (2, 0, 1):
+        progress.add_block(index, block(index))
+    progress.finish()
+
+    done, total, blocks = progress_row(progress_table)
+    assert (done, total) == (3, 3)
+    assert [b["cropIndex"] for b in blocks] == [2, 0, 1]
+    assert [b["lines"][0]["text"] for b in sorted(blocks, key=lambda b: b["cropIndex"])] == \
+        ["line 0", "line 1", "line 2"]
+
+
+@pytest.mark.parametrize("status", ["done", "fail"])
+def test_final_status_deletes_the_progress_row(progress_table, status):
+    conn_ref = {"conn": infra.connect_to_postgres()}
+    progress = ProgressReporter(conn_ref, "doc", min_interval=0)
+    progress.start(1)
+    progress.add_block(0, block(0))
+    assert progress_row(progress_table) is not None
+
+    infra.update_doc_status(conn_ref, "doc", status, result=json.dumps({"v": 1}))
+    assert progress_row(progress_table) is None
+
+
+def test_requeue_keeps_the_progress_row(progress_table):
+    conn_ref = {"conn": infra.connect_to_postgres()}
+    ProgressReporter(conn_ref, "doc", min_interval=0).start(4)
+
+    infra.update_doc_status(conn_ref, "doc", "in-queue")
+    assert progress_row(progress_table) == (0, 4, [])
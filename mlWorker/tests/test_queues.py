@@ -0,0 +1,61 @@
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+queues = pytest.importorskip("queues")
+
+
+@pytest.fixture
+def management_api(monkeypatch):
+    """HTTP-сервер на случайном порту, записывающий PUT-запросы как API management RabbitMQ."""
+    requests = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_PUT(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            requests.append((self.path, self.headers["Authorization"], json.loads(body)))
+            self.send_response(201)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(queues, "RABBITMQ_MANAGEMENT_URL", f"http://127.0.0.1:{server.server_port}/")
+    try:
+        yield requests
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_policy_covers_work_queues_only():
+    pattern = re.compile(queues.dead_letter_policy()["pattern"])
+    for queue in (queues.PROCESSING_QUEUE, queues.BULK_QUEUE, queues.CROP_QUEUE, queues.AGGREGATION_QUEUE):
+        assert pattern.match(queue)
+    assert not pattern.match(queues.DEAD_LETTER_QUEUE)
+    assert not pattern.match(queues.retry_queue_name(queues.PROCESSING_QUEUE, 10))
+
+
+def test_work_queues_are_declared_without_dead_letter_arguments():
+    for queue in (queues.PROCESSING_QUEUE, queues.BULK_QUEUE, queues.CROP_QUEUE, queues.AGGREGATION_QUEUE):
+        assert not any(key.startswith("x-dead-letter") for key in queues.work_queue_arguments(queue))
+
+
+def test_policy_is_put_through_the_management_api(management_api):
+    assert queues.ensure_dead_letter_policy()
+    [(path, authorization, body)] = management_api
+    assert path == f"/api/policies/%2F/{queues.DEAD_LETTER_POLICY}"
+    assert authorization.startswith("Basic ")
+    assert body["definition"] == {"dead-letter-exchange": "", "dead-letter-routing-key": queues.DEAD_LETTER_QUEUE}
+
+
+def test_unreachable_api_is_logged(monkeypatch, caplog):
+    monkeypatch.setattr(queues, "RABBITMQ_MANAGEMENT_URL", "http://127.0.0.1:9")
+    assert not queues.ensure_dead_letter_policy()
+    assert "rabbitmqctl set_policy" in caplog.text
@@ -0,0 +1,45 @@
+import pytest
+
+reprocess = pytest.importorskip("reprocess")
+
+from artifacts import LocalArtifactStore, content_hash  # noqa: E402
+
+DONE = [("a1", "bucket/a1.png"), ("b2", "bucket/b2.png"), ("c3", "bucket/c3.png")]
+
+
+@pytest.fixture
+def documents(pg_schema):
+    with pg_schema.cursor() as cur:
+        cur.execute("CREATE TABLE documents (id text PRIMARY KEY, filepath text, hash text, status text)")
+        for doc_id, filepath in DONE:
+            cur.execute("INSERT INTO documents VALUES (%s, %s, %s, 'done')",
+                        (doc_id, filepath, content_hash(doc_id.encode())))
+        cur.execute("INSERT INTO documents VALUES ('d4', 'bucket/d4.png', NULL, 'processing')")
+    return pg_schema
+
+
+def test_iter_documents_reads_done_documents(documents, monkeypatch):
+    monkeypatch.setattr(reprocess, "FETCH_SIZE", 2)
+    reader = reprocess.connect_reader()
+    try:
+        rows = list(reprocess.iter_documents(reader))
+        assert [(doc_id, filepath) for doc_id, filepath, _ in rows] == DONE
+        assert [row[0] for row in reprocess.iter_documents(reader, ids=["c3", "a1", "d4"])] == ["a1", "c3"]
+        assert len(list(reprocess.iter_documents(reader, limit=1))) == 1
+    finally:
+        reader.close()
+
+
+def test_dry_run_plans_stages(documents, tmp_path, monkeypatch, caplog):
+    store = LocalArtifactStore(str(tmp_path))
+    store.save(content_hash(b"a1"), "entities", {"entities": []})
+    store.save(content_hash(b"b2"), "recognition", {"texts": []})
+    with documents.cursor() as cur:
+        cur.execute("UPDATE documents SET hash = NULL WHERE id = 'c3'")
+    monkeypatch.setenv("MINIO_ROOT_HOST", "http://127.0.0.1")
+    monkeypatch.setattr(reprocess, "get_artifact_store", lambda s3_client: store)
+
+    with caplog.at_level("INFO", logger="mlworker.reprocess"):
+        assert reprocess.main(["--all", "--dry-run"]) == 0
+    planned = next(record.args for record in caplog.records if record.msg == "Planned: %s")
+    assert planned == {"up-to-date": 1, "entities": 1, "segmentation": 1}
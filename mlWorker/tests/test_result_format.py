@@ -0,0 +1,69 @@
+import json
+
+import pytest
+
+result_format = pytest.importorskip("result_format")
+infra = pytest.importorskip("infra")
+
+
+def ocr_result(text="Привет"):
+    box = [{"x": "0", "y": "0"}, {"x": "10", "y": "0"}, {"x": "10", "y": "5"}, {"x": "0", "y": "5"}]
+    return {"result": {"pageNumber": 1, "type": None, "entities": [], "textAnnotation": {
+        "width": "10", "height": "5", "fullText": text,
+        "blocks": [{"boundingBox": {"vertices": box}, "lines": [{"boundingBox": {"vertices": box}, "text": text}]}],
+    }}}
+
+
+class MemoryS3:
+    """Ровно те вызовы boto3, которые делает save_result."""
+
+    def __init__(self, keys=()):
+        self.objects = {key: b"" for key in keys}
+
+    def put_object(self, Bucket, Key, Body, ContentType=None):
+        self.objects[Key] = Body
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop(Key, None)
+
+    def get_paginator(self, name):
+        s3 = self
+
+        class Paginator:
+            def paginate(self, Bucket, Prefix):
+                yield {"Contents": [{"Key": key} for key in sorted(s3.objects) if key.startswith(Prefix)]}
+
+        return Paginator()
+
+
+@pytest.fixture
+def s3_mode(monkeypatch):
+    monkeypatch.setattr(result_format, "RESULT_STORAGE", "s3")
+
+
+def test_lost_lease_deletes_the_attempt_object(s3_mode, monkeypatch):
+    s3 = MemoryS3(["results/doc.msgpack.zstd"])
+
+    def lease_lost(*args, **kwargs):
+        raise infra.LeaseLost("owned by another worker")
+
+    monkeypatch.setattr(infra, "update_doc_status", lease_lost)
+    with pytest.raises(infra.LeaseLost):
+        infra.save_result({}, s3, "doc", ocr_result())
+    assert list(s3.objects) == ["results/doc.msgpack.zstd"]
+
+
+def test_saved_result_prunes_older_unreferenced_objects(s3_mode, monkeypatch):
+    referenced = "results/doc/00000000000000000002-bbbbbbbb.json.gzip"
+    s3 = MemoryS3(["results/doc.msgpack.zstd", "results/doc/00000000000000000001-aaaaaaaa.json.gzip",
+                   referenced, "results/doc2/00000000000000000001-cccccccc.json.gzip",
+                   "results/doc/99999999999999999999-dddddddd.json.gzip"])
+    written = {}
+    monkeypatch.setattr(infra, "update_doc_status",
+                        lambda conn_ref, doc_id, status, result, search_index, owner: written.update(result=result))
+    monkeypatch.setattr(infra, "run_in_transaction", lambda conn_ref, work: referenced)
+
+    infra.save_result({}, s3, "doc", ocr_result())
+    key = json.loads(written["result"])["storage"]["key"]
+    assert sorted(s3.objects) == sorted([key, referenced, "results/doc2/00000000000000000001-cccccccc.json.gzip",
+                                         "results/doc/99999999999999999999-dddddddd.json.gzip"])
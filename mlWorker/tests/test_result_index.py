@@ -0,0 +1,76 @@
+import pytest
+
+pytest.importorskip("psycopg2")
+
+from pipeline import build_output  # noqa: E402
+from result_index import index_document  # noqa: E402
+from utils import bbox_corners  # noqa: E402
+
+
+class Layout:
+    width, height = 100, 40
+    bboxes = [bbox_corners([(0, 0), (100, 18)]), bbox_corners([(5.5, 20), (90, 39.9)])]
+
+
+@pytest.fixture
+def cur(pg_schema):
+    """Поисковые таблицы как в server/main.py, без tsv (он считается в самой базе)."""
+    # кириллица в сущностях: тестовая база может быть в SQL_ASCII
+    pg_schema.set_client_encoding("UTF8")
+    with pg_schema.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE document_pages (id BIGSERIAL PRIMARY KEY, doc_id text NOT NULL, page_number int NOT NULL,
+                                         width int, height int, doc_type text, full_text text NOT NULL DEFAULT '',
+                                         UNIQUE (doc_id, page_number));
+            CREATE TABLE document_blocks (id BIGSERIAL PRIMARY KEY,
+                                          page_id bigint NOT NULL REFERENCES document_pages(id) ON DELETE CASCADE,
+                                          block_index int NOT NULL, x0 int, y0 int, x1 int, y1 int, text text,
+                                          UNIQUE (page_id, block_index));
+            CREATE TABLE document_lines (id BIGSERIAL PRIMARY KEY,
+                                         block_id bigint NOT NULL REFERENCES document_blocks(id) ON DELETE CASCADE,
+                                         line_index int NOT NULL, x0 int, y0 int, x1 int, y1 int, text text,
+                                         UNIQUE (block_id, line_index));
+            CREATE TABLE document_entities (id BIGSERIAL PRIMARY KEY, doc_id text NOT NULL,
+                                            page_id bigint NOT NULL REFERENCES document_pages(id) ON DELETE CASCADE,
+                                            entity_type text NOT NULL, text text NOT NULL, block_index int,
+                                            start_index int, end_index int);
+        """)
+        yield cur
+
+
+def ocr_result(texts, entities=()):
+    output = build_output(Layout, texts)
+    output["result"]["entities"] = list(entities)
+    return output
+
+
+def test_result_is_split_into_pages_blocks_lines_and_entities(cur):
+    entities = [{"text": "Иванов И. И.", "blockIndex": 1, "startIndex": 0, "endIndex": 12},
+                {"type": "DATE", "text": "1913"},
+                {"type": "DATE", "text": ""}]
+    index_document(cur, "doc", ocr_result(["Опись дел", "Иванов И. И. 1913"], entities))
+
+    cur.execute("SELECT page_number, width, height, doc_type, full_text FROM document_pages")
+    assert cur.fetchall() == [(1, 100, 40, "дело", "Опись делИванов И. И. 1913")]
+    cur.execute("SELECT block_index, x0, y0, x1, y1, text FROM document_blocks ORDER BY block_index")
+    assert cur.fetchall() == [(0, 0, 0, 100, 18, "Опись дел"), (1, 5, 20, 90, 39, "Иванов И. И. 1913")]
+    cur.execute("SELECT b.block_index, l.line_index, l.text FROM document_lines l "
+                "JOIN document_blocks b ON b.id = l.block_id ORDER BY b.block_index")
+    assert cur.fetchall() == [(0, 0, "Опись дел"), (1, 0, "Иванов И. И. 1913")]
+    cur.execute("SELECT doc_id, entity_type, text, block_index, start_index, end_index FROM document_entities "
+                "ORDER BY id")
+    # тип по умолчанию — ФИО, сущности без текста не индексируются
+    assert cur.fetchall() == [("doc", "ФИО", "Иванов И. И.", 1, 0, 12), ("doc", "DATE", "1913", None, None, None)]
+
+
+def test_reindexing_replaces_the_document_rows(cur):
+    index_document(cur, "doc", ocr_result(["старый", "текст"], [{"text": "Петров"}]))
+    index_document(cur, "other", ocr_result(["чужой", "текст"]))
+    index_document(cur, "doc", ocr_result(["новый", ""]))
+
+    cur.execute("SELECT doc_id, full_text FROM document_pages ORDER BY doc_id")
+    assert cur.fetchall() == [("doc", "новый"), ("other", "чужойтекст")]
+    cur.execute("SELECT count(*) FROM document_blocks")
+    assert cur.fetchone()[0] == 4
+    cur.execute("SELECT count(*) FROM document_entities")
+    assert cur.fetchone()[0] == 0
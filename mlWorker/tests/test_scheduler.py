@@ -0,0 +1,41 @@
+from scheduler import Delivery, FairScheduler
+
+
+def delivery(queue_class, tenant, n):
+    return Delivery(queue_class, queue_class, None, None, None, f"{tenant}-{n}".encode(), tenant)
+
+
+def drain(scheduler):
+    order = []
+    while (item := scheduler.pop()) is not None:
+        order.append(item.body.decode())
+    return order
+
+
+def test_tenants_of_a_class_take_turns():
+    scheduler = FairScheduler()
+    for n in range(3):
+        scheduler.push(delivery("bulk", "big", n))
+    scheduler.push(delivery("bulk", "small", 0))
+    assert scheduler.depth("bulk") == 4 and len(scheduler) == 4
+    assert drain(scheduler) == ["big-0", "small-0", "big-1", "big-2"]
+
+
+def test_bulk_gets_one_slot_after_interactive_weight():
+    scheduler = FairScheduler(interactive_weight=2)
+    for n in range(5):
+        scheduler.push(delivery("interactive", "web", n))
+    for n in range(2):
+        scheduler.push(delivery("bulk", "archive", n))
+    assert drain(scheduler) == ["web-0", "web-1", "archive-0", "web-2", "web-3", "archive-1", "web-4"]
+
+
+def test_a_lone_class_is_not_held_back():
+    scheduler = FairScheduler(interactive_weight=1)
+    for n in range(3):
+        scheduler.push(delivery("interactive", "web", n))
+    assert drain(scheduler) == ["web-0", "web-1", "web-2"]
+    for n in range(2):
+        scheduler.push(delivery("bulk", "archive", n))
+    assert drain(scheduler) == ["archive-0", "archive-1"]
+    assert scheduler.pop() is None and len(scheduler) == 0
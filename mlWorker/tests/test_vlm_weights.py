@@ -0,0 +1,22 @@
+import os
+
+import pytest
+
+vlm = pytest.importorskip("vlm")
+
+
+def test_weights_fingerprint_follows_adapter_files(tmp_path):
+    model, lora = tmp_path / "model", tmp_path / "checkpoint-200"
+    model.mkdir()
+    lora.mkdir()
+    (model / "model.safetensors").write_bytes(b"base")
+    adapter = lora / "adapter_model.safetensors"
+    adapter.write_bytes(b"v1")
+
+    first = vlm.weights_fingerprint(str(model), str(lora))
+    assert vlm.weights_fingerprint(str(model), str(lora)) == first
+    assert vlm.weights_fingerprint(str(model), None) != first
+
+    adapter.write_bytes(b"v2")
+    os.utime(adapter, ns=(1, 1))
+    assert vlm.weights_fingerprint(str(model), str(lora)) != first
@@ -1,8 +1,13 @@
 # infer.py
 # -*- coding: utf-8 -*-
+import gc
 import os
 import re
+import time
+import logging
 import argparse
+from collections import deque
+from dataclasses import dataclass
 from typing import Optional, List
 
 import torch
@@ -12,7 +17,23 @@ from tqdm import tqdm
 from transformers import AutoProcessor, AutoModelForImageTextToText, BitsAndBytesConfig
 from peft import PeftModel
 
-DEFAULT_INSTRUCTION = "Расшифруй текст на изображении."
+from config import DEFAULT_INSTRUCTION, weights_fingerprint
+from metrics import span, record_generation, record_budget
+
+logger = logging.getLogger(__name__)
+
+# torch — bnb 4-bit на GPU (fp32 на CPU); cpu-int8 — динамическая int8-квантизация линейных слоёв;
+# openvino — экспорт в OpenVINO IR с int8-весами (нужен optimum-intel)
+VLM_BACKENDS = ("torch", "cpu-int8", "openvino")
+# куда складывать экспортированную OpenVINO-модель, чтобы не экспортировать при каждом старте
+OPENVINO_DIR = os.getenv("VLM_OPENVINO_DIR", "./models/openvino")
+# бюджет одного вызова generate в токенах (кропы × (промпт + max_new_tokens)); 0 — начать
+# с batch_size кропов и подстроиться под память устройства, см. GenerationScheduler
+VLM_TOKEN_BUDGET = int(os.getenv("VLM_TOKEN_BUDGET", "0"))
+# больше кропов в одном generate не ставим, даже если бюджет позволяет
+VLM_MAX_BATCH = int(os.getenv("VLM_MAX_BATCH", "64"))
+# после стольких полных батчей подряд без нехватки памяти бюджет растёт на один кроп
+BUDGET_GROW_AFTER = 8
 GEMMA_ASSISTANT_TAG_TEXT = "<start_of_turn>model"  # для совместимости при ручной сборке, если вдруг понадобится
 
 
@@ -31,9 +52,37 @@ def find_latest_checkpoint(dir_path: str) -> Optional[str]:
     return dir_path  # может быть финальный адаптер прямо в outputs/
 
 
-def load_model_and_processor(model_path: str, lora_path: Optional[str], merge_lora: bool = False):
-    """Загружает базовую модель + LoRA. При merge_lora=True сливает адаптер (быстрее инференс)."""
-    bnb_config = BitsAndBytesConfig(
+def configure_cpu_threads(threads: Optional[int] = None):
+    """Потоки intra-op для генерации на CPU; по умолчанию CPU_THREADS или все ядра."""
+    threads = threads or int(os.getenv("CPU_THREADS", "0")) or os.cpu_count()
+    torch.set_num_threads(threads)
+    try:
+        # межоператорный параллелизм при генерации не помогает, только делит ядра
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass  # уже задано: torch разрешает это только до первой параллельной операции
+    logger.info("-> CPU: %d потоков", threads)
+
+
+def load_model_and_processor(model_path: str, lora_path: Optional[str], merge_lora: bool = False,
+                             device: Optional[str] = None, backend: Optional[str] = None):
+    """
+    Загружает базовую модель + LoRA. При merge_lora=True сливает адаптер (быстрее инференс).
+    device=None — раскладка по всем GPU (device_map="auto"), "cuda:N" — модель целиком на одной карте,
+    "cpu" — без квантизации, для тестов на машинах без GPU.
+    backend="cpu-int8" или "openvino" — CPU-бэкенды (см. VLM_BACKENDS), LoRA в них всегда сливается.
+    """
+    backend = backend or "torch"
+    if backend not in VLM_BACKENDS:
+        raise ValueError(f"Unknown VLM backend: {backend}, expected one of {VLM_BACKENDS}")
+    if backend != "torch":
+        device, merge_lora = "cpu", True
+        configure_cpu_threads()
+    if backend == "openvino":
+        return load_openvino_model(model_path, lora_path)
+
+    on_cpu = device == "cpu"
+    bnb_config = None if on_cpu else BitsAndBytesConfig(
         load_in_4bit=True,
         bnb_4bit_use_double_quant=True,
         bnb_4bit_quant_type="nf4",
@@ -47,20 +96,24 @@ def load_model_and_processor(model_path: str, lora_path: Optional[str], merge_lo
         import flash_attn  # noqa: F401
     except Exception:
         attn_impl = None
+    if on_cpu:
+        attn_impl = None
 
-    print("-> Загружаю базовую модель...")
+    logger.info("-> Загружаю базовую модель (%s)...", device or 'auto')
     model = AutoModelForImageTextToText.from_pretrained(
         model_path,
         quantization_config=bnb_config,
-        device_map="auto",
-        torch_dtype=torch.bfloat16,
+        device_map={"": device} if device else "auto",
+        torch_dtype=torch.float32 if on_cpu else torch.bfloat16,
         attn_implementation=attn_impl,
         local_files_only=True,
     )
     model.config.use_cache = True  # на инференсе кэш включён
 
-    print("-> Загружаю процессор...")
+    logger.info("-> Загружаю процессор...")
     processor = AutoProcessor.from_pretrained(model_path, local_files_only=True)
+    # для батчевой генерации decoder-only модели паддинг должен быть слева
+    processor.tokenizer.padding_side = "left"
     try:
         if hasattr(processor, "image_processor") and hasattr(processor.image_processor, "use_fast"):
             processor.image_processor.use_fast = True
@@ -68,18 +121,70 @@ def load_model_and_processor(model_path: str, lora_path: Optional[str], merge_lo
         pass
 
     if lora_path:
-        print(f"-> Подключаю LoRA: {lora_path}")
+        logger.info("-> Подключаю LoRA: %s", lora_path)
         model = PeftModel.from_pretrained(model, lora_path)
         if merge_lora:
-            print("-> Мёрджу LoRA в базовую модель...")
+            logger.info("-> Мёрджу LoRA в базовую модель...")
             model = model.merge_and_unload()
 
+    if backend == "cpu-int8":
+        logger.info("-> Квантую линейные слои в int8...")
+        # inplace: иначе quantize_dynamic делает deepcopy и на время квантизации в памяти две модели
+        torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        gc.collect()
+    model.eval()
+
+    return model, processor
+
+
+def load_openvino_model(model_path: str, lora_path: Optional[str]):
+    """
+    Модель со слитой LoRA, экспортированная в OpenVINO IR с int8-весами. Экспорт выполняется
+    один раз в OPENVINO_DIR (отдельная папка на каждую пару модель+адаптер по weights_fingerprint),
+    дальше IR грузится сразу.
+    """
+    from optimum.intel import OVModelForVisualCausalLM
+
+    name = os.path.basename(os.path.normpath(lora_path or model_path))
+    target = os.path.join(OPENVINO_DIR, f"{name}-{weights_fingerprint(model_path, lora_path)}")
+    if not os.path.isdir(target):
+        import tempfile
+
+        logger.info("-> Экспортирую модель в OpenVINO: %s", target)
+        model, processor = load_model_and_processor(model_path, lora_path, merge_lora=True, device="cpu")
+        with tempfile.TemporaryDirectory() as merged_dir:
+            model.save_pretrained(merged_dir)
+            processor.save_pretrained(merged_dir)
+            del model
+            ov_model = OVModelForVisualCausalLM.from_pretrained(merged_dir, export=True, load_in_8bit=True)
+            ov_model.save_pretrained(target)
+            processor.save_pretrained(target)
+
+    logger.info("-> Загружаю OpenVINO-модель: %s", target)
+    model = OVModelForVisualCausalLM.from_pretrained(target, ov_config={"PERFORMANCE_HINT": "THROUGHPUT"})
+    processor = AutoProcessor.from_pretrained(target, local_files_only=True)
+    processor.tokenizer.padding_side = "left"
     return model, processor
 
 
-def build_chat_input(processor, image: Image.Image, instruction: str) -> dict:
+def model_device(model):
+    # у OpenVINO-модели нет torch-параметров, её входы остаются на CPU
+    try:
+        return next(model.parameters()).device
+    except (AttributeError, StopIteration):
+        return torch.device("cpu")
+
+
+def _as_rgb(image) -> Image.Image:
+    if isinstance(image, str):
+        with Image.open(image) as img:
+            return img.convert("RGB")
+    return image.convert("RGB")
+
+
+def build_chat_text(processor, instruction: str) -> str:
     """
-    Собирает input через chat template, как в тренинге:
+    Собирает текст запроса через chat template, как в тренинге:
     user: текст-инструкция + <image>
     assistant: (пусто, только подсказка для генерации)
     """
@@ -88,48 +193,195 @@ def build_chat_input(processor, image: Image.Image, instruction: str) -> dict:
             "role": "user",
             "content": [
                 {"type": "text", "text": instruction},
-                {"type": "image", "image": image},
+                {"type": "image"},
             ],
         },
         # add_generation_prompt=True сам добавит начало ответа ассистента
     ]
 
-    # Текстовую часть даём из apply_chat_template, а изображения — отдельно в processor(...)
-    chat_text = processor.apply_chat_template(
+    return processor.apply_chat_template(
         messages,
         tokenize=False,
         add_generation_prompt=True,  # генерируем продолжение от ассистента
     )
 
-    inputs = processor(
-        text=[chat_text],
-        images=[[image.convert("RGB")]],  # список сообщений с одной картинкой
+
+def build_chat_input(processor, images: List[Image.Image], instruction: str) -> dict:
+    """Текстовую часть даём из apply_chat_template, а изображения — отдельно в processor(...)"""
+    chat_text = build_chat_text(processor, instruction)
+    return processor(
+        text=[chat_text] * len(images),
+        images=[[image] for image in images],  # по одной картинке на сообщение
         return_tensors="pt",
         padding=True,
     )
-    return inputs
 
 
 @torch.inference_mode()
+def predict_batch(model, processor, images, instruction: str,
+                  max_new_tokens: int = 128, temperature: float = 0.2, top_p: float = 0.9) -> List[str]:
+    """Распознаёт пачку кропов одним вызовом generate; images — PIL-изображения или пути."""
+    if not images:
+        return []
+    batch = build_chat_input(processor, [_as_rgb(image) for image in images], instruction)
+
+    device = model_device(model)
+    batch = {k: v.to(device) for k, v in batch.items()}
+
+    start = time.perf_counter()
+    with span("vlm_batch"):
+        gen = model.generate(
+            **batch,
+            max_new_tokens=max_new_tokens,
+            do_sample=(temperature is not None and temperature > 0),
+            temperature=temperature if temperature and temperature > 0 else None,
+            top_p=top_p,
+            eos_token_id=processor.tokenizer.eos_token_id,
+            pad_token_id=processor.tokenizer.pad_token_id,
+        )
+    # паддинг левый, поэтому промпт у всех строк одинаковой длины — отрезаем его
+    new_tokens = gen[:, batch["input_ids"].shape[1]:]
+    generated = int((new_tokens != processor.tokenizer.pad_token_id).sum())
+    record_generation(len(images), generated, time.perf_counter() - start)
+    return [text.strip() for text in processor.batch_decode(new_tokens, skip_special_tokens=True)]
+
+
 def predict_one(model, processor, image, instruction: str,
                 max_new_tokens: int = 128, temperature: float = 0.2, top_p: float = 0.9) -> str:
-    # image = Image.open(image_path).convert("RGB")
-    batch = build_chat_input(processor, image, instruction)
+    return predict_batch(model, processor, [image], instruction, max_new_tokens, temperature, top_p)[0]
 
-    device = next(model.parameters()).device
-    batch = {k: v.to(device) for k, v in batch.items()}
 
-    gen = model.generate(
-        **batch,
-        max_new_tokens=max_new_tokens,
-        do_sample=(temperature is not None and temperature > 0),
-        temperature=temperature if temperature and temperature > 0 else None,
-        top_p=top_p,
-        eos_token_id=processor.tokenizer.eos_token_id,
-        pad_token_id=processor.tokenizer.pad_token_id,
-    )
-    text = processor.batch_decode(gen, skip_special_tokens=True)[0]
-    return text.strip()
+def is_oom(error) -> bool:
+    if isinstance(error, (MemoryError, torch.cuda.OutOfMemoryError)):
+        return True
+    message = str(error).lower()
+    return isinstance(error, RuntimeError) and ("out of memory" in message or "can't allocate memory" in message)
+
+
+def _image_area(image) -> int:
+    if isinstance(image, str):
+        with Image.open(image) as img:
+            width, height = img.size
+    else:
+        width, height = image.size
+    return width * height
+
+
+@dataclass
+class DeviceBudget:
+    tokens: int
+    # наименьший бюджет, на котором уже была нехватка памяти; выше него не растём
+    ceiling: Optional[int] = None
+    streak: int = 0
+
+
+# безопасный бюджет по устройствам ("cuda:0", "cpu"), общий для всех планировщиков процесса
+_device_budgets = {}
+
+
+class GenerationScheduler:
+    """
+    Делит кропы на вызовы generate по бюджету токенов вместо фиксированного размера батча.
+
+    Процессор Gemma-3 приводит любой кроп к одному размеру, поэтому память на кроп — токены
+    картинки и промпта плюс max_new_tokens — одинакова, а различается длина ответа. Кропы
+    сортируются по площади: крупные абзацы с длинным текстом генерируются вместе, и короткие
+    ответы не ждут в батче самый длинный.
+
+    При нехватке памяти батч делится пополам и повторяется, а бюджет устройства уменьшается
+    и запоминается для следующих батчей; после серии полных батчей без ошибок он растёт на
+    один кроп, но не до размера, на котором память уже кончалась. Кроп, не влезающий в память
+    в одиночку, роняет батч как раньше.
+    """
+
+    def __init__(self, model, processor, instruction: str = DEFAULT_INSTRUCTION, max_new_tokens: int = 128,
+                 batch_size: int = 8, token_budget: int = VLM_TOKEN_BUDGET, max_batch: int = VLM_MAX_BATCH):
+        self.model = model
+        self.processor = processor
+        self.instruction = instruction
+        self.max_new_tokens = max_new_tokens
+        self.max_batch = max_batch
+        self.device = model_device(model)
+        self.item_tokens = self._prompt_tokens() + max_new_tokens
+        key = str(self.device)
+        if key not in _device_budgets:
+            _device_budgets[key] = DeviceBudget(token_budget or batch_size * self.item_tokens)
+            record_budget(key, _device_budgets[key].tokens)
+        self.budget = _device_budgets[key]
+
+    def _prompt_tokens(self) -> int:
+        text = build_chat_text(self.processor, self.instruction)
+        tokens = len(self.processor.tokenizer(text, add_special_tokens=False)["input_ids"])
+        # плейсхолдер картинки процессор раскрывает в image_seq_length токенов
+        return tokens + getattr(self.processor, "image_seq_length", 256)
+
+    @property
+    def batch_limit(self) -> int:
+        return max(1, min(self.max_batch, self.budget.tokens // self.item_tokens))
+
+    def _shrink(self, failed_size):
+        failed = failed_size * self.item_tokens
+        budget = self.budget
+        budget.ceiling = failed if budget.ceiling is None else min(budget.ceiling, failed)
+        budget.tokens = max(self.item_tokens, failed_size // 2 * self.item_tokens)
+        budget.streak = 0
+        record_budget(str(self.device), budget.tokens, oom=True)
+        logger.warning("Out of memory on %s with %d crops, generation budget lowered to %d crops",
+                       self.device, failed_size, self.batch_limit)
+
+    def _grow(self, size):
+        budget = self.budget
+        if size < self.batch_limit:
+            # неполный батч ничего не говорит о пределе устройства
+            return
+        budget.streak += 1
+        if budget.streak < BUDGET_GROW_AFTER:
+            return
+        budget.streak = 0
+        grown = budget.tokens + self.item_tokens
+        if (budget.ceiling is None or grown < budget.ceiling) and grown // self.item_tokens <= self.max_batch:
+            budget.tokens = grown
+            record_budget(str(self.device), grown)
+
+    def run(self, images, on_result=None, temperature: float = 0.2, top_p: float = 0.9) -> List[str]:
+        """Тексты в порядке images; on_result(index, text) вызывается по мере готовности."""
+        texts = [""] * len(images)
+        queue = deque(sorted(range(len(images)), key=lambda i: _image_area(images[i]), reverse=True))
+        # половины батчей, не влезших в память, повторяются раньше новых кропов
+        retry = deque()
+        while retry or queue:
+            if retry:
+                group = retry.popleft()
+                if len(group) > self.batch_limit:
+                    # бюджет уже урезан на соседней половине: не повторяем заведомый OOM
+                    retry.appendleft(group[self.batch_limit:])
+                    group = group[:self.batch_limit]
+            else:
+                group = [queue.popleft() for _ in range(min(self.batch_limit, len(queue)))]
+            try:
+                outputs = predict_batch(self.model, self.processor, [images[i] for i in group], self.instruction,
+                                        self.max_new_tokens, temperature, top_p)
+            except Exception as e:
+                if len(group) == 1 or not is_oom(e):
+                    raise
+                outputs = None
+            if outputs is None:
+                # память освобождаем вне except: исключение держит ссылки на тензоры генерации
+                gc.collect()
+                if self.device.type == "cuda":
+                    torch.cuda.empty_cache()
+                self._shrink(len(group))
+                half = len(group) // 2
+                retry.appendleft(group[half:])
+                retry.appendleft(group[:half])
+                continue
+
+            self._grow(len(group))
+            for index, text in zip(group, outputs):
+                texts[index] = text
+                if on_result is not None:
+                    on_result(index, text)
+        return texts
 
 
 def list_images(folder: str) -> List[str]:
@@ -158,10 +410,13 @@ def main():
                         help="Папка с изображениями для батч-инференса")
     parser.add_argument("--instruction", type=str, default=DEFAULT_INSTRUCTION,
                         help="Инструкция (промпт) для модели")
+    parser.add_argument("--backend", type=str, default="torch", choices=VLM_BACKENDS,
+                        help="cpu-int8 / openvino — инференс без GPU")
     parser.add_argument("--max_new_tokens", type=int, default=128)
     parser.add_argument("--temperature", type=float, default=0.2)
     parser.add_argument("--top_p", type=float, default=0.9)
     args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
 
     # определяем путь к LoRA
     lora_path = args.lora_path if args.lora_path else find_latest_checkpoint(args.outputs_dir)
@@ -172,6 +427,7 @@ def main():
         model_path=args.model_path,
         lora_path=lora_path,
         merge_lora=args.merge_lora,
+        backend=args.backend,
     )
 
     if args.image:
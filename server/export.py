@@ -0,0 +1,101 @@
+"""
+Bulk export of recognized documents without going through HTTP, run next to the API:
+
+    docker compose exec server python export.py --format jsonl --output /exports/all
+    docker compose exec server python export.py --format alto --output /exports/t1 --tenant t1 --part-size 500
+
+Documents are read in id order through the same server-side cursor as GET /export. Every part
+(part-00000.xml, ...) is a complete JSONL/ALTO/hOCR file written through a temporary file; only
+then export.state records the last exported id, so rerunning with the same --output continues
+after it. --after/--until limit the id range, e.g. to split an archive between several exports.
+"""
+import argparse
+import json
+import os
+import sys
+
+from main import (EXPORT_EXTENSIONS, export_footer, export_header, get_db_connection, iter_export_rows,
+                  render_export_document)
+
+STATE_FILE = "export.state"
+
+
+def load_state(output_dir, export_format):
+    path = os.path.join(output_dir, STATE_FILE)
+    if not os.path.exists(path):
+        return {"format": export_format, "last_id": None, "parts": 0, "documents": 0}
+    with open(path, encoding="utf-8") as f:
+        state = json.load(f)
+    if state["format"] != export_format:
+        raise SystemExit(f"{output_dir} holds a {state['format']} export, use another --output")
+    return state
+
+
+def save_state(output_dir, state):
+    path = os.path.join(output_dir, STATE_FILE)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+
+def write_part(output_dir, state, export_format, chunks, last_id, count):
+    path = os.path.join(output_dir, f"part-{state['parts']:05d}.{EXPORT_EXTENSIONS[export_format]}")
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        f.write(export_header(export_format))
+        f.writelines(chunks)
+        f.write(export_footer(export_format))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+    state.update(last_id=last_id, parts=state["parts"] + 1, documents=state["documents"] + count)
+    save_state(output_dir, state)
+    print(f"Wrote {path} ({count} documents, {state['documents']} in total, last id {last_id})")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Export recognized documents as JSONL, ALTO or hOCR")
+    parser.add_argument("--format", choices=sorted(EXPORT_EXTENSIONS), default="jsonl")
+    parser.add_argument("--output", required=True, help="Directory for parts and the resume state")
+    parser.add_argument("--after", help="Export ids greater than this one (default: resume from the state)")
+    parser.add_argument("--until", help="Export ids up to and including this one")
+    parser.add_argument("--tenant")
+    parser.add_argument("--part-size", type=int, default=1000, help="Documents per output file")
+    parser.add_argument("--result-format", choices=("full", "compact"), default="full",
+                        help="Result shape in JSONL, as in GET /recognition-status")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    os.makedirs(args.output, exist_ok=True)
+    state = load_state(args.output, args.format)
+    after = args.after or state["last_id"]
+
+    conn = get_db_connection()
+    if not conn:
+        print("Database connection failed", file=sys.stderr)
+        return 1
+
+    chunks = []
+    last_id = None
+    number = state["documents"]
+    try:
+        for row in iter_export_rows(conn, after, args.until, args.tenant):
+            number += 1
+            chunks.append(render_export_document(row, args.format, number, args.result_format))
+            last_id = row[0]
+            if len(chunks) >= args.part_size:
+                write_part(args.output, state, args.format, chunks, last_id, len(chunks))
+                chunks = []
+        if chunks:
+            write_part(args.output, state, args.format, chunks, last_id, len(chunks))
+    finally:
+        conn.close()
+    print(f"Export finished: {state['documents']} documents in {state['parts']} parts")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
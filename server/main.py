@@ -2,7 +2,10 @@ import uuid
 import boto3
 from botocore.client import Config
 from botocore.exceptions import ClientError
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import FastAPI, UploadFile, File, HTTPException, Query, Request, Header, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel
 import pika
 import psycopg2
 import os
@@ -10,18 +13,71 @@ from psycopg2 import OperationalError
 from psycopg2.errors import DuplicateObject
 import json
 import time
+import base64
+import math
+import asyncio
+import select
+import threading
+import gzip
+from typing import List, Optional
+from urllib.parse import urlencode
+from xml.sax.saxutils import escape, quoteattr
+
+try:
+    import msgpack
+    import zstandard
+except ImportError:
+    msgpack = zstandard = None
 
 S3_BUCKET_NAME = "documents"
+DOCUMENT_STATUSES = ('uploading', 'in-queue', 'processing', 'done', 'fail')
+FINAL_STATUSES = ('done', 'fail')
+STATUS_CHANNEL = "document_status"
+SSE_KEEPALIVE_SECONDS = 15
+
+PROCESSING_QUEUE = "doc_processing"
+BULK_QUEUE = f"{PROCESSING_QUEUE}.bulk"
+DEAD_LETTER_QUEUE = f"{PROCESSING_QUEUE}.dead"
+WORK_QUEUES = {
+    "interactive": PROCESSING_QUEUE,
+    "bulk": BULK_QUEUE,
+}
+BULK_MAX_PRIORITY = 9
+
+def work_queue_arguments(queue):
+    # Must match mlWorker/queues.py, RabbitMQ rejects redeclaration with other arguments.
+    # Dead-lettering comes from a policy the worker sets (queues.ensure_dead_letter_policy),
+    # doc_processing predates it and cannot gain x-dead-letter-* arguments in place.
+    arguments = {}
+    if queue == BULK_QUEUE:
+        arguments["x-max-priority"] = BULK_MAX_PRIORITY
+    return arguments
+
+# Direct uploads: the browser PUTs to MinIO through nginx's /s3/ location with a presigned URL
+S3_PUBLIC_ENDPOINT = os.getenv("S3_PUBLIC_ENDPOINT")
+S3_PUBLIC_PATH = "/s3"
+UPLOAD_URL_EXPIRES_SECONDS = int(os.getenv("UPLOAD_URL_EXPIRES_SECONDS", "3600"))
+MULTIPART_THRESHOLD_BYTES = 64 * 2**20
+MULTIPART_PART_BYTES = 16 * 2**20
+MAX_UPLOAD_BYTES = 5 * 2**30
+# Must match SUPPORTED_FORMATS in mlWorker/config.py
+UPLOAD_SIGNATURES = {
+    '.jpg': b'\xff\xd8\xff',
+    '.jpeg': b'\xff\xd8\xff',
+    '.png': b'\x89PNG\r\n\x1a\n',
+}
 
 app = FastAPI()
 
-def get_s3_client():
+def get_s3_client(endpoint_url='http://minio:9000'):
     return boto3.client(
         's3',
-        endpoint_url='http://minio:9000',
+        endpoint_url=endpoint_url,
         aws_access_key_id=os.getenv('MINIO_ROOT_USER'),
         aws_secret_access_key=os.getenv('MINIO_ROOT_PASSWORD'),
-        config=Config(signature_version='s3v4')
+        config=Config(signature_version='s3v4'),
+        # MinIO ignores the region, the signature still has to name one
+        region_name='us-east-1'
     )
 
 def init_s3():
@@ -88,10 +144,212 @@ def init_db():
             );
         """)
         print("Table 'documents' is ready.")
+
+        # Row version for ETags and worker claims: bumped by a trigger whenever the status,
+        # the result, the viewer assets or the claiming worker changes, whoever the writer is.
+        # Lease-only heartbeats do not bump it.
+        cur.execute("""
+            ALTER TABLE documents ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0;
+            ALTER TABLE documents ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT now();
+            ALTER TABLE documents ADD COLUMN IF NOT EXISTS claimed_by TEXT;
+            ALTER TABLE documents ADD COLUMN IF NOT EXISTS lease_until TIMESTAMPTZ;
+            ALTER TABLE documents ADD COLUMN IF NOT EXISTS assets JSONB;
+
+            CREATE OR REPLACE FUNCTION documents_bump_version() RETURNS trigger AS $$
+            BEGIN
+                IF NEW.status IS DISTINCT FROM OLD.status
+                   OR NEW.result IS DISTINCT FROM OLD.result
+                   OR NEW.claimed_by IS DISTINCT FROM OLD.claimed_by
+                   OR NEW.assets IS DISTINCT FROM OLD.assets THEN
+                    NEW.version := OLD.version + 1;
+                    NEW.updated_at := now();
+                END IF;
+                RETURN NEW;
+            END;
+            $$ LANGUAGE plpgsql;
+
+            DO $$
+            BEGIN
+                IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'documents_bump_version') THEN
+                    CREATE TRIGGER documents_bump_version BEFORE UPDATE ON documents
+                        FOR EACH ROW EXECUTE FUNCTION documents_bump_version();
+                END IF;
+            END$$;
+        """)
+        print("Checked for documents version trigger.")
+
+        # Scheduling class and owner of the upload, used for fair-share priorities
+        cur.execute("""
+            ALTER TABLE documents ADD COLUMN IF NOT EXISTS priority_class TEXT NOT NULL DEFAULT 'interactive';
+            ALTER TABLE documents ADD COLUMN IF NOT EXISTS tenant TEXT NOT NULL DEFAULT 'default';
+            CREATE INDEX IF NOT EXISTS documents_tenant_status_idx ON documents (tenant, status);
+        """)
+        print("Checked for documents scheduling columns.")
+
+        # pg_trgm backs substring/fuzzy lookups of entity names
+        cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+
+        # Normalized, indexed copy of the OCR result used by /search.
+        # The worker fills these tables in the same transaction as the 'done' update.
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS document_pages (
+                id BIGSERIAL PRIMARY KEY,
+                doc_id TEXT NOT NULL REFERENCES documents(id) ON DELETE CASCADE,
+                page_number INTEGER NOT NULL,
+                width INTEGER,
+                height INTEGER,
+                doc_type TEXT,
+                full_text TEXT NOT NULL DEFAULT '',
+                tsv tsvector GENERATED ALWAYS AS (to_tsvector('russian'::regconfig, full_text)) STORED,
+                UNIQUE (doc_id, page_number)
+            );
+            CREATE INDEX IF NOT EXISTS document_pages_tsv_idx ON document_pages USING GIN (tsv);
+
+            CREATE TABLE IF NOT EXISTS document_blocks (
+                id BIGSERIAL PRIMARY KEY,
+                page_id BIGINT NOT NULL REFERENCES document_pages(id) ON DELETE CASCADE,
+                block_index INTEGER NOT NULL,
+                x0 INTEGER NOT NULL,
+                y0 INTEGER NOT NULL,
+                x1 INTEGER NOT NULL,
+                y1 INTEGER NOT NULL,
+                text TEXT NOT NULL DEFAULT '',
+                UNIQUE (page_id, block_index)
+            );
+
+            CREATE TABLE IF NOT EXISTS document_lines (
+                id BIGSERIAL PRIMARY KEY,
+                block_id BIGINT NOT NULL REFERENCES document_blocks(id) ON DELETE CASCADE,
+                line_index INTEGER NOT NULL,
+                x0 INTEGER NOT NULL,
+                y0 INTEGER NOT NULL,
+                x1 INTEGER NOT NULL,
+                y1 INTEGER NOT NULL,
+                text TEXT NOT NULL DEFAULT '',
+                UNIQUE (block_id, line_index)
+            );
+
+            CREATE TABLE IF NOT EXISTS document_entities (
+                id BIGSERIAL PRIMARY KEY,
+                doc_id TEXT NOT NULL REFERENCES documents(id) ON DELETE CASCADE,
+                page_id BIGINT NOT NULL REFERENCES document_pages(id) ON DELETE CASCADE,
+                entity_type TEXT NOT NULL,
+                text TEXT NOT NULL,
+                block_index INTEGER,
+                start_index INTEGER,
+                end_index INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS document_entities_type_text_idx
+                ON document_entities (entity_type, lower(text));
+            CREATE INDEX IF NOT EXISTS document_entities_text_trgm_idx
+                ON document_entities USING GIN (text gin_trgm_ops);
+            CREATE INDEX IF NOT EXISTS document_entities_page_idx ON document_entities (page_id);
+            CREATE INDEX IF NOT EXISTS document_entities_doc_idx ON document_entities (doc_id);
+        """)
+        print("Search tables are ready.")
+
+        # Paragraph-level progress, appended by the worker while a page is recognized
+        # and deleted together with the 'done'/'fail' transition
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS document_progress (
+                doc_id TEXT PRIMARY KEY REFERENCES documents(id) ON DELETE CASCADE,
+                done INTEGER NOT NULL DEFAULT 0,
+                total INTEGER NOT NULL DEFAULT 0,
+                blocks JSONB NOT NULL DEFAULT '[]',
+                updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            );
+        """)
+        print("Table 'document_progress' is ready.")
+
+        # Split pipeline state: the segmenter writes crop boxes, recognizers fill in
+        # the text, the aggregator assembles the result and drops these rows
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS document_layouts (
+                doc_id TEXT PRIMARY KEY REFERENCES documents(id) ON DELETE CASCADE,
+                width INTEGER NOT NULL,
+                height INTEGER NOT NULL,
+                crop_count INTEGER NOT NULL
+            );
+
+            CREATE TABLE IF NOT EXISTS document_crops (
+                doc_id TEXT NOT NULL REFERENCES documents(id) ON DELETE CASCADE,
+                crop_index INTEGER NOT NULL,
+                x0 INTEGER NOT NULL,
+                y0 INTEGER NOT NULL,
+                x1 INTEGER NOT NULL,
+                y1 INTEGER NOT NULL,
+                text TEXT,
+                PRIMARY KEY (doc_id, crop_index)
+            );
+        """)
+        print("Split pipeline tables are ready.")
     
     conn.commit()
     conn.close()
 
+class StatusBroadcaster:
+    """
+    Holds a single LISTEN connection on STATUS_CHANNEL and fans the worker's
+    notifications out to the event-stream clients subscribed to a document.
+    """
+
+    def __init__(self):
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self._run, name="status-broadcaster", daemon=True).start()
+
+    def subscribe(self, doc_id):
+        subscription = (asyncio.get_running_loop(), asyncio.Queue())
+        with self._lock:
+            self._subscribers.setdefault(doc_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, doc_id, subscription):
+        with self._lock:
+            subscriptions = self._subscribers.get(doc_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscribers[doc_id]
+
+    def _dispatch(self, payload):
+        try:
+            event = json.loads(payload)
+        except ValueError:
+            print(f"Ignoring malformed status notification: {payload!r}")
+            return
+        with self._lock:
+            subscriptions = list(self._subscribers.get(event.get("id"), ()))
+        for loop, queue in subscriptions:
+            loop.call_soon_threadsafe(queue.put_nowait, event)
+
+    def _run(self):
+        while True:
+            conn = get_db_connection()
+            if not conn:
+                time.sleep(1)
+                continue
+            try:
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(f"LISTEN {STATUS_CHANNEL};")
+                print(f"Listening for notifications on '{STATUS_CHANNEL}'.")
+                while True:
+                    if select.select([conn], [], [], SSE_KEEPALIVE_SECONDS) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self._dispatch(conn.notifies.pop(0).payload)
+            except psycopg2.Error as e:
+                print(f"Status listener connection lost: {e}")
+            finally:
+                conn.close()
+            time.sleep(1)
+
+status_broadcaster = StatusBroadcaster()
+
 @app.on_event("startup")
 async def startup_event():
     print("Application startup: Initializing S3...")
@@ -100,6 +358,7 @@ async def startup_event():
     print("Application startup: Initializing database...")
     init_db()
     print("Database initialization complete.")
+    status_broadcaster.start()
 
 def get_db_connection():
     try:
@@ -119,8 +378,82 @@ def get_db_connection():
         print(f"Could not connect to PostgreSQL database: {e}")
         return None
 
+def bulk_priority(backlog):
+    # Fair share inside the bulk queue: a tenant's next page loses one priority level
+    # each time its pending backlog doubles, so small batches overtake huge imports.
+    return max(0, BULK_MAX_PRIORITY - int(math.log2(backlog + 1)))
+
+def publish_document(doc_id, filepath, priority_class, tenant, priority=None, profile=False):
+    connection = pika.BlockingConnection(pika.ConnectionParameters('rabbitmq'))
+    try:
+        channel = connection.channel()
+        queue = WORK_QUEUES[priority_class]
+        channel.queue_declare(queue=queue, durable=True, arguments=work_queue_arguments(queue))
+        message = {
+            "id": doc_id,
+            "filepath": filepath,
+            "hash": doc_id,
+            "tenant": tenant,
+        }
+        if profile:
+            # The worker uploads a cProfile/torch profile next to the document
+            message["profile"] = True
+        channel.basic_publish(exchange='',
+                              routing_key=queue,
+                              body=json.dumps(message).encode(),
+                              # the worker measures queue lag from this timestamp
+                              properties=pika.BasicProperties(delivery_mode=2, priority=priority,
+                                                              timestamp=int(time.time())))
+    finally:
+        connection.close()
+
+def check_priority_class(priority_class):
+    if priority_class not in WORK_QUEUES:
+        raise HTTPException(status_code=400, detail=f"Unknown priority class: {priority_class}")
+
+def register_document(doc_id, filepath, priority_class, tenant, profile=False):
+    """Creates the DB row for an uploaded object and enqueues it. Returns False if the row already exists."""
+    conn = get_db_connection()
+    if not conn:
+        raise HTTPException(status_code=500, detail="Database connection failed")
+
+    with conn.cursor() as cur:
+        # A retried completion call must not enqueue the document twice
+        cur.execute(
+            "INSERT INTO documents (id, filepath, hash, status, priority_class, tenant) "
+            "VALUES (%s, %s, %s, %s, %s, %s) ON CONFLICT (id) DO NOTHING RETURNING id",
+            (doc_id, filepath, doc_id, 'uploading', priority_class, tenant)
+        )
+        created = cur.fetchone() is not None
+        priority = None
+        if created and priority_class == "bulk":
+            cur.execute(
+                "SELECT count(*) FROM documents WHERE tenant = %s AND status IN ('uploading', 'in-queue')",
+                (tenant,)
+            )
+            priority = bulk_priority(cur.fetchone()[0])
+    conn.commit()
+    conn.close()
+
+    if not created:
+        return False
+
+    try:
+        publish_document(doc_id, filepath, priority_class, tenant, priority, profile)
+    except pika.exceptions.AMQPConnectionError:
+        # Here we should ideally handle the failure, e.g., by setting doc status to 'fail'
+        raise HTTPException(status_code=500, detail="Could not send message to the processing queue")
+    return True
+
 @app.post("/upload-doc")
-async def upload_doc(file: UploadFile = File(...)):
+async def upload_doc(
+    file: UploadFile = File(...),
+    priority_class: str = Query("interactive"),
+    tenant: str = Query("default", min_length=1, max_length=128),
+    profile: bool = Query(False),
+):
+    check_priority_class(priority_class)
+
     doc_id = str(uuid.uuid4())
     file_extension = os.path.splitext(file.filename)[1]
     filepath = f"{doc_id}{file_extension}"
@@ -132,48 +465,345 @@ async def upload_doc(file: UploadFile = File(...)):
     except ClientError as e:
         raise HTTPException(status_code=500, detail=f"Failed to upload to S3: {e}")
 
-    # 2. Create DB record
+    # 2. Create DB record and 3. send message to RabbitMQ
+    register_document(doc_id, filepath, priority_class, tenant, profile)
+
+    return {"id": doc_id}
+
+class UploadRequest(BaseModel):
+    filename: str
+    size: Optional[int] = None
+    content_type: Optional[str] = None
+
+class UploadedPart(BaseModel):
+    part_number: int
+    etag: str
+
+class CompleteUploadRequest(BaseModel):
+    key: str
+    upload_id: Optional[str] = None
+    parts: Optional[List[UploadedPart]] = None
+
+def public_s3_client(request):
+    # The signature covers the Host header, so URLs are signed for the host the browser talks to
+    endpoint = S3_PUBLIC_ENDPOINT or f"{request.headers.get('x-forwarded-proto', request.url.scheme)}://" \
+                                     f"{request.headers.get('host', request.url.netloc)}"
+    return get_s3_client(endpoint_url=endpoint.rstrip('/'))
+
+def to_public_url(url):
+    # nginx strips the /s3 prefix before proxying to MinIO, the signed path stays intact
+    scheme, rest = url.split('://', 1)
+    host, path = rest.split('/', 1)
+    return f"{scheme}://{host}{S3_PUBLIC_PATH}/{path}"
+
+def upload_key(doc_id, filename):
+    file_extension = os.path.splitext(filename)[1].lower()
+    if file_extension not in UPLOAD_SIGNATURES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unsupported file type: {file_extension}. Supported formats are {list(UPLOAD_SIGNATURES)}"
+        )
+    return f"{doc_id}{file_extension}"
+
+@app.post("/uploads")
+def create_upload(
+    upload: UploadRequest,
+    request: Request,
+    priority_class: str = Query("interactive"),
+    tenant: str = Query("default", min_length=1, max_length=128),
+    profile: bool = Query(False),
+):
+    """
+    Issues presigned URLs so the browser uploads straight to MinIO; nothing is stored until
+    POST /uploads/{id}/complete. Large files get one URL per multipart part.
+    """
+    check_priority_class(priority_class)
+    if upload.size is not None and not 0 < upload.size <= MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"File size must be between 1 and {MAX_UPLOAD_BYTES} bytes")
+
+    doc_id = str(uuid.uuid4())
+    key = upload_key(doc_id, upload.filename)
+    s3 = public_s3_client(request)
+    query = {"priority_class": priority_class, "tenant": tenant}
+    if profile:
+        query["profile"] = "true"
+    completion = f"/uploads/{doc_id}/complete?" + urlencode(query)
+
+    if upload.size is None or upload.size <= MULTIPART_THRESHOLD_BYTES:
+        params = {"Bucket": S3_BUCKET_NAME, "Key": key}
+        headers = {}
+        if upload.content_type:
+            params["ContentType"] = upload.content_type
+            headers["Content-Type"] = upload.content_type
+        url = s3.generate_presigned_url("put_object", Params=params, ExpiresIn=UPLOAD_URL_EXPIRES_SECONDS)
+        return {
+            "id": doc_id,
+            "key": key,
+            "method": "PUT",
+            "url": to_public_url(url),
+            "headers": headers,
+            "expires_in": UPLOAD_URL_EXPIRES_SECONDS,
+            "complete": completion,
+        }
+
+    multipart = get_s3_client().create_multipart_upload(
+        Bucket=S3_BUCKET_NAME, Key=key, ContentType=upload.content_type or "application/octet-stream"
+    )
+    part_count = math.ceil(upload.size / MULTIPART_PART_BYTES)
+    parts = [
+        {
+            "part_number": number,
+            "url": to_public_url(s3.generate_presigned_url(
+                "upload_part",
+                Params={"Bucket": S3_BUCKET_NAME, "Key": key,
+                        "UploadId": multipart["UploadId"], "PartNumber": number},
+                ExpiresIn=UPLOAD_URL_EXPIRES_SECONDS,
+            )),
+        }
+        for number in range(1, part_count + 1)
+    ]
+    return {
+        "id": doc_id,
+        "key": key,
+        "method": "PUT",
+        "upload_id": multipart["UploadId"],
+        "part_size": MULTIPART_PART_BYTES,
+        "parts": parts,
+        "expires_in": UPLOAD_URL_EXPIRES_SECONDS,
+        "complete": completion,
+    }
+
+@app.post("/uploads/{doc_id}/complete")
+def complete_upload(
+    doc_id: str,
+    completion: CompleteUploadRequest,
+    priority_class: str = Query("interactive"),
+    tenant: str = Query("default", min_length=1, max_length=128),
+    profile: bool = Query(False),
+):
+    """Verifies the uploaded object, then creates the document and enqueues it like /upload-doc."""
+    check_priority_class(priority_class)
+    # Only the key issued for this id is accepted, a client cannot register someone else's object
+    if completion.key != upload_key(doc_id, completion.key):
+        raise HTTPException(status_code=400, detail="Key does not belong to this upload")
+
+    s3 = get_s3_client()
+    try:
+        if completion.upload_id:
+            if not completion.parts:
+                raise HTTPException(status_code=400, detail="Multipart completion needs the uploaded parts")
+            s3.complete_multipart_upload(
+                Bucket=S3_BUCKET_NAME, Key=completion.key, UploadId=completion.upload_id,
+                MultipartUpload={"Parts": [{"PartNumber": p.part_number, "ETag": p.etag}
+                                           for p in sorted(completion.parts, key=lambda p: p.part_number)]},
+            )
+        head = s3.head_object(Bucket=S3_BUCKET_NAME, Key=completion.key)
+        magic = s3.get_object(Bucket=S3_BUCKET_NAME, Key=completion.key, Range="bytes=0-7")["Body"].read()
+    except ClientError as e:
+        code = e.response['Error']['Code']
+        if code in ('404', 'NoSuchKey', 'NoSuchUpload'):
+            raise HTTPException(status_code=409, detail="The file has not been uploaded yet")
+        raise HTTPException(status_code=500, detail=f"Failed to verify the upload: {e}")
+
+    extension = os.path.splitext(completion.key)[1].lower()
+    if not 0 < head['ContentLength'] <= MAX_UPLOAD_BYTES or not magic.startswith(UPLOAD_SIGNATURES[extension]):
+        s3.delete_object(Bucket=S3_BUCKET_NAME, Key=completion.key)
+        raise HTTPException(status_code=400, detail="Uploaded file is empty, too large or not a valid image")
+
+    created = register_document(doc_id, completion.key, priority_class, tenant, profile)
+    return {"id": doc_id, "created": created}
+
+@app.delete("/uploads/{doc_id}")
+def abort_upload(doc_id: str, key: str = Query(...), upload_id: Optional[str] = Query(None)):
+    """Drops an unfinished upload so abandoned multipart parts do not pile up in MinIO."""
+    if key != upload_key(doc_id, key):
+        raise HTTPException(status_code=400, detail="Key does not belong to this upload")
+
     conn = get_db_connection()
     if not conn:
         raise HTTPException(status_code=500, detail="Database connection failed")
-    
     with conn.cursor() as cur:
-        cur.execute(
-            "INSERT INTO documents (id, filepath, hash, status) VALUES (%s, %s, %s, %s)",
-            (doc_id, filepath, doc_id, 'uploading')
-        )
-    conn.commit()
+        cur.execute("SELECT 1 FROM documents WHERE id = %s", (doc_id,))
+        registered = cur.fetchone() is not None
     conn.close()
+    if registered:
+        raise HTTPException(status_code=409, detail="The upload is already completed")
+
+    s3 = get_s3_client()
+    try:
+        if upload_id:
+            s3.abort_multipart_upload(Bucket=S3_BUCKET_NAME, Key=key, UploadId=upload_id)
+        else:
+            s3.delete_object(Bucket=S3_BUCKET_NAME, Key=key)
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('404', 'NoSuchKey', 'NoSuchUpload'):
+            raise HTTPException(status_code=500, detail=f"Failed to abort the upload: {e}")
+    return {"id": doc_id, "aborted": True}
 
-    # 3. Send message to RabbitMQ
+@app.get("/queue-stats")
+def queue_stats():
     try:
         connection = pika.BlockingConnection(pika.ConnectionParameters('rabbitmq'))
-        channel = connection.channel()
-        channel.queue_declare(queue='doc_processing', durable=True)
-        message = {
-            "id": doc_id,
-            "filepath": filepath,
-            "hash": doc_id
-        }
-        channel.basic_publish(exchange='',
-                              routing_key='doc_processing',
-                              body=json.dumps(message).encode(),
-                              properties=pika.BasicProperties(delivery_mode=2))
-        connection.close()
     except pika.exceptions.AMQPConnectionError:
-        # Here we should ideally handle the failure, e.g., by setting doc status to 'fail'
-        raise HTTPException(status_code=500, detail="Could not send message to the processing queue")
+        raise HTTPException(status_code=500, detail="Could not connect to RabbitMQ")
 
-    return {"id": doc_id}
+    stats = {}
+    try:
+        for name, queue in {**WORK_QUEUES, "dead": DEAD_LETTER_QUEUE}.items():
+            channel = connection.channel()
+            try:
+                declared = channel.queue_declare(queue=queue, passive=True)
+                stats[name] = {
+                    "queue": queue,
+                    "messages": declared.method.message_count,
+                    "consumers": declared.method.consumer_count,
+                }
+                channel.close()
+            except pika.exceptions.ChannelClosedByBroker:
+                # passive declare closes the channel when the queue does not exist yet
+                stats[name] = {"queue": queue, "messages": 0, "consumers": 0}
+    finally:
+        connection.close()
+
+    return stats
+
+def make_etag(version, variant=None):
+    # Weak validator: nginx may gzip the body, the representation stays the same
+    return f'W/"{version}-{variant}"' if variant else f'W/"{version}"'
+
+def parse_etag_versions(if_none_match, variant=None):
+    suffix = f"-{variant}" if variant else ""
+    versions = set()
+    for tag in (if_none_match or "").split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        tag = tag.strip('"')
+        if suffix:
+            if not tag.endswith(suffix):
+                continue
+            tag = tag[:-len(suffix)]
+        if tag.isdigit():
+            versions.add(int(tag))
+    return versions
+
+def caching_headers(version, variant=None):
+    return {
+        "ETag": make_etag(version, variant),
+        "Cache-Control": "private, no-cache",
+        "Vary": "Accept-Encoding",
+    }
+
+def _vertices(box):
+    x0, y0, x1, y1 = box
+    return [{"x": str(x), "y": str(y)} for x, y in ((x0, y0), (x1, y0), (x1, y1), (x0, y1))]
+
+def _legacy_line(box, text):
+    return {
+        "boundingBox": {"vertices": _vertices(box)},
+        "text": text,
+        "words": [],
+        "entityIndex": "-1",
+        "textSegments": [{"startIndex": "0", "length": "1"}],
+        "orientation": "ANGLE_0",
+    }
+
+def load_compact_result(result):
+    # Results stored in S3 leave only a summary with the object key in the row (mlWorker/result_format.py)
+    storage = result.get("storage")
+    if not storage:
+        return result
+    payload = get_s3_client().get_object(Bucket=S3_BUCKET_NAME, Key=storage["key"])["Body"].read()
+    if storage["codec"] == "msgpack+zstd":
+        if msgpack is None:
+            raise HTTPException(status_code=500, detail="msgpack/zstandard are not installed")
+        return msgpack.unpackb(zstandard.ZstdDecompressor().decompress(payload), raw=False)
+    if storage["codec"] == "json+gzip":
+        return json.loads(gzip.decompress(payload))
+    raise HTTPException(status_code=500, detail=f"Unknown result codec: {storage['codec']}")
+
+def expand_result(compact):
+    """Renders the compact result in the original textAnnotation shape."""
+    blocks = []
+    texts = []
+    for x0, y0, x1, y1, lines in compact["blocks"]:
+        box = (x0, y0, x1, y1)
+        if isinstance(lines, str):
+            lines = [lines]
+        legacy_lines = []
+        for line in lines:
+            if isinstance(line, str):
+                legacy_lines.append(_legacy_line(box, line))
+                texts.append(line)
+            else:
+                legacy_lines.append(_legacy_line(line[:4], line[4]))
+                texts.append(line[4])
+        blocks.append({
+            "boundingBox": {"vertices": _vertices(box)},
+            "lines": legacy_lines,
+            "textSegments": [{"startIndex": "0", "length": "1"}],
+        })
+
+    annotation = {
+        "width": str(compact["w"]),
+        "height": str(compact["h"]),
+        "blocks": blocks,
+        "fullText": compact.get("fullText", "".join(texts)),
+        "entities": [],
+        "tables": [],
+        "rotate": "ANGLE_0",
+        "markdown": "",
+        "pictures": [],
+    }
+    annotation.update(compact.get("extra", {}))
+    page = {
+        "textAnnotation": annotation,
+        "pageNumber": compact["page"],
+        "type": compact["type"],
+        "entities": compact["entities"],
+    }
+    # Keys of an on-demand profile (mlWorker/profiling.py)
+    if "profile" in compact:
+        page["profile"] = compact["profile"]
+    return {"result": page}
+
+def render_result(result, result_format):
+    # Legacy rows and error payloads have no "v" and are returned untouched
+    if not isinstance(result, dict) or "v" not in result:
+        return result
+    compact = load_compact_result(result)
+    return compact if result_format == "compact" else expand_result(compact)
+
+def asset_urls(assets):
+    # Viewer derivatives written by mlWorker/assets.py; the original stays at "filepath"
+    if not assets:
+        return None
+    urls = {name: f"/s3/{S3_BUCKET_NAME}/{assets[name]}" for name in ("thumbnail", "preview", "dzi")}
+    urls.update(width=assets["width"], height=assets["height"])
+    return urls
 
 @app.get("/recognition-status/{doc_id}")
-def recognition_status(doc_id: str):
+def recognition_status(doc_id: str, if_none_match: Optional[str] = Header(None),
+                       format: str = Query("full", pattern="^(full|compact)$")):
+    # Both representations share the row version, the ETag must tell them apart
+    variant = "compact" if format == "compact" else None
+    cached_versions = list(parse_etag_versions(if_none_match, variant))
+
     conn = get_db_connection()
     if not conn:
         raise HTTPException(status_code=500, detail="Database connection failed")
 
     with conn.cursor() as cur:
-        cur.execute("SELECT id, status, filepath, result FROM documents WHERE id = %s", (doc_id,))
+        # The result is not even read from the table when the client already has this version
+        cur.execute(
+            """
+            SELECT id, status, filepath, version,
+                   CASE WHEN version = ANY(%s::bigint[]) THEN NULL ELSE result END,
+                   assets
+            FROM documents WHERE id = %s
+            """,
+            (cached_versions, doc_id)
+        )
         doc = cur.fetchone()
     
     conn.close()
@@ -181,13 +811,519 @@ def recognition_status(doc_id: str):
     if not doc:
         raise HTTPException(status_code=404, detail="Document not found")
 
-    return {
+    headers = caching_headers(doc[3], variant)
+    if doc[3] in cached_versions:
+        return Response(status_code=304, headers=headers)
+
+    return JSONResponse({
         "id": doc[0],
         "status": doc[1],
         "filepath": f"/s3/{S3_BUCKET_NAME}/{doc[2]}",
-        "result": doc[3]
+        "version": doc[3],
+        "assets": asset_urls(doc[5]),
+        "result": render_result(doc[4], format)
+    }, headers=headers)
+
+@app.get("/status/{doc_id}")
+def document_status(doc_id: str, if_none_match: Optional[str] = Header(None)):
+    conn = get_db_connection()
+    if not conn:
+        raise HTTPException(status_code=500, detail="Database connection failed")
+
+    with conn.cursor() as cur:
+        cur.execute("SELECT id, status, version FROM documents WHERE id = %s", (doc_id,))
+        doc = cur.fetchone()
+
+    conn.close()
+
+    if not doc:
+        raise HTTPException(status_code=404, detail="Document not found")
+
+    headers = caching_headers(doc[2])
+    if doc[2] in parse_etag_versions(if_none_match):
+        return Response(status_code=304, headers=headers)
+
+    return JSONResponse({"id": doc[0], "status": doc[1], "version": doc[2]}, headers=headers)
+
+@app.get("/progress/{doc_id}")
+def document_progress(doc_id: str, since: int = Query(0, ge=0)):
+    """
+    Partial recognition results; `since` skips blocks the client already has.
+    Blocks come in recognition order, `cropIndex` gives their reading order. The worker drops
+    the progress row when the document is done or failed; the full result replaces it.
+    """
+    conn = get_db_connection()
+    if not conn:
+        raise HTTPException(status_code=500, detail="Database connection failed")
+
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT d.status, p.done, p.total,
+                   coalesce((SELECT jsonb_agg(b ORDER BY i)
+                             FROM jsonb_array_elements(p.blocks) WITH ORDINALITY AS t(b, i)
+                             WHERE i > %s), '[]'),
+                   p.updated_at
+            FROM documents d
+            LEFT JOIN document_progress p ON p.doc_id = d.id
+            WHERE d.id = %s
+            """,
+            (since, doc_id)
+        )
+        row = cur.fetchone()
+
+    conn.close()
+
+    if not row:
+        raise HTTPException(status_code=404, detail="Document not found")
+
+    return {
+        "id": doc_id,
+        "status": row[0],
+        "done": row[1] or 0,
+        "total": row[2] or 0,
+        "blocks": row[3],
+        "updatedAt": row[4].isoformat() if row[4] else None,
     }
 
+class StatusesRequest(BaseModel):
+    ids: List[str]
+
+MAX_BULK_STATUS_IDS = 1000
+
+@app.post("/statuses")
+def document_statuses(request: StatusesRequest):
+    if len(request.ids) > MAX_BULK_STATUS_IDS:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_BULK_STATUS_IDS} ids per request")
+    if not request.ids:
+        return {"items": [], "missing": []}
+
+    conn = get_db_connection()
+    if not conn:
+        raise HTTPException(status_code=500, detail="Database connection failed")
+
+    with conn.cursor() as cur:
+        cur.execute("SELECT id, status, version FROM documents WHERE id = ANY(%s)", (request.ids,))
+        rows = cur.fetchall()
+
+    conn.close()
+
+    found = {row[0] for row in rows}
+    return {
+        "items": [{"id": row[0], "status": row[1], "version": row[2]} for row in rows],
+        "missing": [doc_id for doc_id in request.ids if doc_id not in found],
+    }
+
+def fetch_doc_status(doc_id):
+    conn = get_db_connection()
+    if not conn:
+        raise HTTPException(status_code=500, detail="Database connection failed")
+
+    with conn.cursor() as cur:
+        cur.execute("SELECT status FROM documents WHERE id = %s", (doc_id,))
+        row = cur.fetchone()
+
+    conn.close()
+    return row[0] if row else None
+
+def format_sse(event):
+    event_type = "progress" if "progress" in event else "status"
+    return f"event: {event_type}\ndata: {json.dumps(event)}\n\n"
+
+@app.get("/recognition-events/{doc_id}")
+async def recognition_events(doc_id: str, request: Request):
+    # Subscribe before reading the current status so that no transition is lost in between
+    subscription = status_broadcaster.subscribe(doc_id)
+    try:
+        status = await run_in_threadpool(fetch_doc_status, doc_id)
+    except HTTPException:
+        status_broadcaster.unsubscribe(doc_id, subscription)
+        raise
+    if status is None:
+        status_broadcaster.unsubscribe(doc_id, subscription)
+        raise HTTPException(status_code=404, detail="Document not found")
+
+    async def event_stream():
+        queue = subscription[1]
+        try:
+            yield format_sse({"id": doc_id, "status": status})
+            if status in FINAL_STATUSES:
+                return
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        return
+                    yield ": keep-alive\n\n"
+                    continue
+                yield format_sse(event)
+                if event.get("status") in FINAL_STATUSES:
+                    return
+        finally:
+            status_broadcaster.unsubscribe(doc_id, subscription)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+SEARCH_HEADLINE_OPTIONS = "StartSel=<b>, StopSel=</b>, MaxFragments=2, MaxWords=25, MinWords=8"
+
+# Relevance is only computed for a bounded window of matching pages, see search()
+SEARCH_RANK_WINDOW = int(os.getenv("SEARCH_RANK_WINDOW", "1000"))
+
+def encode_search_cursor(window_top, rank=None, page_id=None):
+    raw = json.dumps([window_top, rank, page_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+def decode_search_cursor(cursor):
+    try:
+        window_top, rank, page_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if rank is None or page_id is None:
+            return int(window_top), None, None
+        return int(window_top), float(rank), int(page_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def escape_like(value):
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+@app.get("/search")
+def search(
+    q: Optional[str] = Query(None, min_length=1),
+    entity: Optional[str] = Query(None, min_length=2),
+    entity_type: Optional[str] = None,
+    status: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = None,
+):
+    if not q and not entity and not entity_type:
+        raise HTTPException(status_code=400, detail="Specify q, entity or entity_type")
+
+    # Ranking every hit of a common term would cost O(total hits) per page. Instead the hits are
+    # cut into windows of SEARCH_RANK_WINDOW pages in page id order (newest first), which the
+    # primary key index or the GIN index produce without looking at the rest; only the pages of
+    # one window are ranked and sorted. Inside a window pages are ordered by (rank DESC, id DESC),
+    # across windows newer pages come first. The cursor holds the top page id of the window, which
+    # keeps the window fixed while documents are added, and the last (rank, id) pair sent from it.
+    # ts_headline only runs on the returned rows.
+    window_top, last_rank, last_id = decode_search_cursor(cursor) if cursor else (None, None, None)
+
+    params = []
+    conditions = []
+    if q:
+        conditions.append("p.tsv @@ websearch_to_tsquery('russian', %s)")
+        params.append(q)
+    if entity or entity_type:
+        entity_conditions = ["e.page_id = p.id"]
+        if entity_type:
+            entity_conditions.append("e.entity_type = %s")
+            params.append(entity_type)
+        if entity:
+            entity_conditions.append("e.text ILIKE %s")
+            params.append(f"%{escape_like(entity)}%")
+        conditions.append(
+            f"EXISTS (SELECT 1 FROM document_entities e WHERE {' AND '.join(entity_conditions)})"
+        )
+    if status:
+        if status not in DOCUMENT_STATUSES:
+            raise HTTPException(status_code=400, detail=f"Unknown status: {status}")
+        conditions.append("d.status = %s")
+        params.append(status)
+    if window_top is not None:
+        conditions.append("p.id <= %s")
+        params.append(window_top)
+    params.append(SEARCH_RANK_WINDOW)
+
+    if q:
+        rank_sql = "ts_rank_cd(tsv, websearch_to_tsquery('russian', %s))"
+        params.append(q)
+    else:
+        rank_sql = "0::real"
+
+    keyset_sql = ""
+    if last_id is not None:
+        keyset_sql = "WHERE (rank, page_id) < (%s::real, %s)"
+        params.extend([last_rank, last_id])
+
+    params.append(limit + 1)
+
+    if q:
+        snippet_sql = f"ts_headline('russian', p.full_text, websearch_to_tsquery('russian', %s), '{SEARCH_HEADLINE_OPTIONS}')"
+        params.append(q)
+    else:
+        snippet_sql = "left(p.full_text, 200)"
+
+    sql = f"""
+        WITH hits AS (
+            SELECT p.id AS page_id, p.doc_id, p.page_number, d.filepath, d.status, p.tsv
+            FROM document_pages p
+            JOIN documents d ON d.id = p.doc_id
+            WHERE {' AND '.join(conditions)}
+            ORDER BY p.id DESC
+            LIMIT %s
+        ), ranked AS (
+            SELECT page_id, doc_id, page_number, filepath, status, {rank_sql} AS rank,
+                   max(page_id) OVER () AS window_top, min(page_id) OVER () AS window_bottom,
+                   count(*) OVER () AS window_size
+            FROM hits
+        ), page AS (
+            SELECT * FROM ranked
+            {keyset_sql}
+            ORDER BY rank DESC, page_id DESC
+            LIMIT %s
+        )
+        SELECT page.page_id, page.doc_id, page.page_number, page.filepath, page.status, page.rank,
+               {snippet_sql} AS snippet,
+               (SELECT coalesce(json_agg(json_build_object('type', e.entity_type, 'text', e.text)), '[]')
+                FROM document_entities e WHERE e.page_id = page.page_id) AS entities,
+               page.window_top, page.window_bottom, page.window_size
+        FROM page
+        JOIN document_pages p ON p.id = page.page_id
+        ORDER BY page.rank DESC, page.page_id DESC
+    """
+
+    conn = get_db_connection()
+    if not conn:
+        raise HTTPException(status_code=500, detail="Database connection failed")
+
+    with conn.cursor() as cur:
+        cur.execute(sql, params)
+        rows = cur.fetchall()
+
+    conn.close()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_search_cursor(rows[-1][8], rows[-1][5], rows[-1][0])
+    elif rows and rows[-1][10] == SEARCH_RANK_WINDOW:
+        # The window is used up; a full window means older pages may match too.
+        # The response can be shorter than limit here, the next one starts the next window.
+        next_cursor = encode_search_cursor(rows[-1][9] - 1)
+
+    return {
+        "query": q,
+        "items": [
+            {
+                "id": row[1],
+                "pageNumber": row[2],
+                "filepath": f"/s3/{S3_BUCKET_NAME}/{row[3]}",
+                "status": row[4],
+                "rank": row[5],
+                "snippet": row[6],
+                "entities": row[7],
+            }
+            for row in rows
+        ],
+        "nextCursor": next_cursor,
+    }
+
+EXPORT_FETCH_SIZE = 500
+EXPORT_MEDIA_TYPES = {
+    "jsonl": "application/x-ndjson",
+    "alto": "application/xml",
+    "hocr": "application/xhtml+xml",
+}
+EXPORT_EXTENSIONS = {"jsonl": "jsonl", "alto": "xml", "hocr": "html"}
+ALTO_HEADER = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<alto xmlns="http://www.loc.gov/standards/alto/ns-v4#" '
+    'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+    'xsi:schemaLocation="http://www.loc.gov/standards/alto/ns-v4# '
+    'http://www.loc.gov/alto/v4/alto-4-2.xsd">\n'
+    '<Description><MeasurementUnit>pixel</MeasurementUnit></Description>\n'
+    '<Layout>\n'
+)
+ALTO_FOOTER = '</Layout>\n</alto>\n'
+HOCR_HEADER = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN" '
+    '"http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">\n'
+    '<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="ru" lang="ru">\n<head>\n<title></title>\n'
+    '<meta http-equiv="Content-Type" content="text/html;charset=utf-8"/>\n'
+    '<meta name="ocr-system" content="bobs-lct-archieves"/>\n'
+    '<meta name="ocr-capabilities" content="ocr_page ocr_carea ocr_par ocr_line ocrx_word"/>\n'
+    '</head>\n<body>\n'
+)
+HOCR_FOOTER = '</body>\n</html>\n'
+
+def _box_from_vertices(vertices):
+    xs = [int(float(v["x"])) for v in vertices]
+    ys = [int(float(v["y"])) for v in vertices]
+    return min(xs), min(ys), max(xs), max(ys)
+
+def page_blocks(compact_or_legacy):
+    """(width, height, [(block box, [(line box, text), ...]), ...]) for both stored result shapes."""
+    if "v" in compact_or_legacy:
+        blocks = []
+        for x0, y0, x1, y1, lines in compact_or_legacy["blocks"]:
+            box = (x0, y0, x1, y1)
+            if isinstance(lines, str):
+                lines = [lines]
+            blocks.append((box, [(box, line) if isinstance(line, str) else (tuple(line[:4]), line[4])
+                                 for line in lines]))
+        return compact_or_legacy["w"], compact_or_legacy["h"], blocks
+    annotation = compact_or_legacy["result"]["textAnnotation"]
+    blocks = [
+        (_box_from_vertices(block["boundingBox"]["vertices"]),
+         [(_box_from_vertices(line["boundingBox"]["vertices"]), line["text"]) for line in block["lines"]])
+        for block in annotation["blocks"]
+    ]
+    return int(float(annotation["width"])), int(float(annotation["height"])), blocks
+
+def layout_words(box, text):
+    """
+    The recognizer returns one text per paragraph crop without word geometry: its lines split
+    the box height evenly and words are placed in proportion to their offset in the line.
+    """
+    x0, y0, x1, y1 = box
+    lines = [line for line in text.splitlines() if line.strip()]
+    result = []
+    for i, line in enumerate(lines):
+        top = y0 + (y1 - y0) * i // len(lines)
+        bottom = y0 + (y1 - y0) * (i + 1) // len(lines)
+        scale = (x1 - x0) / max(len(line), 1)
+        words = []
+        offset = 0
+        for word in line.split():
+            start = line.index(word, offset)
+            offset = start + len(word)
+            words.append(((x0 + int(start * scale), top, x0 + int(offset * scale), bottom), word))
+        result.append(((x0, top, x1, bottom), words))
+    return result
+
+def _alto_box(box):
+    x0, y0, x1, y1 = box
+    return f'HPOS="{x0}" VPOS="{y0}" WIDTH="{x1 - x0}" HEIGHT="{y1 - y0}"'
+
+def render_alto_page(doc_id, number, width, height, blocks):
+    # XML IDs must not start with a digit, hence the prefix; the document id stays recoverable
+    page_id = f"doc_{doc_id}"
+    parts = [f'<Page ID={quoteattr(page_id)} PHYSICAL_IMG_NR="{number}" WIDTH="{width}" HEIGHT="{height}">\n'
+             f'<PrintSpace {_alto_box((0, 0, width, height))}>\n']
+    for b, (block_box, lines) in enumerate(blocks):
+        parts.append(f'<TextBlock ID={quoteattr(f"{page_id}_b{b}")} {_alto_box(block_box)}>\n')
+        n = 0
+        for line_box, text in lines:
+            for text_line_box, words in layout_words(line_box, text):
+                parts.append(f'<TextLine ID={quoteattr(f"{page_id}_b{b}_l{n}")} {_alto_box(text_line_box)}>')
+                parts.append("<SP/>".join(f'<String CONTENT={quoteattr(word)} {_alto_box(word_box)}/>'
+                                          for word_box, word in words))
+                parts.append('</TextLine>\n')
+                n += 1
+        parts.append('</TextBlock>\n')
+    parts.append('</PrintSpace>\n</Page>\n')
+    return "".join(parts)
+
+def _hocr_bbox(box):
+    return "bbox {} {} {} {}".format(*box)
+
+def _hocr_string(value):
+    # hOCR property strings are double-quoted with backslash escapes, not Python repr
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+def render_hocr_page(doc_id, filepath, number, width, height, blocks):
+    parts = [f'<div class="ocr_page" id="page_{number}" '
+             f'title={quoteattr(f"image {_hocr_string(filepath)}; {_hocr_bbox((0, 0, width, height))}; ppageno {number - 1}")} '
+             f'data-doc-id={quoteattr(doc_id)}>\n']
+    for b, (block_box, lines) in enumerate(blocks):
+        parts.append(f'<div class="ocr_carea" id="block_{number}_{b}" title="{_hocr_bbox(block_box)}">'
+                     f'<p class="ocr_par" title="{_hocr_bbox(block_box)}">\n')
+        for line_box, text in lines:
+            for text_line_box, words in layout_words(line_box, text):
+                parts.append(f'<span class="ocr_line" title="{_hocr_bbox(text_line_box)}">')
+                parts.append(" ".join(f'<span class="ocrx_word" title="{_hocr_bbox(word_box)}">{escape(word)}</span>'
+                                      for word_box, word in words))
+                parts.append('</span>\n')
+        parts.append('</p></div>\n')
+    parts.append('</div>\n')
+    return "".join(parts)
+
+def iter_export_rows(conn, after=None, until=None, tenant=None, limit=None):
+    """
+    Recognized documents in id order through a server-side cursor, so memory does not depend on
+    the archive size. after is exclusive and until inclusive: an interrupted export resumes with
+    after=<last exported id>.
+    """
+    conditions = ["status = 'done'", "result IS NOT NULL"]
+    params = []
+    if after:
+        conditions.append("id > %s")
+        params.append(after)
+    if until:
+        conditions.append("id <= %s")
+        params.append(until)
+    if tenant:
+        conditions.append("tenant = %s")
+        params.append(tenant)
+    sql = f"SELECT id, filepath, result FROM documents WHERE {' AND '.join(conditions)} ORDER BY id"
+    if limit:
+        sql += " LIMIT %s"
+        params.append(limit)
+    with conn.cursor(name="export_documents") as cur:
+        cur.itersize = EXPORT_FETCH_SIZE
+        cur.execute(sql, params)
+        for row in cur:
+            yield row
+
+def render_export_document(row, export_format, number, result_format="full"):
+    doc_id, filepath, result = row
+    try:
+        if export_format == "jsonl":
+            return json.dumps({"id": doc_id, "filepath": filepath, "result": render_result(result, result_format)},
+                              ensure_ascii=False) + "\n"
+        width, height, blocks = page_blocks(load_compact_result(result) if "v" in result else result)
+        if export_format == "alto":
+            return render_alto_page(doc_id, number, width, height, blocks)
+        return render_hocr_page(doc_id, filepath, number, width, height, blocks)
+    except Exception as e:
+        # One unreadable result must not break a multi-gigabyte stream
+        print(f"Export of document {doc_id} failed: {e}")
+        if export_format == "jsonl":
+            return json.dumps({"id": doc_id, "filepath": filepath, "error": str(e)}, ensure_ascii=False) + "\n"
+        return f"<!-- document {escape(doc_id)} skipped: {escape(str(e)).replace('--', '- -')} -->\n"
+
+def export_header(export_format):
+    return {"alto": ALTO_HEADER, "hocr": HOCR_HEADER}.get(export_format, "")
+
+def export_footer(export_format):
+    return {"alto": ALTO_FOOTER, "hocr": HOCR_FOOTER}.get(export_format, "")
+
+def export_stream(conn, export_format, after=None, until=None, tenant=None, limit=None, result_format="full"):
+    """Yields the export piece by piece and closes conn when done or when the client goes away."""
+    try:
+        yield export_header(export_format)
+        for number, row in enumerate(iter_export_rows(conn, after, until, tenant, limit), start=1):
+            yield render_export_document(row, export_format, number, result_format)
+        yield export_footer(export_format)
+    finally:
+        conn.close()
+
+@app.get("/export")
+def export_documents(
+    format: str = Query("jsonl", pattern="^(jsonl|alto|hocr)$"),
+    after: Optional[str] = None,
+    until: Optional[str] = None,
+    tenant: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1),
+    result_format: str = Query("full", pattern="^(full|compact)$"),
+):
+    conn = get_db_connection()
+    if not conn:
+        raise HTTPException(status_code=500, detail="Database connection failed")
+
+    return StreamingResponse(
+        export_stream(conn, format, after, until, tenant, limit, result_format),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={
+            "Content-Disposition": f'attachment; filename="export.{EXPORT_EXTENSIONS[format]}"',
+            "X-Accel-Buffering": "no",
+        },
+    )
+
 @app.get("/")
 def read_root():
     return {"Hello": "World"}
@@ -0,0 +1,38 @@
+import os
+import sys
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def pg_schema(monkeypatch):
+    """
+    Temporary PostgreSQL schema from POSTGRES_*; main.get_db_connection is pointed at it.
+    The test is skipped when there is no database.
+    """
+    psycopg2 = pytest.importorskip("psycopg2")
+    import main
+
+    params = dict(dbname=os.getenv("POSTGRES_DB", "db"), user=os.getenv("POSTGRES_USER", "user"),
+                  password=os.getenv("POSTGRES_PASSWORD", "password"),
+                  host=os.getenv("POSTGRES_HOST", "localhost"), port=int(os.getenv("POSTGRES_PORT", "5432")))
+    try:
+        admin = psycopg2.connect(connect_timeout=2, **params)
+    except psycopg2.OperationalError as e:
+        pytest.skip(f"PostgreSQL is unavailable: {e}")
+    admin.autocommit = True
+    schema = f"test_{uuid.uuid4().hex[:12]}"
+    with admin.cursor() as cur:
+        cur.execute(f"CREATE SCHEMA {schema}")
+        cur.execute(f"SET search_path TO {schema}")
+    monkeypatch.setattr(main, "get_db_connection",
+                        lambda: psycopg2.connect(options=f"-c search_path={schema}", **params))
+    try:
+        yield admin
+    finally:
+        with admin.cursor() as cur:
+            cur.execute(f"DROP SCHEMA {schema} CASCADE")
+        admin.close()
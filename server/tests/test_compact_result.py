@@ -0,0 +1,81 @@
+import copy
+import os
+import sys
+
+# to_compact живёт в воркере; server/main.py стоит в sys.path раньше, чем mlWorker/main.py
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                             "mlWorker"))
+
+import pytest  # noqa: E402
+
+from main import expand_result, render_result  # noqa: E402
+
+result_format = pytest.importorskip("result_format")
+
+
+def vertices(x0, y0, x1, y1):
+    return [{"x": str(x), "y": str(y)} for x, y in ((x0, y0), (x1, y0), (x1, y1), (x0, y1))]
+
+
+def block(box, lines):
+    return {
+        "boundingBox": {"vertices": vertices(*box)},
+        "lines": [{
+            "boundingBox": {"vertices": vertices(*line_box)},
+            "text": text,
+            "words": [],
+            "entityIndex": "-1",
+            "textSegments": [{"startIndex": "0", "length": "1"}],
+            "orientation": "ANGLE_0",
+        } for line_box, text in lines],
+        "textSegments": [{"startIndex": "0", "length": "1"}],
+    }
+
+
+def worker_result(blocks, full_text=None, **annotation):
+    """Результат в том виде, в каком его собирают pipeline.build_output и attach_entities."""
+    texts = [line["text"] for b in blocks for line in b["lines"]]
+    return {"result": {
+        "textAnnotation": {
+            "width": "1200", "height": "1800", "blocks": blocks,
+            "fullText": "".join(texts) if full_text is None else full_text,
+            "entities": [], "tables": [], "rotate": "ANGLE_0", "markdown": "", "pictures": [],
+            **annotation,
+        },
+        "pageNumber": 1,
+        "type": "дело",
+        "entities": [{"type": "ФИО", "text": "Иванов И. И."}],
+    }}
+
+
+def test_worker_result_round_trips():
+    full = worker_result([block((10, 20, 500, 80), [((10, 20, 500, 80), "Иванов И. И.")]),
+                          block((10, 100, 500, 300), [((10, 100, 500, 300), "1914 год")])])
+    compact = result_format.to_compact(copy.deepcopy(full))
+    assert compact["blocks"] == [[10, 20, 500, 80, "Иванов И. И."], [10, 100, 500, 300, "1914 год"]]
+    assert "fullText" not in compact and "extra" not in compact
+    assert expand_result(compact) == full
+
+
+def test_lines_with_own_boxes_and_extra_fields_round_trip():
+    full = worker_result(
+        [block((0, 0, 600, 200), [((0, 0, 600, 90), "первая"), ((0, 100, 580, 200), "вторая")])],
+        full_text="первая\nвторая", markdown="# первая",
+    )
+    compact = result_format.to_compact(copy.deepcopy(full))
+    assert compact["blocks"][0][4] == [[0, 0, 600, 90, "первая"], [0, 100, 580, 200, "вторая"]]
+    assert compact["fullText"] == "первая\nвторая"
+    assert compact["extra"] == {"markdown": "# первая"}
+    assert expand_result(compact) == full
+
+
+def test_profile_keys_survive():
+    full = worker_result([])
+    full["result"]["profile"] = {"keys": ["profiles/doc/1.prof"], "sections": {"recognition": 1.5}}
+    assert render_result(result_format.to_compact(full), "full") == full
+
+
+def test_legacy_results_are_returned_untouched():
+    legacy = worker_result([block((0, 0, 1, 1), [((0, 0, 1, 1), "x")])])
+    assert render_result(legacy, "full") is legacy
+    assert render_result({"error": "boom"}, "compact") == {"error": "boom"}
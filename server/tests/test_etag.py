@@ -0,0 +1,22 @@
+from main import make_etag, parse_etag_versions
+
+
+def test_parses_own_etags():
+    assert parse_etag_versions(make_etag(7)) == {7}
+    assert parse_etag_versions(make_etag(7, "compact"), "compact") == {7}
+
+
+def test_accepts_lists_strong_tags_and_spacing():
+    assert parse_etag_versions('W/"3", "4" ,W/"5"') == {3, 4, 5}
+
+
+def test_variants_do_not_match_each_other():
+    header = f'{make_etag(3)}, {make_etag(4, "compact")}'
+    assert parse_etag_versions(header) == {3}
+    assert parse_etag_versions(header, "compact") == {4}
+
+
+def test_ignores_missing_and_foreign_tags():
+    assert parse_etag_versions(None) == set()
+    assert parse_etag_versions("*") == set()
+    assert parse_etag_versions('"abc", W/"12-other"', "compact") == set()
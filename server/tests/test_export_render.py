@@ -0,0 +1,17 @@
+from xml.dom import minidom
+
+from main import render_hocr_page
+
+
+def page_title(html):
+    return minidom.parseString(html).documentElement.getAttribute("title")
+
+
+def test_hocr_image_is_an_hocr_string():
+    html = render_hocr_page("doc", "scans/page 1.png", 1, 100, 50, [])
+    assert page_title(html) == 'image "scans/page 1.png"; bbox 0 0 100 50; ppageno 0'
+
+
+def test_hocr_image_escapes_quotes_and_backslashes():
+    html = render_hocr_page("doc", 'a"b\\c\'d.png', 2, 10, 10, [])
+    assert page_title(html).startswith('image "a\\"b\\\\c\'d.png"; ')
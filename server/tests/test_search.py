@@ -0,0 +1,96 @@
+import pytest
+from fastapi import HTTPException
+
+import main
+
+
+@pytest.fixture
+def pages(pg_schema, monkeypatch):
+    """12 pages mention "archive" 1..3 times, every third one is not done yet; 3 pages do not match."""
+    monkeypatch.setattr(main, "SEARCH_RANK_WINDOW", 5)
+    with pg_schema.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE documents (id text PRIMARY KEY, filepath text, status text);
+            CREATE TABLE document_pages (
+                id BIGSERIAL PRIMARY KEY, doc_id text, page_number int, full_text text NOT NULL DEFAULT '',
+                tsv tsvector GENERATED ALWAYS AS (to_tsvector('russian'::regconfig, full_text)) STORED
+            );
+            CREATE TABLE document_entities (page_id bigint, entity_type text, text text);
+        """)
+        for i in range(15):
+            text = " ".join(["archive"] * (i % 3 + 1) + ["inventory", "fund"]) if i < 12 else "registry journal"
+            cur.execute("INSERT INTO documents VALUES (%s, %s, %s)",
+                        (f"doc{i}", f"doc{i}.png", "processing" if i % 3 == 0 else "done"))
+            cur.execute("INSERT INTO document_pages (doc_id, page_number, full_text) VALUES (%s, 1, %s)",
+                        (f"doc{i}", text))
+        cur.execute("INSERT INTO document_entities SELECT id, 'PERSON', 'Ivan 100%' FROM document_pages "
+                    "WHERE doc_id IN ('doc1', 'doc2')")
+    return pg_schema
+
+
+def search(**kwargs):
+    params = dict(q=None, entity=None, entity_type=None, status=None, limit=20, cursor=None)
+    params.update(kwargs)
+    return main.search(**params)
+
+
+def all_pages(**kwargs):
+    responses = [search(**kwargs)]
+    while responses[-1]["nextCursor"]:
+        responses.append(search(cursor=responses[-1]["nextCursor"], **kwargs))
+    return responses
+
+
+def test_cursor_walks_every_hit_once_window_by_window(pages):
+    responses = all_pages(q="archive", limit=2)
+    ids = [item["id"] for response in responses for item in response["items"]]
+    assert sorted(ids) == sorted(f"doc{i}" for i in range(12))
+
+    # windows of 5 pages, newest first; inside a window the order is by rank
+    windows = [["doc11", "doc10", "doc9", "doc8", "doc7"], ["doc6", "doc5", "doc4", "doc3", "doc2"],
+               ["doc1", "doc0"]]
+    start = 0
+    for window in windows:
+        chunk = ids[start:start + len(window)]
+        assert sorted(chunk) == sorted(window)
+        ranks = [item["rank"] for response in responses for item in response["items"]][start:start + len(window)]
+        assert ranks == sorted(ranks, reverse=True)
+        start += len(window)
+
+
+def test_window_stays_fixed_while_pages_are_added(pages):
+    first = search(q="archive", limit=2)
+    with pages.cursor() as cur:
+        cur.execute("INSERT INTO documents VALUES ('new', 'new.png', 'done')")
+        cur.execute("INSERT INTO document_pages (doc_id, page_number, full_text) "
+                    "VALUES ('new', 1, 'archive archive archive archive')")
+    second = search(q="archive", limit=3, cursor=first["nextCursor"])
+    ids = [item["id"] for item in first["items"] + second["items"]]
+    assert "new" not in ids
+    assert sorted(ids) == ["doc10", "doc11", "doc7", "doc8", "doc9"]
+    assert search(q="archive", limit=1)["items"][0]["id"] == "new"
+
+
+def test_filters_and_snippets(pages):
+    done = [item["id"] for response in all_pages(q="archive", status="done") for item in response["items"]]
+    assert sorted(done) == sorted(f"doc{i}" for i in range(12) if i % 3)
+
+    found = search(entity="100%", entity_type="PERSON")
+    assert sorted(item["id"] for item in found["items"]) == ["doc1", "doc2"]
+    assert found["items"][0]["entities"] == [{"type": "PERSON", "text": "Ivan 100%"}]
+    # % in the entity text is matched literally
+    assert search(entity="0%x")["items"] == []
+
+    item = search(q="inventory", limit=1)["items"][0]
+    assert "<b>inventory</b>" in item["snippet"] and item["filepath"] == f"/s3/{main.S3_BUCKET_NAME}/doc11.png"
+
+
+def test_cursor_round_trip_and_validation():
+    assert main.decode_search_cursor(main.encode_search_cursor(40, 0.25, 17)) == (40, 0.25, 17)
+    assert main.decode_search_cursor(main.encode_search_cursor(16)) == (16, None, None)
+    for cursor in ("not base64!", main.encode_search_cursor("x", 1, 2)[:-4]):
+        with pytest.raises(HTTPException) as error:
+            main.decode_search_cursor(cursor)
+        assert error.value.status_code == 400
+    with pytest.raises(HTTPException):
+        search()
@@ -0,0 +1,85 @@
+import asyncio
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+
+def test_notifications_fan_out_to_the_document_subscribers():
+    broadcaster = main.StatusBroadcaster()
+
+    async def scenario():
+        first, second = broadcaster.subscribe("a"), broadcaster.subscribe("a")
+        other = broadcaster.subscribe("b")
+        broadcaster._dispatch(json.dumps({"id": "a", "status": "processing", "progress": {"done": 1, "total": 2}}))
+        broadcaster._dispatch("not json")
+        broadcaster._dispatch(json.dumps({"id": "c", "status": "done"}))
+        await asyncio.sleep(0)
+        assert first[1].get_nowait() == second[1].get_nowait() == {
+            "id": "a", "status": "processing", "progress": {"done": 1, "total": 2}}
+        assert first[1].empty() and other[1].empty()
+
+        broadcaster.unsubscribe("a", first)
+        broadcaster._dispatch(json.dumps({"id": "a", "status": "done"}))
+        await asyncio.sleep(0)
+        assert first[1].empty() and second[1].get_nowait()["status"] == "done"
+
+        broadcaster.unsubscribe("a", second)
+        broadcaster.unsubscribe("b", other)
+        broadcaster.unsubscribe("b", other)
+        assert broadcaster._subscribers == {}
+
+    asyncio.run(scenario())
+
+
+@pytest.fixture
+def events(monkeypatch):
+    """
+    TestClient reads the whole stream before returning, so the notifications are sent from the
+    status lookup: by then the endpoint has already subscribed, as the listener thread would see it.
+    """
+    broadcaster = main.StatusBroadcaster()
+    statuses = {}
+    notifications = []
+
+    def fetch_doc_status(doc_id):
+        for event in notifications:
+            broadcaster._dispatch(json.dumps(event))
+        return statuses.get(doc_id)
+
+    monkeypatch.setattr(main, "status_broadcaster", broadcaster)
+    monkeypatch.setattr(main, "fetch_doc_status", fetch_doc_status)
+    return broadcaster, statuses, notifications
+
+
+def read_events(response):
+    return [json.loads(line[len("data: "):]) for line in response.text.splitlines() if line.startswith("data: ")]
+
+
+def test_stream_ends_on_a_terminal_status(events):
+    broadcaster, statuses, notifications = events
+    statuses["doc"] = "processing"
+    notifications.extend([{"id": "other", "status": "done"},
+                          {"id": "doc", "status": "processing", "progress": {"done": 1, "total": 2}},
+                          {"id": "doc", "status": "done"},
+                          {"id": "doc", "status": "processing"}])
+    response = TestClient(main.app).get("/recognition-events/doc")
+
+    assert response.headers["content-type"].startswith("text/event-stream")
+    assert "event: progress" in response.text
+    received = read_events(response)
+    assert [event.get("status") for event in received] == ["processing", "processing", "done"]
+    assert received[1]["progress"] == {"done": 1, "total": 2}
+    assert broadcaster._subscribers == {}
+
+
+def test_finished_or_missing_documents(events):
+    broadcaster, statuses, notifications = events
+    statuses["doc"] = "fail"
+    notifications.append({"id": "doc", "status": "processing"})
+    client = TestClient(main.app)
+    assert read_events(client.get("/recognition-events/doc")) == [{"id": "doc", "status": "fail"}]
+    assert client.get("/recognition-events/missing").status_code == 404
+    assert broadcaster._subscribers == {}
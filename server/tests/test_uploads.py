@@ -0,0 +1,176 @@
+import io
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+from botocore.exceptions import ClientError
+from fastapi.testclient import TestClient
+
+import main
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 100
+
+
+class FakeS3:
+    """The internal MinIO client: objects in memory, calls recorded."""
+
+    def __init__(self):
+        self.objects = {}
+        self.calls = []
+
+    def _missing(self, key, operation):
+        if key not in self.objects:
+            raise ClientError({"Error": {"Code": "404"}}, operation)
+
+    def create_multipart_upload(self, Bucket, Key, ContentType):
+        self.calls.append(("create_multipart_upload", Key))
+        return {"UploadId": "upload-1"}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.calls.append(("complete_multipart_upload", Key, UploadId, MultipartUpload["Parts"]))
+
+    def head_object(self, Bucket, Key):
+        self._missing(Key, "HeadObject")
+        return {"ContentLength": len(self.objects[Key])}
+
+    def get_object(self, Bucket, Key, Range):
+        self._missing(Key, "GetObject")
+        end = int(Range.rsplit("-", 1)[1])
+        return {"Body": io.BytesIO(self.objects[Key][:end + 1])}
+
+    def delete_object(self, Bucket, Key):
+        self.calls.append(("delete_object", Key))
+        self.objects.pop(Key, None)
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.calls.append(("abort_multipart_upload", Key, UploadId))
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv("MINIO_ROOT_USER", "minio")
+    monkeypatch.setenv("MINIO_ROOT_PASSWORD", "minio-secret")
+    monkeypatch.setattr(main, "S3_PUBLIC_ENDPOINT", None)
+    fake = FakeS3()
+    real_client = main.get_s3_client
+
+    def get_s3_client(endpoint_url="http://minio:9000"):
+        # presigned URLs are signed offline by a real client for the public endpoint
+        return fake if endpoint_url == "http://minio:9000" else real_client(endpoint_url)
+
+    monkeypatch.setattr(main, "get_s3_client", get_s3_client)
+    return fake
+
+
+@pytest.fixture
+def registered(monkeypatch):
+    calls = []
+
+    def register_document(*args):
+        calls.append(args)
+        return True
+
+    monkeypatch.setattr(main, "register_document", register_document)
+    return calls
+
+
+@pytest.fixture
+def client():
+    # without the context manager the startup hook (MinIO, Postgres, LISTEN) does not run
+    return TestClient(main.app)
+
+
+def test_to_public_url_keeps_the_signed_path():
+    url = "https://ocr.example.org/documents/a.png?X-Amz-Signature=abc&partNumber=2"
+    assert main.to_public_url(url) == "https://ocr.example.org/s3/documents/a.png?X-Amz-Signature=abc&partNumber=2"
+
+
+def test_upload_url_is_signed_for_the_forwarded_host(s3, client):
+    response = client.post("/uploads?tenant=acme", json={"filename": "Scan.PNG", "size": 1000,
+                                                        "content_type": "image/png"},
+                           headers={"host": "ocr.example.org", "x-forwarded-proto": "https"})
+    assert response.status_code == 200
+    upload = response.json()
+    assert upload["key"] == f"{upload['id']}.png"
+    url = urlsplit(upload["url"])
+    assert (url.scheme, url.netloc, url.path) == ("https", "ocr.example.org", f"/s3/documents/{upload['key']}")
+    query = parse_qs(url.query)
+    assert query["X-Amz-SignedHeaders"] == ["content-type;host"] and "X-Amz-Signature" in query
+    assert upload["headers"] == {"Content-Type": "image/png"}
+    assert upload["complete"] == f"/uploads/{upload['id']}/complete?priority_class=interactive&tenant=acme"
+
+
+def test_large_upload_gets_a_url_per_part(s3, client):
+    response = client.post("/uploads", json={"filename": "big.jpg", "size": 100 * 2**20},
+                           headers={"host": "localhost:8080"})
+    upload = response.json()
+    assert upload["upload_id"] == "upload-1" and s3.calls == [("create_multipart_upload", upload["key"])]
+    assert [part["part_number"] for part in upload["parts"]] == list(range(1, 8))
+    last = urlsplit(upload["parts"][-1]["url"])
+    assert last.netloc == "localhost:8080" and last.path.startswith("/s3/documents/")
+    assert parse_qs(last.query)["partNumber"] == ["7"] and parse_qs(last.query)["uploadId"] == ["upload-1"]
+
+
+@pytest.mark.parametrize("filename, size, status", [("doc.pdf", 10, 400), ("a.png", 0, 413),
+                                                    ("a.png", main.MAX_UPLOAD_BYTES + 1, 413)])
+def test_upload_request_is_validated(s3, client, filename, size, status):
+    assert client.post("/uploads", json={"filename": filename, "size": size}).status_code == status
+
+
+def test_completion_registers_a_valid_image(s3, registered, client):
+    s3.objects["doc-1.png"] = PNG
+    response = client.post("/uploads/doc-1/complete?priority_class=bulk&tenant=acme&profile=true",
+                           json={"key": "doc-1.png"})
+    assert response.json() == {"id": "doc-1", "created": True}
+    assert registered == [("doc-1", "doc-1.png", "bulk", "acme", True)]
+
+
+def test_completion_rejects_a_bad_magic_and_deletes_it(s3, registered, client):
+    s3.objects["doc-1.png"] = b"\xff\xd8\xff" + b"\x00" * 100
+    response = client.post("/uploads/doc-1/complete", json={"key": "doc-1.png"})
+    assert response.status_code == 400
+    assert ("delete_object", "doc-1.png") in s3.calls and "doc-1.png" not in s3.objects
+    assert registered == []
+
+
+@pytest.mark.parametrize("key", ["doc-2.png", "doc-1.jpg.png", "../doc-1.png", "doc-1.pdf"])
+def test_completion_rejects_a_foreign_key(s3, registered, client, key):
+    s3.objects[key] = PNG
+    assert client.post("/uploads/doc-1/complete", json={"key": key}).status_code == 400
+    assert s3.calls == [] and registered == []
+
+
+def test_completion_before_the_upload_is_a_conflict(s3, registered, client):
+    assert client.post("/uploads/doc-1/complete", json={"key": "doc-1.png"}).status_code == 409
+
+
+def test_multipart_completion_sends_the_parts_in_order(s3, registered, client):
+    s3.objects["doc-1.jpg"] = b"\xff\xd8\xff\xe0" + b"\x00" * 100
+    response = client.post("/uploads/doc-1/complete", json={
+        "key": "doc-1.jpg", "upload_id": "upload-1",
+        "parts": [{"part_number": 2, "etag": '"b"'}, {"part_number": 1, "etag": '"a"'}],
+    })
+    assert response.status_code == 200
+    assert s3.calls == [("complete_multipart_upload", "doc-1.jpg", "upload-1",
+                         [{"PartNumber": 1, "ETag": '"a"'}, {"PartNumber": 2, "ETag": '"b"'}])]
+    assert registered == [("doc-1", "doc-1.jpg", "interactive", "default", False)]
+
+    response = client.post("/uploads/doc-1/complete", json={"key": "doc-1.jpg", "upload_id": "upload-1"})
+    assert response.status_code == 400
+
+
+@pytest.fixture
+def documents(pg_schema):
+    with pg_schema.cursor() as cur:
+        cur.execute("CREATE TABLE documents (id text PRIMARY KEY)")
+        cur.execute("INSERT INTO documents VALUES ('done-1')")
+    return pg_schema
+
+
+def test_abort_drops_unfinished_uploads_only(s3, documents, client):
+    assert client.delete("/uploads/doc-1?key=doc-1.png").json() == {"id": "doc-1", "aborted": True}
+    assert client.delete("/uploads/doc-2?key=doc-2.jpg&upload_id=upload-1").status_code == 200
+    assert s3.calls == [("delete_object", "doc-1.png"), ("abort_multipart_upload", "doc-2.jpg", "upload-1")]
+
+    assert client.delete("/uploads/done-1?key=done-1.png").status_code == 409
+    assert client.delete("/uploads/doc-1?key=doc-2.png").status_code == 400
+    assert len(s3.calls) == 2